@@ -0,0 +1,54 @@
+import inspect
+import torch
+from torch.utils.checkpoint import checkpoint
+
+# non-reentrant checkpointing (torch >= 1.11) also gives parameter gradients when no input requires grad
+_KWARGS = {'use_reentrant': False} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+
+
+def checkpoint_forward(module, forward, *args):
+    """
+    forward(*args), checkpointed when `module.use_checkpoint` is set and autograd is recording: only the
+    inputs are kept, the activations inside are recomputed in backward (RNG state of dropout/DropPath
+    preserved). The EMA teacher and evaluation run under no_grad and take the plain path.
+    Stages must not hold BatchNorm: the recompute would update its running statistics a second time.
+    """
+    if getattr(module, 'use_checkpoint', False) and module.training and torch.is_grad_enabled():
+        return checkpoint(forward, *args, **_KWARGS)
+    return forward(*args)
+
+
+def checkpoint_stages(model):
+    """ :return: {qualified name: module} of the stages of `model` with a `use_checkpoint` switch """
+    return {name: module for name, module in model.named_modules()
+            if name and isinstance(getattr(module, 'use_checkpoint', None), bool)}
+
+
+def set_activation_checkpointing(model, stages='all'):
+    """
+    Switch activation checkpointing of the stages of `model`.
+    :param stages: 'all', 'none', or a comma separated list (or list) of stage class names, e.g. 'IGAB',
+        or qualified module names / prefixes, e.g. 'body.0.denoiser.bottleneck' or 'body.0.denoiser'.
+        A stage inside an enabled one is left off, its activations are already recomputed.
+    :return: names of the enabled stages
+    """
+    if isinstance(stages, str):
+        stages = [s.strip() for s in stages.split(',') if s.strip()]
+    stages = list(stages)
+
+    def selected(name, module):
+        if 'all' in stages:
+            return True
+        return any(type(module).__name__ == s or name == s or name.startswith(s + '.') for s in stages)
+
+    enabled = []
+    for name, module in checkpoint_stages(model).items():
+        inside = any(name.startswith(outer + '.') for outer in enabled)
+        module.use_checkpoint = 'none' not in stages and not inside and selected(name, module)
+        if module.use_checkpoint:
+            enabled.append(name)
+    unknown = [s for s in stages if s not in ('all', 'none') and not any(
+        type(m).__name__ == s or n == s or n.startswith(s + '.') for n, m in checkpoint_stages(model).items())]
+    if unknown:
+        raise ValueError('no checkpointable stage matches %s, see activation_checkpoint.checkpoint_stages' % unknown)
+    return enabled
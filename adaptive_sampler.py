@@ -0,0 +1,85 @@
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class AdaptiveSampler(Sampler):
+    """
+    Unlabeled-sample order that spends the epoch on the samples whose reliable-bank candidate is
+    still improving. get_reliable reports the MUSIQ scores of every visit through update(); the
+    margin of a sample is the EMA of score_teacher - max(score_student, score_bank), how far the
+    teacher is from winning a swap. A sample is settled once its candidate was not replaced in its
+    last `patience` visits and its margin is below `margin`. Settled samples are drawn with
+    probability `min_rate` per epoch, all others every epoch, so an epoch shrinks as the bank converges.
+    Samples never scored count as improving; a replacement makes a sample improving again.
+    The dataset must be wrapped in teacher_cache.IndexedDataset, the trainer reads the ids from the batch.
+    :param min_rate: minimum revisit rate of settled samples, 1 draws every sample every epoch
+    """
+
+    def __init__(self, num_samples, min_rate=0.25, patience=3, margin=0.0, momentum=0.5, shuffle=True, seed=None):
+        self.num_samples = num_samples
+        self.min_rate = min_rate
+        self.patience = patience
+        self.margin = margin
+        self.momentum = momentum
+        self.shuffle = shuffle
+        self.seed = torch.initial_seed() % 2 ** 31 if seed is None else seed
+        self.scored = np.zeros(num_samples, dtype=bool)
+        self.gap = np.zeros(num_samples, dtype=np.float64)
+        self.since_update = np.zeros(num_samples, dtype=np.int64)
+        self.updates = np.zeros(num_samples, dtype=np.int64)
+        self.epoch = None
+        self.indices = None
+
+    def settled(self):
+        return self.scored & (self.since_update >= self.patience) & (self.gap < self.margin)
+
+    def set_epoch(self, epoch):
+        """ Draw the samples of `epoch`, call it before iter(loader) so len(loader) is the drawn length """
+        if epoch == self.epoch and self.indices is not None:
+            # resumed in the middle of this epoch, keep the saved draw
+            return
+        self.epoch = epoch
+        rng = np.random.default_rng(self.seed + epoch)
+        keep = rng.random(self.num_samples) < np.where(self.settled(), self.min_rate, 1.0)
+        indices = np.nonzero(keep)[0]
+        if self.shuffle:
+            rng.shuffle(indices)
+        self.indices = indices.tolist()
+
+    def update(self, ids, score_t, score_s, score_r, replaced):
+        """ MUSIQ scores of teacher, student and bank candidate of the samples `ids`, and which candidates were replaced """
+        ids = torch.as_tensor(ids).cpu().numpy()
+        n = len(ids)
+        gap = np.asarray(score_t, dtype=np.float64).reshape(n) - np.maximum(
+            np.asarray(score_s, dtype=np.float64).reshape(n), np.asarray(score_r, dtype=np.float64).reshape(n))
+        replaced = np.asarray(replaced, dtype=bool).reshape(n)
+        old = self.gap[ids]
+        self.gap[ids] = np.where(self.scored[ids], self.momentum * old + (1 - self.momentum) * gap, gap)
+        self.scored[ids] = True
+        self.since_update[ids] = np.where(replaced, 0, self.since_update[ids] + 1)
+        self.updates[ids] += replaced
+
+    def stats(self):
+        return {'settled': float(self.settled().mean()) if self.num_samples else 0.0,
+                'epoch_fraction': len(self) / max(1, self.num_samples)}
+
+    def __iter__(self):
+        if self.indices is None:
+            self.set_epoch(0 if self.epoch is None else self.epoch)
+        return iter(self.indices)
+
+    def __len__(self):
+        if self.indices is None:
+            return self.num_samples
+        return len(self.indices)
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch, 'indices': self.indices, 'scored': self.scored.copy(),
+                'gap': self.gap.copy(), 'since_update': self.since_update.copy(), 'updates': self.updates.copy()}
+
+    def load_state_dict(self, state):
+        for key in ('seed', 'epoch', 'indices'):
+            setattr(self, key, state[key])
+        for key in ('scored', 'gap', 'since_update', 'updates'):
+            setattr(self, key, np.array(state[key]))
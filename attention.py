@@ -1,9 +1,13 @@
+from collections import OrderedDict
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 # from https://github.com/HarukiYqM/Non-Local-Sparse-Attention
 
+# seeded rotations kept per module, the least recently used shape / device / dtype is dropped first
+MAX_CACHED_ROTATIONS = 8
+
 
 def batched_index_select(values, indices):
     last_dim = values.shape[-1]
@@ -11,24 +15,49 @@ def batched_index_select(values, indices):
 
 
 class NonLocalSparseAttention(nn.Module):
+    """
+    :param rotation_seed: None draws new LSH rotations on every forward (training), an int freezes
+        them to a seeded draw that is cached, so inference is reproducible
+    :param max_buckets: buckets attended per step of the bucket loop, None processes all at once
+    """
+
     def __init__(self, n_hashes=4, channels=64, k_size=3, reduction=4, chunk_size=144,
-                 res_scale=1):
+                 res_scale=1, rotation_seed=None, max_buckets=None):
         super(NonLocalSparseAttention, self).__init__()
         self.chunk_size = chunk_size
         self.n_hashes = n_hashes
         self.reduction = reduction
         self.res_scale = res_scale
+        self.rotation_seed = rotation_seed
+        self.max_buckets = max_buckets
+        self._rotations = OrderedDict()
         self.conv_match = nn.Conv2d(channels, channels // reduction, k_size, padding=k_size//2, bias=True)
         self.conv_assembly = nn.Conv2d(channels, channels, 1, padding=0, bias=True)
 
+    def rotations(self, dim, hash_buckets, device, dtype):
+        # sizes are tensors while tracing, ints keep the cache key and the seeded draw traceable
+        rotations_shape = (1, int(dim), self.n_hashes, int(hash_buckets) // 2)
+        if self.rotation_seed is None:
+            return torch.randn(rotations_shape, dtype=dtype, device=device)
+        key = (rotations_shape, device, dtype, self.rotation_seed)
+        rotations = self._rotations.get(key)
+        if rotations is not None:
+            self._rotations.move_to_end(key)
+        else:
+            # drawn on the CPU so the same seed gives the same rotations on every device
+            generator = torch.Generator().manual_seed(self.rotation_seed)
+            rotations = torch.randn(rotations_shape, generator=generator).to(device=device, dtype=dtype)
+            self._rotations[key] = rotations
+            if len(self._rotations) > MAX_CACHED_ROTATIONS:
+                self._rotations.popitem(last=False)
+        return rotations
+
     def LSH(self, hash_buckets, x):
         N = x.shape[0]
         device = x.device
 
         # generate random rotation matrix
-        rotations_shape = (1, x.shape[-1], self.n_hashes, hash_buckets // 2)
-        random_rotations = torch.randn(rotations_shape, dtype=x.dtype, device=device).expand(N, -1, -1,
-                                                                                             -1)
+        random_rotations = self.rotations(x.shape[-1], hash_buckets, device, x.dtype).expand(N, -1, -1, -1)
 
         # locality sensitive hashing
         rotated_vecs = torch.einsum('btf,bfhi->bhti', x, random_rotations) 
@@ -49,6 +78,14 @@ class NonLocalSparseAttention(nn.Module):
         x_extra_forward = torch.cat([x[:, :, 1:, ...], x[:, :, :1, ...]], dim=2)
         return torch.cat([x, x_extra_back, x_extra_forward], dim=3)
 
+    def gather_adjacent_buckets(self, x, start, end):
+        # add_adjacent_buckets restricted to buckets [start, end)
+        n_buckets = x.shape[2]
+        idx = torch.arange(start, end, device=x.device)
+        return torch.cat([x[:, :, start:end],
+                          x.index_select(2, (idx - 1) % n_buckets),
+                          x.index_select(2, (idx + 1) % n_buckets)], dim=3)
+
     def forward(self, input):
 
         N, _, H, W = input.shape
@@ -65,7 +102,9 @@ class NonLocalSparseAttention(nn.Module):
 
         # group elements with same hash code by sorting
         _, indices = hash_codes.sort(dim=-1)
-        _, undo_sort = indices.sort(dim=-1)  # undo_sort to recover original order
+        # undo_sort to recover original order, the inverse permutation is scattered instead of sorted
+        positions = torch.arange(indices.shape[-1], device=indices.device).expand_as(indices)
+        undo_sort = torch.empty_like(indices).scatter_(1, indices, positions)
         mod_indices = (indices % L)  # now range from (0->H*W)
         x_embed_sorted = batched_index_select(x_embed, mod_indices)
         y_embed_sorted = batched_index_select(y_embed, mod_indices)
@@ -86,21 +125,27 @@ class NonLocalSparseAttention(nn.Module):
 
         x_match = F.normalize(x_att_buckets, p=2, dim=-1, eps=5e-5)
 
-        # allow attend to adjacent buckets
-        x_match = self.add_adjacent_buckets(x_match)
-        y_att_buckets = self.add_adjacent_buckets(y_att_buckets)
-
-        # unormalized attention score
-        raw_score = torch.einsum('bhkie,bhkje->bhkij', x_att_buckets,
-                                 x_match)
-
-        # softmax
-        bucket_score = torch.logsumexp(raw_score, dim=-1, keepdim=True)
-        score = torch.exp(raw_score - bucket_score) 
+        # attend to the bucket and its two neighbours, max_buckets at a time to bound the score memory
+        n_buckets = x_att_buckets.shape[2]
+        step = self.max_buckets or n_buckets
+        rets, bucket_scores = [], []
+        for start in range(0, n_buckets, step):
+            end = min(start + step, n_buckets)
+            keys = self.gather_adjacent_buckets(x_match, start, end)
+            values = self.gather_adjacent_buckets(y_att_buckets, start, end)
+
+            # unormalized attention score
+            raw_score = torch.einsum('bhkie,bhkje->bhkij', x_att_buckets[:, :, start:end], keys)
+
+            # softmax
+            bucket_scores.append(torch.logsumexp(raw_score, dim=-1))
+            score = torch.softmax(raw_score, dim=-1)
+
+            # attention
+            rets.append(torch.einsum('bukij,bukje->bukie', score, values))
+        ret = torch.cat(rets, dim=2) if len(rets) > 1 else rets[0]
+        bucket_score = torch.cat(bucket_scores, dim=2) if len(bucket_scores) > 1 else bucket_scores[0]
         bucket_score = torch.reshape(bucket_score, [N, self.n_hashes, -1])
-
-        # attention
-        ret = torch.einsum('bukij,bukje->bukie', score, y_att_buckets) 
         ret = torch.reshape(ret, (N, self.n_hashes, -1, C * self.reduction))
 
         # if padded, then remove extra elements
@@ -122,3 +167,28 @@ class NonLocalSparseAttention(nn.Module):
 
         ret = ret.permute(0, 2, 1).view(N, -1, H, W).contiguous() * self.res_scale + input
         return ret
+
+
+def set_rotation_seed(model, seed=0):
+    """ Freeze (int) or release (None) the LSH rotations of every NonLocalSparseAttention in model """
+    for module in model.modules():
+        if isinstance(module, NonLocalSparseAttention):
+            module.rotation_seed = seed
+            module._rotations = OrderedDict()
+    return model
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    nla = NonLocalSparseAttention(channels=64).eval()
+    x = torch.randn(2, 64, 48, 48)
+    with torch.no_grad():
+        # the bucket loop against the single pass, same rotations
+        torch.manual_seed(1)
+        ref = nla(x)
+        nla.max_buckets = 8
+        torch.manual_seed(1)
+        out = nla(x)
+        print('chunked bucket loop: max abs err %.1e' % (ref - out).abs().max().item())
+        set_rotation_seed(nla, 2022)
+        print('seeded rotations reproducible:', torch.equal(nla(x), nla(x)))
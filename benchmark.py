@@ -0,0 +1,288 @@
+import sys
+import json
+import time
+import resource
+import argparse
+import platform
+import subprocess
+import numpy as np
+import torch
+from registry import MODEL_MODULES, build
+from activation_checkpoint import set_activation_checkpointing
+
+try:
+    from fvcore.nn import FlopCountAnalysis
+except ImportError:
+    FlopCountAnalysis = None
+
+
+def _perpetual_loss():
+    from torchvision.models import vgg16
+    from loss.losses import PerpetualLoss
+    # same slice as the trainers, random weights are as fast as the pretrained ones
+    return PerpetualLoss(vgg16().features[:16])
+
+
+def _loss(module, name):
+    def create():
+        import importlib
+        return getattr(importlib.import_module(module), name)()
+    return create
+
+
+# loss name -> (constructor, number of image inputs)
+LOSSES = {
+    'MyLoss': (_loss('loss.losses', 'MyLoss'), 2),
+    'PerpetualLoss': (_perpetual_loss, 2),
+    'ContrastLoss': (_loss('loss.contrast', 'ContrastLoss'), 3),
+    'RAMContrastLoss': (_loss('loss.ram_contrast', 'RAMContrastLoss'), 3),
+    'SAMPerpetualLoss': (_loss('loss.sam_perceptural', 'SAMPerpetualLoss'), 2),
+}
+
+# models whose forward takes more than the image
+EXTRA_INPUTS = {'AIMnet': 1}
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def _reset_peak_rss():
+    """ Restart the kernel's RSS high-water mark of this process (Linux >= 4.0), False where it cannot """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+
+
+def time_fn(fn, device, warmup=3, repeats=20):
+    """
+    Call `fn` `warmup` times, then time `repeats` calls.
+    :return: dict of latency percentiles in ms and the peak memory of the timed calls
+    """
+    for _ in range(warmup):
+        fn()
+    _sync(device)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        per_case = True
+    else:
+        per_case = _reset_peak_rss()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        _sync(device)
+        times.append((time.perf_counter() - start) * 1000)
+    times = np.array(times)
+    result = {'mean_ms': float(times.mean()), 'std_ms': float(times.std()),
+              'p50_ms': float(np.percentile(times, 50)), 'p90_ms': float(np.percentile(times, 90)),
+              'p99_ms': float(np.percentile(times, 99)), 'min_ms': float(times.min())}
+    if device.type == 'cuda':
+        result['peak_mb'] = torch.cuda.max_memory_allocated(device) / 2 ** 20
+    elif per_case:
+        # peak RSS of the process during the timed calls
+        result['peak_mb'] = _peak_rss_mb()
+    else:
+        # no reset outside Linux: lifetime high-water mark of the process, not comparable between cases
+        result['process_peak_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+
+def count_flops(model, inputs):
+    if FlopCountAnalysis is None:
+        return None
+    flops = FlopCountAnalysis(model, inputs)
+    flops.unsupported_ops_warnings(False)
+    flops.uncalled_modules_warnings(False)
+    return int(flops.total())
+
+
+def bench_model(name, device, sizes, batch_sizes, backward=False, flops=True, checkpoint=None, **kwargs):
+    """
+    One record per (batch size, size) of `name`, forward only unless `backward`
+    :param checkpoint: stages to recompute in backward, see activation_checkpoint.set_activation_checkpointing
+    """
+    model = build('model', name).to(device)
+    model.train(backward)
+    if checkpoint:
+        set_activation_checkpointing(model, checkpoint)
+    params = sum(p.numel() for p in model.parameters())
+    records = []
+    for batch_size in batch_sizes:
+        for h, w in sizes:
+            inputs = tuple(torch.rand(batch_size, 3, h, w, device=device) for _ in range(1 + EXTRA_INPUTS.get(name, 0)))
+            record = {'kind': 'model', 'name': name, 'device': device.type, 'batch_size': batch_size,
+                      'size': [h, w], 'params': params}
+            if checkpoint:
+                record['checkpoint'] = checkpoint
+
+            def step():
+                if not backward:
+                    with torch.no_grad():
+                        return model(*inputs)
+                out = model(*inputs)
+                out = out[0] if isinstance(out, (tuple, list)) else out
+                out.mean().backward()
+                model.zero_grad(set_to_none=True)
+
+            try:
+                record.update(time_fn(step, device, **kwargs))
+                record['images_per_s'] = batch_size * 1000 / record['p50_ms']
+                if flops and not backward:
+                    with torch.no_grad():
+                        record['gflops'] = count_flops(model, inputs)
+                    if record['gflops'] is not None:
+                        record['gflops'] /= 1e9
+            except RuntimeError as e:
+                # out of memory at the larger sizes, keep the smaller ones
+                record['error'] = str(e).splitlines()[0]
+                if device.type == 'cuda':
+                    torch.cuda.empty_cache()
+            records.append(record)
+    return records
+
+
+def bench_loss(name, device, sizes, batch_sizes, **kwargs):
+    """ Forward and backward of the loss w.r.t. its first input, like in the trainers """
+    create, n_inputs = LOSSES[name]
+    loss = create().to(device)
+    records = []
+    for batch_size in batch_sizes:
+        for h, w in sizes:
+            inputs = [torch.rand(batch_size, 3, h, w, device=device) for _ in range(n_inputs)]
+            inputs[0].requires_grad_(True)
+            record = {'kind': 'loss', 'name': name, 'device': device.type, 'batch_size': batch_size, 'size': [h, w]}
+
+            def step():
+                loss(*inputs).backward()
+                inputs[0].grad = None
+
+            try:
+                record.update(time_fn(step, device, **kwargs))
+                record['images_per_s'] = batch_size * 1000 / record['p50_ms']
+            except RuntimeError as e:
+                record['error'] = str(e).splitlines()[0]
+                if device.type == 'cuda':
+                    torch.cuda.empty_cache()
+            records.append(record)
+    return records
+
+
+def case_key(record):
+    key = '%s/%s/%s/b%d/%dx%d' % (record['kind'], record['name'], record['device'], record['batch_size'],
+                                  record['size'][0], record['size'][1])
+    if record.get('checkpoint'):
+        key += '/ckpt=' + record['checkpoint']
+    return key
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    env = {'commit': commit, 'torch': torch.__version__, 'python': platform.python_version(),
+           'cpu': platform.processor() or platform.machine(), 'threads': torch.get_num_threads(),
+           'cuda': torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+           'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    return env
+
+
+def compare(old, new, tolerance=0.1):
+    """
+    :return: list of (key, old p50, new p50) for cases that got slower by more than `tolerance`
+    """
+    old = {case_key(r): r for r in old['results'] if 'p50_ms' in r}
+    regressions = []
+    for record in new['results']:
+        if 'p50_ms' not in record:
+            continue
+        key = case_key(record)
+        if key in old and record['p50_ms'] > old[key]['p50_ms'] * (1 + tolerance):
+            regressions.append((key, old[key]['p50_ms'], record['p50_ms']))
+    return regressions
+
+
+def _sizes(text):
+    sizes = []
+    for size in text.split(','):
+        h, _, w = size.partition('x')
+        sizes.append((int(h), int(w or h)))
+    return sorted(sizes, key=lambda s: s[0] * s[1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency, throughput, memory, params and FLOPs of the models and losses')
+    parser.add_argument('--models', default=','.join(MODEL_MODULES), type=str, help='registry model names, "" for none')
+    parser.add_argument('--losses', default=','.join(LOSSES), type=str, help='loss names, "" for none')
+    parser.add_argument('--sizes', default='128,256,512', type=str, help='HxW or H for square inputs')
+    parser.add_argument('--batch_sizes', default='1,4', type=str)
+    parser.add_argument('--devices', default='cpu,cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    parser.add_argument('--warmup', default=3, type=int)
+    parser.add_argument('--repeats', default=20, type=int)
+    parser.add_argument('--threads', default=None, type=int, help='torch CPU threads, fix it for comparable runs')
+    parser.add_argument('--backward', action='store_true', help='time forward+backward of the models')
+    parser.add_argument('--checkpoint', default=None, type=str,
+                        help="with --backward: activation checkpointing of these stages, e.g. 'all' or 'IGAB'")
+    parser.add_argument('--no_flops', action='store_true')
+    parser.add_argument('--out', default='benchmark.json', type=str)
+    parser.add_argument('--compare', default=None, type=str, help='earlier --out file to check for regressions')
+    parser.add_argument('--tolerance', default=0.1, type=float, help='allowed relative p50 slowdown')
+
+    args = parser.parse_args()
+    torch.manual_seed(0)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.backends.cudnn.benchmark = True
+    sizes = _sizes(args.sizes)
+    batch_sizes = sorted(int(b) for b in args.batch_sizes.split(','))
+    timing = {'warmup': args.warmup, 'repeats': args.repeats}
+    results = []
+    for device in args.devices.split(','):
+        device = torch.device(device)
+        jobs = [('model', name) for name in args.models.split(',') if name] + \
+               [('loss', name) for name in args.losses.split(',') if name]
+        for kind, name in jobs:
+            print('%s %s on %s' % (kind, name, device.type))
+            try:
+                if kind == 'model':
+                    records = bench_model(name, device, sizes, batch_sizes, backward=args.backward,
+                                          flops=not args.no_flops, checkpoint=args.checkpoint, **timing)
+                else:
+                    records = bench_loss(name, device, sizes, batch_sizes, **timing)
+            except Exception as e:
+                # missing mmcv / mamba_ssm / pretrained weights, or a CUDA-only constructor
+                print('    skipped: %s: %s' % (type(e).__name__, str(e).splitlines()[0] if str(e) else ''))
+                results.append({'kind': kind, 'name': name, 'device': device.type,
+                                'error': '%s: %s' % (type(e).__name__, e)})
+                continue
+            for record in records:
+                if 'error' in record:
+                    print('    %-24s %s' % (case_key(record).split('/', 3)[-1], record['error']))
+                else:
+                    print('    %-24s p50 %8.2f ms  p90 %8.2f ms  %8.1f img/s  %8.1f MB%s' % (
+                        case_key(record).split('/', 3)[-1], record['p50_ms'], record['p90_ms'], record['images_per_s'],
+                        record.get('peak_mb', record.get('process_peak_mb')), '' if 'peak_mb' in record else ' (process)'))
+            results.extend(records)
+
+    report = {'environment': environment(), 'args': vars(args), 'results': results}
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('results written to %s' % args.out)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.tolerance)
+        for key, old, new in regressions:
+            print('REGRESSION %s: p50 %.2f ms -> %.2f ms' % (key, old, new))
+        sys.exit(1 if regressions else 0)
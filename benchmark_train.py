@@ -0,0 +1,232 @@
+import json
+import time
+import argparse
+import tempfile
+import torch
+import torch.nn as nn
+import torch.utils.data as data
+from torchvision.models import vgg16, vgg19
+from utils import initialize_weights, create_emamodel
+from registry import REGISTRY, resolve, build
+from profiling import Profiler
+from data_stream import InfiniteLoader
+from teacher_cache import IndexedDataset
+from activation_checkpoint import set_activation_checkpointing
+from gradient_ops import GetGradientNopadding
+from loss.losses import MyLoss, PerpetualLoss
+
+
+class SyntheticLabeled(data.Dataset):
+    """ (input, label) crops like dataset_simple.TrainLabeled, drawn from a small pool of random images in memory """
+
+    def __init__(self, length, finesize=256, pool=8):
+        self.length = length
+        self.images = torch.rand(pool, 2, 3, finesize, finesize)
+
+    def __getitem__(self, index):
+        a, b = self.images[index % len(self.images)]
+        return a, b
+
+    def __len__(self):
+        return self.length
+
+
+class SyntheticUnlabeled(SyntheticLabeled):
+    """ (weak, strong) augmented views like dataset_simple.TrainUnlabeled """
+
+
+class RandomVgg19(nn.Module):
+    """ loss.contrast.Vgg19 with untrained weights: the same cost, without the download """
+
+    def __init__(self):
+        super(RandomVgg19, self).__init__()
+        features = vgg19().features
+        self.slices = nn.ModuleList([features[a:b] for a, b in ((0, 2), (2, 7), (7, 12), (12, 21), (21, 30))])
+        for param in self.parameters():
+            param.requires_grad = False
+
+    def forward(self, x):
+        out = []
+        for layer in self.slices:
+            x = layer(x)
+            out.append(x)
+        return out
+
+
+def random_contrast_loss(name):
+    """
+    The contrastive loss registered as `name` (registry.REGISTRY['loss']) with untrained weights:
+        'contrast'      the VGG-19 of loss.contrast
+        'sam_contrast'  MobileSAM vit_t, as loaded by loss.sam_contrast
+        'ram_contrast'  the whole RAM Swin-L model, encoder and tagging head
+    """
+    base = resolve('loss', name)
+
+    class RandomContrastLoss(base):
+        def __init__(self, ablation=False):
+            nn.Module.__init__(self)
+            self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+            self.l1 = nn.L1Loss()
+            self.ab = ablation
+            if name == 'contrast':
+                self.vgg = RandomVgg19()
+                self.weights = [1.0 / 32, 1.0 / 16, 1.0 / 8, 1.0 / 4, 1.0]
+            elif name == 'sam_contrast':
+                from mobile_sam import sam_model_registry
+                self.sam = sam_model_registry['vit_t'](checkpoint=None)
+            elif name == 'ram_contrast':
+                from ram.models.ram import ram
+                self.ram = ram(pretrained='', image_size=384, vit='swin_l').eval()
+                self.ram.visual_encoder.freeze()
+                self.image_size = 384
+            else:
+                raise NotImplementedError('no untrained stand-in for the %s loss' % name)
+
+    return RandomContrastLoss()
+
+
+class ZeroLoss(nn.Module):
+    def forward(self, x, *args):
+        return x.new_zeros(())
+
+
+def synthetic_trainer(base, losses='random'):
+    """
+    Subclass of the trainer class `base` whose perceptual and contrastive losses are
+        'real'    the ones of the trainer (pretrained VGG, RAM/SAM weights, CUDA)
+        'random'  the same networks with untrained weights, the contrastive one picked by args.contrast_loss
+        'none'    zero, to time the models alone
+    """
+
+    class SyntheticTrainer(base):
+        def build_losses(self):
+            if losses == 'real':
+                return super().build_losses()
+            self.loss_unsup = nn.L1Loss()
+            self.loss_str = MyLoss().to(self.device)
+            self.loss_grad = nn.L1Loss().to(self.device)
+            self.get_grad = GetGradientNopadding(memory_efficient=True).to(self.device)
+            if losses == 'random':
+                self.loss_per = PerpetualLoss(vgg16().features[:16]).to(self.device)
+                self.loss_cr = random_contrast_loss(getattr(self.args, 'contrast_loss', 'ram_contrast')).to(self.device)
+            else:
+                self.loss_per = ZeroLoss()
+                self.loss_cr = ZeroLoss()
+
+    return SyntheticTrainer
+
+
+class MemoryWriter():
+    """ SummaryWriter stand-in keeping the last value of every scalar """
+
+    def __init__(self):
+        self.scalars = {}
+
+    def add_scalar(self, tag, value, global_step=None):
+        self.scalars[tag] = value
+
+
+def run(trainer_name='TrainerWithGrad', model_name='RetinexFormerWithGrad', model_args=None, losses='random',
+        steps=20, warmup=3, batch_size=2, crop_size=128, gpus=None, contrast_loss='ram_contrast', fused_forward=False,
+        teacher_cache_every=0, unlabeled_size=64, activation_checkpoint=None):
+    """
+    Run `warmup` then `steps` iterations of the trainer's _train_epoch on synthetic batches.
+    :return: dict with images/s, steps/s and the mean ms per phase of the timed steps
+    """
+    model_args = model_args or {}
+    if gpus is None:
+        gpus = 1 if torch.cuda.is_available() else 0
+    # profile records and the teacher cache go to a scratch save_path, removed after the run
+    save_dir = tempfile.TemporaryDirectory(prefix='benchmark_train_')
+    try:
+        args = argparse.Namespace(start_epoch=1, num_epochs=1, gpus=gpus, train_batchsize=batch_size,
+                                  crop_size=crop_size, save_path=save_dir.name,
+                                  resume='False', local_rank=-1, save_iter_period=0, contrast_loss=contrast_loss,
+                                  profile=True, fused_forward=fused_forward, teacher_cache_every=teacher_cache_every)
+        net = build('model', model_name, **model_args)
+        if activation_checkpoint:
+            set_activation_checkpointing(net, activation_checkpoint)
+        ema_net = create_emamodel(build('model', model_name, **model_args))
+        trainer = synthetic_trainer(resolve('trainer', trainer_name), losses)(
+            model=net, tmodel=ema_net, args=args, supervised_loader=None, val_loader=None,
+            unsupervised_loader=data.DataLoader(SyntheticUnlabeled(unlabeled_size, crop_size)),
+            iter_per_epoch=steps, writer=MemoryWriter())
+        initialize_weights(trainer.model)
+        trainer.freeze_teachers_parameters()
+
+        def epoch(n):
+            trainer.supervised_loader = data.DataLoader(SyntheticLabeled(n * batch_size, crop_size),
+                                                        batch_size=batch_size)
+            trainer.supervised_stream = InfiniteLoader(trainer.supervised_loader)
+            # n batches cycling over an unlabeled set of unlabeled_size samples
+            unlabeled = SyntheticUnlabeled(unlabeled_size, crop_size)
+            if teacher_cache_every:
+                unlabeled = IndexedDataset(unlabeled)
+            order = [i % unlabeled_size for i in range(n * batch_size)]
+            trainer.unsupervised_loader = data.DataLoader(unlabeled, batch_size=batch_size, sampler=order)
+            trainer._train_epoch(1)
+
+        if warmup:
+            epoch(warmup)
+        trainer.profiler = Profiler(enabled=True)
+        start = time.perf_counter()
+        epoch(steps)
+        seconds = time.perf_counter() - start
+        summary = trainer.profiler.summary()
+        # every step feeds a labeled and an unlabeled batch
+        result = {'trainer': trainer_name, 'model': model_name, 'losses': losses, 'device': str(trainer.device),
+                  'fused_forward': fused_forward, 'teacher_cache_every': teacher_cache_every,
+                  'unlabeled_size': unlabeled_size, 'activation_checkpoint': activation_checkpoint,
+                  'batch_size': batch_size, 'crop_size': crop_size, 'steps': steps,
+                  'steps_per_s': steps / seconds, 'images_per_s': 2 * batch_size * steps / seconds,
+                  'ms': summary['ms']}
+        result['ms']['other'] = max(0.0, seconds * 1000 / steps - sum(summary['ms'].values()))
+        for key in ('cpu_rss_mb', 'cpu_maxrss_mb', 'cuda_peak_mb'):
+            if key in summary:
+                result[key] = summary[key]
+        if teacher_cache_every:
+            result['teacher_cache_hit_rate'] = trainer.writer.scalars['teacher_cache_hit_rate']
+        return result
+    finally:
+        save_dir.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mean-teacher training-step throughput on synthetic data')
+    parser.add_argument('--trainer', default='TrainerWithGrad', type=str, choices=['Trainer', 'TrainerWithGrad'])
+    parser.add_argument('--model', default='RetinexFormerWithGrad', type=str, choices=sorted(REGISTRY['model']))
+    parser.add_argument('--model_args', default={}, type=json.loads, help='model constructor kwargs as json')
+    parser.add_argument('--losses', default='random', type=str, choices=['real', 'random', 'none'])
+    parser.add_argument('--contrast_loss', default='ram_contrast', type=str, choices=sorted(REGISTRY['loss']),
+                        help='contrastive loss of --losses real and random')
+    parser.add_argument('--steps', default=20, type=int)
+    parser.add_argument('--warmup', default=3, type=int)
+    parser.add_argument('--batch_size', default=2, type=int)
+    parser.add_argument('--crop_size', default=128, type=int)
+    parser.add_argument('--gpus', default=None, type=int, help='0 runs on the CPU, default: 1 if there is a GPU')
+    parser.add_argument('--fused_forward', action='store_true', help='one student forward over both batches')
+    parser.add_argument('--unlabeled_size', default=64, type=int, help='distinct unlabeled samples')
+    parser.add_argument('--teacher_cache_every', default=0, type=int, help='see train.py')
+    parser.add_argument('--activation_checkpoint', default=None, type=str, help='see train.py')
+    parser.add_argument('--threads', default=None, type=int, help='torch CPU threads')
+    parser.add_argument('--out', default=None, type=str, help='also write the result as json')
+
+    args = parser.parse_args()
+    torch.manual_seed(0)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    result = run(args.trainer, args.model, args.model_args, args.losses, args.steps, args.warmup, args.batch_size,
+                 args.crop_size, args.gpus, args.contrast_loss, args.fused_forward,
+                 args.teacher_cache_every, args.unlabeled_size, args.activation_checkpoint)
+    print('%s / %s on %s, batch %d, %dx%d, %s losses' % (result['trainer'], result['model'], result['device'],
+                                                         result['batch_size'], result['crop_size'],
+                                                         result['crop_size'], result['losses']))
+    print('%.2f steps/s, %.1f images/s' % (result['steps_per_s'], result['images_per_s']))
+    if 'teacher_cache_hit_rate' in result:
+        print('teacher cache hit rate %.2f' % result['teacher_cache_hit_rate'])
+    total = sum(result['ms'].values())
+    for name, ms in sorted(result['ms'].items(), key=lambda item: -item[1]):
+        print('    %-10s %9.2f ms %5.1f%%' % (name, ms, 100 * ms / total))
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=1)
@@ -0,0 +1,60 @@
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+# modules that must only be imported by the model / loss / metric that needs them
+HEAVY_MODULES = ['segment_anything', 'mobile_sam', 'ram', 'transformers', 'cv2', 'pyiqa', 'mamba_ssm', 'mmcv']
+
+
+def import_report(module, top=10):
+    """
+    Import `module` in a fresh interpreter.
+    :return: dict with wall time, the heavy modules it pulled in and the slowest imports (-X importtime)
+    """
+    code = 'import sys, json, %s; print(json.dumps(sorted(sys.modules)))' % module
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if proc.returncode != 0:
+        return {'module': module, 'error': proc.stderr.strip().splitlines()[-1]}
+
+    loaded = json.loads(proc.stdout.strip().splitlines()[-1])
+    heavy = sorted({name.split('.')[0] for name in loaded} & set(HEAVY_MODULES))
+    # lines look like 'import time:  self [us] | cumulative | imported package', nested imports are
+    # indented by two spaces per level, so the direct imports of `module` are at depth 1
+    slowest = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            slowest.append((int(cumulative) / 1e6, name.strip()))
+    slowest.sort(reverse=True)
+    return {'module': module, 'seconds': seconds, 'heavy': heavy, 'slowest': slowest[:top]}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import-time budget of the training / inference entry points')
+    parser.add_argument('--modules', default='trainer,trainer_with_grad,train,inference,export_model', type=str)
+    parser.add_argument('--budget', default=10.0, type=float, help='seconds allowed per cold import')
+    parser.add_argument('--top', default=5, type=int, help='slowest top-level imports to list')
+
+    args = parser.parse_args()
+    failed = False
+    for module in args.modules.split(','):
+        report = import_report(module, args.top)
+        if 'error' in report:
+            print('%-20s import failed: %s' % (module, report['error']))
+            failed = True
+            continue
+        over = report['seconds'] > args.budget
+        print('%-20s %.2fs%s' % (module, report['seconds'], '  OVER BUDGET' if over else ''))
+        for seconds, name in report['slowest']:
+            print('    %.2fs %s' % (seconds, name))
+        if report['heavy']:
+            print('    eagerly imports %s' % ', '.join(report['heavy']))
+        failed = failed or over or bool(report['heavy'])
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,219 @@
+import os
+import json
+import random
+import shutil
+import threading
+import numpy as np
+import torch
+
+# A checkpoint is a directory holding one shard per component plus an index:
+#   model_e20/
+#   ├── student.pth     student state_dict (DataParallel keys)
+#   ├── teacher.pth     EMA teacher state_dict
+#   ├── optimizer.pth   optimizer state_dict
+#   ├── trainer.pth     epoch, iteration, curiter, scheduler, rng, bank, ...
+#   └── index.json      written last, a directory without it is incomplete
+# Legacy single-file checkpoints ({'arch','epoch','state_dict','optimizer_dict'})
+# are still accepted by load_checkpoint.
+
+INDEX_NAME = 'index.json'
+LATEST_NAME = 'latest.json'
+
+
+def to_cpu(obj):
+    """ Deep copy of a (nested) state onto the CPU, detached from the live training tensors """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [to_cpu(v) for v in obj]
+    if isinstance(obj, tuple):
+        return tuple(to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    state = {'python': random.getstate(),
+             'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        cuda_state = state['cuda'][:torch.cuda.device_count()]
+        torch.cuda.set_rng_state_all(cuda_state)
+
+
+def is_checkpoint_dir(path):
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, INDEX_NAME))
+
+
+def load_checkpoint(path, map_location='cpu'):
+    """
+    :param path: checkpoint directory, legacy .pth file, or a save_path holding latest.json
+    :return: dict with the shards plus the legacy 'state_dict'/'optimizer_dict'/'epoch' keys
+    """
+    if os.path.isdir(path) and not is_checkpoint_dir(path):
+        with open(os.path.join(path, LATEST_NAME)) as f:
+            path = os.path.join(path, json.load(f)['name'])
+    if not os.path.isdir(path):
+        return torch.load(path, map_location=map_location)
+
+    with open(os.path.join(path, INDEX_NAME)) as f:
+        index = json.load(f)
+    checkpoint = {'index': index}
+    for shard in index['shards']:
+        checkpoint[shard] = torch.load(os.path.join(path, shard + '.pth'), map_location=map_location)
+    checkpoint['state_dict'] = checkpoint.get('student')
+    checkpoint['optimizer_dict'] = checkpoint.get('optimizer')
+    checkpoint['epoch'] = index['epoch']
+    return checkpoint
+
+
+class CheckpointManager():
+    """ Writes sharded checkpoints from a CPU snapshot in a background thread """
+
+    def __init__(self, save_dir, keep_last=None, async_save=True):
+        self.save_dir = str(save_dir)
+        self.keep_last = keep_last
+        self.async_save = async_save
+        self._thread = None
+        self._error = None
+        self._lock = threading.Lock()
+
+    def save(self, state, name, epoch, iteration=None, metric=None, rotate=False):
+        """
+        :param state: dict of shard name -> picklable state, tensors may live on the GPU
+        :param name: checkpoint directory name, an existing one is replaced atomically
+        :param iteration: iterations done inside `epoch`, None once the epoch is finished
+        :param rotate: take part in keep_last rotation (epoch checkpoints)
+        """
+        # the snapshot is taken on the caller's thread so training can mutate the live tensors
+        snapshot = to_cpu(state)
+        index = {'name': name, 'epoch': epoch, 'iteration': iteration, 'metric': metric,
+                 'rotate': rotate, 'shards': sorted(snapshot.keys())}
+        self.wait()
+        if self.async_save:
+            self._thread = threading.Thread(target=self._write_guarded, args=(snapshot, index))
+            self._thread.start()
+        else:
+            self._write(snapshot, index)
+
+    def wait(self):
+        """ Block until the pending write is on disk, re-raising its error if it failed """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def latest(self):
+        path = os.path.join(self.save_dir, LATEST_NAME)
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            return os.path.join(self.save_dir, json.load(f)['name'])
+
+    def _write_guarded(self, snapshot, index):
+        try:
+            self._write(snapshot, index)
+        except Exception as e:
+            self._error = e
+
+    def _write(self, snapshot, index):
+        with self._lock:
+            final_dir = os.path.join(self.save_dir, index['name'])
+            tmp_dir = final_dir + '.tmp'
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir)
+            os.makedirs(tmp_dir)
+            for shard, value in snapshot.items():
+                torch.save(value, os.path.join(tmp_dir, shard + '.pth'))
+            with open(os.path.join(tmp_dir, INDEX_NAME), 'w') as f:
+                json.dump(index, f)
+
+            if os.path.isdir(final_dir):
+                old_dir = final_dir + '.old'
+                os.replace(final_dir, old_dir)
+                os.replace(tmp_dir, final_dir)
+                shutil.rmtree(old_dir)
+            else:
+                os.replace(tmp_dir, final_dir)
+            self._write_json(LATEST_NAME, {'name': index['name'], 'epoch': index['epoch'],
+                                           'iteration': index['iteration']})
+            if index['rotate']:
+                self._rotate()
+
+    def _write_json(self, name, obj):
+        path = os.path.join(self.save_dir, name)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(obj, f)
+        os.replace(path + '.tmp', path)
+
+    def _rotate(self):
+        if not self.keep_last:
+            return
+        rotated = []
+        for name in os.listdir(self.save_dir):
+            path = os.path.join(self.save_dir, name)
+            if is_checkpoint_dir(path):
+                with open(os.path.join(path, INDEX_NAME)) as f:
+                    index = json.load(f)
+                if index.get('rotate'):
+                    rotated.append((index['epoch'], path))
+        rotated.sort()
+        for _, path in rotated[:-self.keep_last]:
+            shutil.rmtree(path)
+
+
+def trainer_state(trainer, epoch, iteration=None):
+    """ Full resumable state of a mean-teacher Trainer """
+    return {'student': trainer.model.state_dict(),
+            'teacher': trainer.tmodel.state_dict(),
+            'optimizer': trainer.optimizer_s.state_dict(),
+            'trainer': {'arch': type(trainer.model).__name__,
+                        'epoch': epoch,
+                        'iteration': iteration,
+                        'curiter': trainer.curiter,
+                        'scheduler': trainer.lr_scheduler_s.state_dict(),
+                        'best_psnr': trainer.best_psnr,
+                        'supervised_stream': trainer.supervised_stream.state_dict(),
+                        'unlabeled_sampler': trainer.unlabeled_sampler.state_dict()
+                        if getattr(trainer, 'unlabeled_sampler', None) is not None else None,
+                        'rng': get_rng_state()}}
+
+
+def restore_trainer(trainer, checkpoint):
+    """
+    Load a checkpoint into the trainer and set trainer.start_epoch / trainer.start_iter.
+    Legacy checkpoints only carry the student, so the run restarts at args.start_epoch.
+    """
+    trainer.model.load_state_dict(checkpoint['state_dict'])
+    if 'trainer' not in checkpoint:
+        return
+    trainer.tmodel.load_state_dict(checkpoint['teacher'])
+    trainer.optimizer_s.load_state_dict(checkpoint['optimizer'])
+    state = checkpoint['trainer']
+    trainer.lr_scheduler_s.load_state_dict(state['scheduler'])
+    trainer.curiter = state['curiter']
+    trainer.best_psnr = state['best_psnr']
+    if 'supervised_stream' in state:
+        trainer.supervised_stream.load_state_dict(state['supervised_stream'])
+    if state.get('unlabeled_sampler') is not None and getattr(trainer, 'unlabeled_sampler', None) is not None:
+        trainer.unlabeled_sampler.load_state_dict(state['unlabeled_sampler'])
+    if state['iteration'] is None:
+        trainer.start_epoch = state['epoch'] + 1
+        trainer.start_iter = 0
+    else:
+        trainer.start_epoch = state['epoch']
+        trainer.start_iter = state['iteration']
+    # rng is restored after the data iterators have been fast-forwarded, see _train_epoch
+    trainer.resume_rng = state['rng']
@@ -0,0 +1,77 @@
+import torch
+from torch.utils.data import DataLoader
+
+
+def loader_over(loader, indices):
+    """ DataLoader over `indices` of the dataset of `loader`, with its batch_size, workers and collate_fn """
+    return DataLoader(loader.dataset, batch_size=loader.batch_size, sampler=indices,
+                      num_workers=loader.num_workers, collate_fn=loader.collate_fn,
+                      pin_memory=loader.pin_memory, drop_last=loader.drop_last,
+                      worker_init_fn=loader.worker_init_fn)
+
+
+def iter_from(loader, batch):
+    """
+    Iterator over `loader` starting at batch `batch`, for a mid-epoch resume: the sampler order of
+    the epoch is drawn as usual and the indices of the consumed batches are dropped, so the skipped
+    batches are never loaded or augmented.
+    """
+    if not batch:
+        return iter(loader)
+    return iter(loader_over(loader, list(loader.sampler)[batch * loader.batch_size:]))
+
+
+class InfiniteLoader():
+    """
+    Endless stream of batches from the dataset of `loader`, replacing itertools.cycle(loader).
+    Every pass draws a new permutation and runs the dataset's random augmentations again, and only
+    the batches in flight are held in memory (cycle keeps the whole first pass and replays it).
+    The position in the stream is part of state_dict(), so a run resumes at the exact next batch
+    without loading the skipped ones.
+    :param loader: DataLoader whose dataset, batch_size, workers and collate_fn are reused
+    :param seed: base seed of the per-pass permutations, default torch.initial_seed()
+    """
+
+    def __init__(self, loader, seed=None, shuffle=True):
+        self.loader = loader
+        self.seed = torch.initial_seed() % 2 ** 31 if seed is None else seed
+        self.shuffle = shuffle
+        self.epoch = 0
+        self.batch = 0
+        self._iterator = None
+
+    def order(self, epoch):
+        n = len(self.loader.dataset)
+        if not self.shuffle:
+            return list(range(n))
+        generator = torch.Generator().manual_seed(self.seed + epoch)
+        return torch.randperm(n, generator=generator).tolist()
+
+    def _start_pass(self):
+        return iter(loader_over(self.loader, self.order(self.epoch)[self.batch * self.loader.batch_size:]))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        for _ in range(2):
+            if self._iterator is None:
+                self._iterator = self._start_pass()
+            try:
+                batch = next(self._iterator)
+                self.batch += 1
+                return batch
+            except StopIteration:
+                self._iterator = None
+                self.epoch += 1
+                self.batch = 0
+        raise RuntimeError('the labeled dataset yields no batch, is it smaller than batch_size with drop_last?')
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch, 'batch': self.batch}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.batch = state['batch']
+        self._iterator = None
@@ -2,6 +2,8 @@ import os.path
 import torch
 import torch.utils.data as data
 from PIL import Image
+from image_io import load_resized
+from manifest import load_pairs
 import random
 from random import randrange
 from torchvision.transforms import ToTensor
@@ -62,23 +64,17 @@ class TrainLabeled(data.Dataset):
         self.dir_B = os.path.join(self.root, self.phase + '/GT')
         self.dir_C = os.path.join(self.root, self.phase + '/LA')
 
-        # image path
-        self.A_paths = sorted(make_dataset(self.dir_A))
-        self.B_paths = sorted(make_dataset(self.dir_B))
-        self.C_paths = sorted(make_dataset(self.dir_C))
+        # image paths, paired by file stem and indexed in a manifest, see manifest.py
+        self.A_paths, self.B_paths, self.C_paths = load_pairs(os.path.join(self.root, self.phase), ('input', 'GT', 'LA'))
 
         # transform
         self.transform = ToTensor()  # [0,1]
 
     def __getitem__(self, index):
         # A, B is the image pair, hazy, gt respectively
-        A = Image.open(self.A_paths[index]).convert("RGB")
-        B = Image.open(self.B_paths[index]).convert("RGB")
-        C = Image.open(self.C_paths[index]).convert("RGB")
-        # resize
-        resized_a = A.resize((280, 280), Image.ANTIALIAS)
-        resized_b = B.resize((280, 280), Image.ANTIALIAS)
-        resized_c = C.resize((280, 280), Image.ANTIALIAS)
+        resized_a = load_resized(self.A_paths[index], (280, 280))
+        resized_b = load_resized(self.B_paths[index], (280, 280))
+        resized_c = load_resized(self.C_paths[index], (280, 280))
         # crop the training image into fineSize
         w, h = resized_a.size
         x, y = randrange(w - self.fineSize + 1), randrange(h - self.fineSize + 1)
@@ -112,20 +108,16 @@ class TrainUnlabeled(data.Dataset):
         self.dir_C = os.path.join(self.root, self.phase + '/LA')
         self.dir_D = os.path.join(self.root, self.phase + '/candidate')
 
-        # image path
-        self.A_paths = sorted(make_dataset(self.dir_A))
-        self.C_paths = sorted(make_dataset(self.dir_C))
-        self.D_paths = sorted(make_dataset(self.dir_D))
+        # image paths, paired by file stem and indexed in a manifest, see manifest.py
+        self.A_paths, self.C_paths, self.D_paths = load_pairs(os.path.join(self.root, self.phase), ('input', 'LA', 'candidate'))
 
         # transform
         self.transform = ToTensor()  # [0,1]
 
     def __getitem__(self, index):
-        A = Image.open(self.A_paths[index]).convert("RGB")
-        C = Image.open(self.C_paths[index]).convert("RGB")
+        A = load_resized(self.A_paths[index], (self.fineSize, self.fineSize))
+        C = load_resized(self.C_paths[index], (self.fineSize, self.fineSize))
         candidate = Image.open(self.D_paths[index]).convert('RGB')
-        A = A.resize((self.fineSize, self.fineSize), Image.ANTIALIAS)
-        C = C.resize((self.fineSize, self.fineSize), Image.ANTIALIAS)
         # strong augmentation
         strong_data = data_aug(A)
         tensor_w = self.transform(A)
@@ -151,22 +143,18 @@ class ValLabeled(data.Dataset):
         self.dir_B = os.path.join(self.root, self.phase + '/GT')
         self.dir_C = os.path.join(self.root, self.phase + '/LA')
 
-        # image path
-        self.A_paths = sorted(make_dataset(self.dir_A))
-        self.B_paths = sorted(make_dataset(self.dir_B))
-        self.C_paths = sorted(make_dataset(self.dir_C))
+        # image paths, paired by file stem and indexed in a manifest, see manifest.py
+        self.A_paths, self.B_paths, self.C_paths = load_pairs(os.path.join(self.root, self.phase), ('input', 'GT', 'LA'))
 
         # transform
         self.transform = ToTensor()  # [0,1]
 
     def __getitem__(self, index):
         # A, B is the image pair, hazy, gt respectively
-        A = Image.open(self.A_paths[index]).convert("RGB")
-        B = Image.open(self.B_paths[index]).convert("RGB")
-        C = Image.open(self.C_paths[index]).convert("RGB")
-        resized_a = A.resize((self.fineSize, self.fineSize), Image.ANTIALIAS)
-        resized_b = B.resize((self.fineSize, self.fineSize), Image.ANTIALIAS)
-        resized_c = C.resize((self.fineSize, self.fineSize), Image.ANTIALIAS)
+        # full JPEG decode, validation PSNR stays comparable with runs before the draft decode
+        resized_a = load_resized(self.A_paths[index], (self.fineSize, self.fineSize), margin=0)
+        resized_b = load_resized(self.B_paths[index], (self.fineSize, self.fineSize), margin=0)
+        resized_c = load_resized(self.C_paths[index], (self.fineSize, self.fineSize), margin=0)
         # transform to (0, 1)
         tensor_a = self.transform(resized_a)
         tensor_b = self.transform(resized_b)
@@ -186,9 +174,8 @@ class TestData(data.Dataset):
         self.dir_A = os.path.join(self.root + '/input')
         self.dir_C = os.path.join(self.root + '/LA')
 
-        # image path
-        self.A_paths = sorted(make_dataset(self.dir_A))
-        self.C_paths = sorted(make_dataset(self.dir_C))
+        # image paths, paired by file stem and indexed in a manifest, see manifest.py
+        self.A_paths, self.C_paths = load_pairs(self.root, ('input', 'LA'))
 
         # transform
         self.transform = ToTensor()  # [0,1]
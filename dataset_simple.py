@@ -2,6 +2,8 @@ import os.path
 import torch
 import torch.utils.data as data
 from PIL import Image
+from image_io import load_resized
+from manifest import load_pairs
 import random
 from random import randrange
 from torchvision.transforms import ToTensor
@@ -64,20 +66,16 @@ class TrainLabeled(data.Dataset):
         self.dir_A = os.path.join(self.root, self.phase + '/input')
         self.dir_B = os.path.join(self.root, self.phase + '/GT')
 
-        # image path
-        self.A_paths = sorted(make_dataset(self.dir_A))
-        self.B_paths = sorted(make_dataset(self.dir_B))
+        # image paths, paired by file stem and indexed in a manifest, see manifest.py
+        self.A_paths, self.B_paths = load_pairs(os.path.join(self.root, self.phase), ('input', 'GT'))
 
         # transform
         self.transform = ToTensor()  # [0,1]
 
     def __getitem__(self, index):
         # A, B is the image pair, hazy, gt respectively
-        A = Image.open(self.A_paths[index]).convert("RGB")
-        B = Image.open(self.B_paths[index]).convert("RGB")
-        # resize
-        resized_a = A.resize((280, 280), Image.ANTIALIAS)
-        resized_b = B.resize((280, 280), Image.ANTIALIAS)
+        resized_a = load_resized(self.A_paths[index], (280, 280))
+        resized_b = load_resized(self.B_paths[index], (280, 280))
         # crop the training image into fineSize
         w, h = resized_a.size
         x, y = randrange(w - self.fineSize + 1), randrange(h - self.fineSize + 1)
@@ -107,8 +105,8 @@ class TrainUnlabeled(data.Dataset):
         self.dir_A = os.path.join(self.root, self.phase + '/input')
 
 
-        # image path
-        self.A_paths = sorted(make_dataset(self.dir_A))
+        # image paths, indexed in a manifest, see manifest.py
+        self.A_paths = load_pairs(os.path.join(self.root, self.phase), ('input',))[0]
 
 
         # transform
@@ -116,9 +114,8 @@ class TrainUnlabeled(data.Dataset):
         self.night_aug = NightAug()
 
     def __getitem__(self, index):
-        A = Image.open(self.A_paths[index]).convert("RGB")
+        A = load_resized(self.A_paths[index], (self.fineSize, self.fineSize))
 
-        A = A.resize((self.fineSize, self.fineSize), Image.ANTIALIAS)
         # strong augmentation
         #strong_data = data_aug(A)
         strong_data = self.night_aug.aug(self.transform(A.copy()))
@@ -142,17 +139,15 @@ class TrainUnlabeledWithBank(data.Dataset):
         self.dir_A = os.path.join(self.root, self.phase + '/input')
         self.dir_D = os.path.join(self.root, self.phase + '/candidate')
 
-        # image path
-        self.A_paths = sorted(make_dataset(self.dir_A))
-        self.D_paths = sorted(make_dataset(self.dir_D))
+        # image paths, paired by file stem and indexed in a manifest, see manifest.py
+        self.A_paths, self.D_paths = load_pairs(os.path.join(self.root, self.phase), ('input', 'candidate'))
 
         # transform
         self.transform = ToTensor()  # [0,1]
 
     def __getitem__(self, index):
-        A = Image.open(self.A_paths[index]).convert("RGB")
+        A = load_resized(self.A_paths[index], (self.fineSize, self.fineSize))
         candidate = Image.open(self.D_paths[index]).convert('RGB')
-        A = A.resize((self.fineSize, self.fineSize), Image.ANTIALIAS)
 
         # strong augmentation
         strong_data = data_aug(A)
@@ -177,17 +172,16 @@ class TrainUnlabeledOrignAug(data.Dataset):
         self.dir_A = os.path.join(self.root, self.phase + '/input')
 
 
-        # image path
-        self.A_paths = sorted(make_dataset(self.dir_A))
+        # image paths, indexed in a manifest, see manifest.py
+        self.A_paths = load_pairs(os.path.join(self.root, self.phase), ('input',))[0]
 
 
         # transform
         self.transform = ToTensor()  # [0,1]
 
     def __getitem__(self, index):
-        A = Image.open(self.A_paths[index]).convert("RGB")
+        A = load_resized(self.A_paths[index], (self.fineSize, self.fineSize))
 
-        A = A.resize((self.fineSize, self.fineSize), Image.ANTIALIAS)
         # strong augmentation
         strong_data = data_aug(A)
 
@@ -210,17 +204,16 @@ class TrainUnlabeledOrignAugBaseline(data.Dataset):
         self.dir_A = os.path.join(self.root, self.phase + '/input')
 
 
-        # image path
-        self.A_paths = sorted(make_dataset(self.dir_A))
+        # image paths, indexed in a manifest, see manifest.py
+        self.A_paths = load_pairs(os.path.join(self.root, self.phase), ('input',))[0]
 
 
         # transform
         self.transform = ToTensor()  # [0,1]
 
     def __getitem__(self, index):
-        A = Image.open(self.A_paths[index]).convert("RGB")
+        A = load_resized(self.A_paths[index], (self.fineSize, self.fineSize))
 
-        A = A.resize((self.fineSize, self.fineSize), Image.ANTIALIAS)
         # strong augmentation
         #strong_data = data_aug(A)
         strong_data = A
@@ -243,17 +236,16 @@ class TrainUnlabeledOrignAugwograyscale(data.Dataset):
         self.dir_A = os.path.join(self.root, self.phase + '/input')
 
 
-        # image path
-        self.A_paths = sorted(make_dataset(self.dir_A))
+        # image paths, indexed in a manifest, see manifest.py
+        self.A_paths = load_pairs(os.path.join(self.root, self.phase), ('input',))[0]
 
 
         # transform
         self.transform = ToTensor()  # [0,1]
 
     def __getitem__(self, index):
-        A = Image.open(self.A_paths[index]).convert("RGB")
+        A = load_resized(self.A_paths[index], (self.fineSize, self.fineSize))
 
-        A = A.resize((self.fineSize, self.fineSize), Image.ANTIALIAS)
         # strong augmentation
         strong_data = data_aug_wo_grayscale(A)
 
@@ -275,17 +267,16 @@ class TrainUnlabeledOrignAugwocolorjitt(data.Dataset):
         self.dir_A = os.path.join(self.root, self.phase + '/input')
 
 
-        # image path
-        self.A_paths = sorted(make_dataset(self.dir_A))
+        # image paths, indexed in a manifest, see manifest.py
+        self.A_paths = load_pairs(os.path.join(self.root, self.phase), ('input',))[0]
 
 
         # transform
         self.transform = ToTensor()  # [0,1]
 
     def __getitem__(self, index):
-        A = Image.open(self.A_paths[index]).convert("RGB")
+        A = load_resized(self.A_paths[index], (self.fineSize, self.fineSize))
 
-        A = A.resize((self.fineSize, self.fineSize), Image.ANTIALIAS)
         # strong augmentation
         strong_data = data_aug_wo_grayscale(A)
 
@@ -307,17 +298,16 @@ class TrainUnlabeledOrignAugwoblur(data.Dataset):
         self.dir_A = os.path.join(self.root, self.phase + '/input')
 
 
-        # image path
-        self.A_paths = sorted(make_dataset(self.dir_A))
+        # image paths, indexed in a manifest, see manifest.py
+        self.A_paths = load_pairs(os.path.join(self.root, self.phase), ('input',))[0]
 
 
         # transform
         self.transform = ToTensor()  # [0,1]
 
     def __getitem__(self, index):
-        A = Image.open(self.A_paths[index]).convert("RGB")
+        A = load_resized(self.A_paths[index], (self.fineSize, self.fineSize))
 
-        A = A.resize((self.fineSize, self.fineSize), Image.ANTIALIAS)
         # strong augmentation
         strong_data = data_aug_wo_grayscale(A)
 
@@ -339,19 +329,17 @@ class ValLabeled(data.Dataset):
         self.dir_A = os.path.join(self.root, self.phase + '/input')
         self.dir_B = os.path.join(self.root, self.phase + '/GT')
 
-        # image path
-        self.A_paths = sorted(make_dataset(self.dir_A))
-        self.B_paths = sorted(make_dataset(self.dir_B))
+        # image paths, paired by file stem and indexed in a manifest, see manifest.py
+        self.A_paths, self.B_paths = load_pairs(os.path.join(self.root, self.phase), ('input', 'GT'))
 
         # transform
         self.transform = ToTensor()  # [0,1]
 
     def __getitem__(self, index):
         # A, B is the image pair, hazy, gt respectively
-        A = Image.open(self.A_paths[index]).convert("RGB")
-        B = Image.open(self.B_paths[index]).convert("RGB")
-        resized_a = A.resize((self.fineSize, self.fineSize), Image.ANTIALIAS)
-        resized_b = B.resize((self.fineSize, self.fineSize), Image.ANTIALIAS)
+        # full JPEG decode, validation PSNR stays comparable with runs before the draft decode
+        resized_a = load_resized(self.A_paths[index], (self.fineSize, self.fineSize), margin=0)
+        resized_b = load_resized(self.B_paths[index], (self.fineSize, self.fineSize), margin=0)
         # transform to (0, 1)
         tensor_a = self.transform(resized_a)
         tensor_b = self.transform(resized_b)
@@ -369,8 +357,8 @@ class TestData(data.Dataset):
 
         self.dir_A = os.path.join(self.root + '/input')
 
-        # image path
-        self.A_paths = sorted(make_dataset(self.dir_A))
+        # image paths, indexed in a manifest, see manifest.py
+        self.A_paths = load_pairs(self.root, ('input',))[0]
 
         # transform
         self.transform = ToTensor()  # [0,1]
@@ -461,8 +449,8 @@ class TrainUnlabeledwithNoise(data.Dataset):
         self.dir_A = os.path.join(self.root, self.phase + '/input')
 
 
-        # image path
-        self.A_paths = sorted(make_dataset(self.dir_A))
+        # image paths, indexed in a manifest, see manifest.py
+        self.A_paths = load_pairs(os.path.join(self.root, self.phase), ('input',))[0]
 
 
         # transform
@@ -470,9 +458,8 @@ class TrainUnlabeledwithNoise(data.Dataset):
         self.add_noise = AddGaussianNoise(mean=0.0, std=1.0, level=5)
 
     def __getitem__(self, index):
-        A = Image.open(self.A_paths[index]).convert("RGB")
+        A = load_resized(self.A_paths[index], (self.fineSize, self.fineSize))
 
-        A = A.resize((self.fineSize, self.fineSize), Image.ANTIALIAS)
         # strong augmentation
         strong_data = data_aug(A)
 
@@ -0,0 +1,94 @@
+import json
+import uuid
+import base64
+import socket
+import http.client
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class EnhanceClient():
+    """
+    Client of serve.py, standard library only so other pipelines can import it without torch.
+    Images go in and come out as encoded bytes (PNG, JPEG, ...), the results are PNG.
+    One connection per call, so a client can be shared between threads.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8080, socket_path=None, timeout=60.0):
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def _connection(self):
+        if self.socket_path is not None:
+            return _UnixConnection(self.socket_path, self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _request(self, method, path, body=None, content_type='application/octet-stream'):
+        conn = self._connection()
+        conn.request(method, path, body, {'Content-Type': content_type} if body is not None else {})
+        response = conn.getresponse()
+        data = response.read()
+        conn.close()
+        if response.status != 200:
+            raise RuntimeError('%s %s: %d %s' % (method, path, response.status, data.decode(errors='replace')))
+        return data
+
+    def health(self):
+        return json.loads(self._request('GET', '/health'))
+
+    def metrics(self):
+        return json.loads(self._request('GET', '/metrics'))
+
+    def enhance(self, image, la=None):
+        """
+        :param image: encoded image bytes
+        :param la: encoded illumination map for AIMnet, sent with the image as multipart/form-data
+        :return: PNG bytes of the enhanced image
+        """
+        if la is None:
+            return self._request('POST', '/enhance', image)
+        boundary = uuid.uuid4().hex
+        body = b''.join(b'--%s\r\nContent-Disposition: form-data; name="%s"\r\n'
+                        b'Content-Type: application/octet-stream\r\n\r\n%s\r\n' % (boundary.encode(), name, data)
+                        for name, data in ((b'image', image), (b'la', la)))
+        body += b'--%s--\r\n' % boundary.encode()
+        return self._request('POST', '/enhance', body, 'multipart/form-data; boundary=%s' % boundary)
+
+    def enhance_stream(self, images, las=None, ids=None):
+        """
+        Sends all images in one request, yields {'id', 'image': PNG bytes} (or {'id', 'error'}) as the
+        server finishes them, in completion order.
+        :param las: encoded illumination maps for AIMnet, None otherwise
+        :param ids: ids of the images, their positions by default
+        """
+        ids = range(len(images)) if ids is None else ids
+        las = [None] * len(images) if las is None else las
+        body = b''.join((json.dumps({'id': id, 'image': base64.b64encode(image).decode(),
+                                     'la': base64.b64encode(la).decode() if la is not None else None}) + '\n').encode()
+                        for id, image, la in zip(ids, images, las))
+        conn = self._connection()
+        conn.request('POST', '/enhance_stream', body, {'Content-Type': 'application/x-ndjson'})
+        response = conn.getresponse()
+        if response.status != 200:
+            raise RuntimeError('POST /enhance_stream: %d %s' % (response.status, response.read().decode(errors='replace')))
+        try:
+            # http.client undoes the chunked encoding, one json line per result
+            for line in response:
+                result = json.loads(line)
+                if 'image' in result:
+                    result['image'] = base64.b64decode(result['image'])
+                yield result
+        finally:
+            conn.close()
@@ -0,0 +1,130 @@
+import argparse
+import torch
+import torch.nn as nn
+from export_model import load_inference
+from attention import set_rotation_seed
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+# AIMnet additionally takes the LA illumination map
+GRAPH_MODELS = {'RetinexFormer': False, 'RetinexFormerWithGrad': False, 'AIMnet': True}
+
+
+class GraphWrapper(nn.Module):
+    """ Fixed positional signature (x[, la]) -> tuple of outputs for tracing """
+
+    def __init__(self, model, with_la):
+        super(GraphWrapper, self).__init__()
+        self.model = model
+        self.with_la = with_la
+
+    def forward(self, x, la=None):
+        out = self.model(x, la) if self.with_la else self.model(x)
+        if not isinstance(out, (tuple, list)):
+            out = (out,)
+        return tuple(out)
+
+
+def example_inputs(with_la, height=256, width=256, batch=1):
+    x = torch.rand(batch, 3, height, width)
+    return (x, torch.rand_like(x)) if with_la else (x,)
+
+
+def freeze_for_export(model, with_la, height, width, rotation_seed=0):
+    """
+    Seed the LSH rotations of AIMnet's NonLocalSparseAttention and draw them once at the trace size,
+    so the graph holds them as constants instead of a random op that ONNX Runtime would redraw on every run.
+    The model stays seeded, check_parity compares against the same rotations.
+    """
+    set_rotation_seed(model, rotation_seed)
+    wrapper = GraphWrapper(model, with_la).eval()
+    with torch.no_grad():
+        wrapper(*example_inputs(with_la, height, width))
+    return wrapper
+
+
+def export_torchscript(model, with_la, path, height=256, width=256, rotation_seed=0):
+    wrapper = freeze_for_export(model, with_la, height, width, rotation_seed)
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapper, example_inputs(with_la, height, width), check_trace=False)
+    traced.save(path)
+    return traced
+
+
+def export_onnx(model, with_la, path, height=256, width=256, opset=13, rotation_seed=0):
+    wrapper = freeze_for_export(model, with_la, height, width, rotation_seed)
+    input_names = ['input', 'la'] if with_la else ['input']
+    with torch.no_grad():
+        n_out = len(wrapper(*example_inputs(with_la, 16, 16)))
+    output_names = ['output'] + ['grad'] * (n_out > 1)
+    dynamic_axes = {name: {0: 'batch', 2: 'height', 3: 'width'} for name in input_names + output_names}
+    with torch.no_grad():
+        torch.onnx.export(wrapper, example_inputs(with_la, height, width), path, opset_version=opset,
+                          input_names=input_names, output_names=output_names, dynamic_axes=dynamic_axes)
+
+
+def check_parity(model, with_la, run_exported, sizes, atol=1e-4):
+    """
+    Compare eager and exported outputs at sizes other than the traced one.
+    :param run_exported: callable(*inputs) -> tuple of tensors
+    :return: list of (h, w, max abs difference)
+    """
+    wrapper = GraphWrapper(model, with_la).eval()
+    report = []
+    for h, w in sizes:
+        inputs = example_inputs(with_la, h, w)
+        with torch.no_grad():
+            ref = wrapper(*inputs)
+            out = run_exported(*inputs)
+        diff = max((a - b).abs().max().item() for a, b in zip(ref, out))
+        report.append((h, w, diff))
+        if diff > atol:
+            raise AssertionError('exported graph differs from eager at %dx%d: %.3e > %.1e' % (h, w, diff, atol))
+    return report
+
+
+def onnx_runner(path):
+    if onnxruntime is None:
+        raise ImportError('onnxruntime is needed to check ONNX exports')
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    names = [i.name for i in session.get_inputs()]
+
+    def run(*inputs):
+        outs = session.run(None, {n: t.numpy() for n, t in zip(names, inputs)})
+        return tuple(torch.from_numpy(o) for o in outs)
+    return run
+
+
+def parse_sizes(text):
+    return [tuple(int(v) for v in s.split('x')) for s in text.split(',') if s]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export TorchScript / ONNX graphs with dynamic H/W')
+    parser.add_argument('--weights', required=True, type=str, help='exported .pth or training checkpoint')
+    parser.add_argument('--model', default=None, type=str, choices=sorted(GRAPH_MODELS))
+    parser.add_argument('--format', default='onnx', type=str, choices=['torchscript', 'onnx'])
+    parser.add_argument('--out', required=True, type=str)
+    parser.add_argument('--height', default=256, type=int, help='trace height, a multiple of 16')
+    parser.add_argument('--width', default=256, type=int, help='trace width, a multiple of 16')
+    parser.add_argument('--opset', default=13, type=int)
+    parser.add_argument('--check', default='256x256,384x512', type=str, help='HxW sizes for the parity check')
+    parser.add_argument('--atol', default=1e-4, type=float)
+    parser.add_argument('--rotation_seed', default=0, type=int, help="seed of AIMnet's LSH rotations in the graph")
+
+    args = parser.parse_args()
+    model = load_inference(args.weights, model_name=args.model)
+    model_name = args.model or type(model).__name__
+    with_la = GRAPH_MODELS[model_name]
+    if args.format == 'torchscript':
+        traced = export_torchscript(model, with_la, args.out, args.height, args.width, args.rotation_seed)
+        run_exported = traced
+    else:
+        export_onnx(model, with_la, args.out, args.height, args.width, args.opset, args.rotation_seed)
+        run_exported = onnx_runner(args.out)
+    print('exported %s to %s' % (model_name, args.out))
+    for h, w, diff in check_parity(model, with_la, run_exported, parse_sizes(args.check), args.atol):
+        print('parity %dx%d: max abs diff %.3e' % (h, w, diff))
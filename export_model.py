@@ -0,0 +1,97 @@
+import os
+import json
+import argparse
+import torch
+from checkpoint import load_checkpoint
+from registry import MODEL_MODULES, build
+
+INFERENCE_FORMAT = 'semi_llie_inference_v1'
+DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def strip_prefix(state_dict, prefix='module.'):
+    """ Drop the nn.DataParallel prefix from state_dict keys """
+    return {(k[len(prefix):] if k.startswith(prefix) else k): v for k, v in state_dict.items()}
+
+
+def build_model(name, config=None):
+    return build('model', name, **(config or {}))
+
+
+def export_inference(checkpoint_path, out_path, model_name, weights='student', dtype='fp32', config=None):
+    """
+    :param checkpoint_path: training checkpoint (directory or legacy .pth)
+    :param weights: 'student' or 'teacher' (EMA), legacy checkpoints only hold the student
+    :param dtype: 'fp32' | 'fp16' | 'bf16', floating point tensors are cast on export
+    :return: metadata stored next to the weights
+    """
+    checkpoint = load_checkpoint(checkpoint_path)
+    if weights == 'teacher':
+        if 'teacher' not in checkpoint:
+            raise KeyError('%s holds no teacher weights' % checkpoint_path)
+        state_dict = checkpoint['teacher']
+    else:
+        state_dict = checkpoint['state_dict']
+    state_dict = strip_prefix(state_dict)
+    state_dict = {k: v.to(DTYPES[dtype]) if v.is_floating_point() else v for k, v in state_dict.items()}
+
+    meta = {'format': INFERENCE_FORMAT,
+            'model': model_name,
+            'config': config or {},
+            'weights': weights,
+            'dtype': dtype,
+            'epoch': checkpoint.get('epoch'),
+            'source': os.path.abspath(checkpoint_path)}
+    torch.save({'meta': meta, 'state_dict': state_dict}, out_path)
+    return meta
+
+
+def load_inference(path, model_name=None, config=None, weights='student', device='cpu', dtype=None):
+    """
+    Build a model ready for eval from an exported artifact or a training checkpoint,
+    without DataParallel or an optimizer.
+    :param model_name/config: required for training checkpoints, taken from the metadata of exported artifacts,
+        where a model_name other than the exported one raises ValueError
+    :param dtype: None keeps fp32 compute, 'fp16'/'bf16' casts the model after loading
+    """
+    if os.path.isdir(path):
+        checkpoint = load_checkpoint(path)
+    else:
+        checkpoint = torch.load(path, map_location='cpu')
+    if checkpoint.get('meta', {}).get('format') == INFERENCE_FORMAT:
+        meta = checkpoint['meta']
+        # the weights fix the architecture, model_name can only confirm it
+        if model_name is not None and model_name != meta['model']:
+            raise ValueError('%s was exported from %s, not %s' % (path, meta['model'], model_name))
+        model_name = meta['model']
+        config = meta['config'] if config is None else config
+        state_dict = checkpoint['state_dict']
+    else:
+        if model_name is None:
+            raise ValueError('model_name is required to load a training checkpoint')
+        state_dict = checkpoint['teacher'] if weights == 'teacher' else checkpoint['state_dict']
+        state_dict = strip_prefix(state_dict)
+
+    model = build_model(model_name, config)
+    # load_state_dict copies into the fp32 parameters, so half exports also run on CPU
+    model.load_state_dict(state_dict)
+    model = model.to(device)
+    if dtype is not None:
+        model = model.to(DTYPES[dtype])
+    model.eval()
+    return model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export an inference-only model')
+    parser.add_argument('--checkpoint', required=True, type=str, help='training checkpoint dir or .pth')
+    parser.add_argument('--out', required=True, type=str, help='output .pth path')
+    parser.add_argument('--model', default='RetinexFormer', type=str, choices=sorted(MODEL_MODULES))
+    parser.add_argument('--config', default='{}', type=str, help='model constructor kwargs as json')
+    parser.add_argument('--weights', default='student', type=str, choices=['student', 'teacher'])
+    parser.add_argument('--dtype', default='fp32', type=str, choices=sorted(DTYPES))
+
+    args = parser.parse_args()
+    meta = export_inference(args.checkpoint, args.out, args.model, weights=args.weights,
+                            dtype=args.dtype, config=json.loads(args.config))
+    print('exported %s (%s weights, %s) to %s' % (meta['model'], meta['weights'], meta['dtype'], args.out))
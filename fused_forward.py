@@ -0,0 +1,65 @@
+import torch
+import torch.nn as nn
+
+
+class BranchBatchNorm2d(nn.BatchNorm2d):
+    """
+    BatchNorm2d that, while `branches` > 1 in training, normalizes that many equal slices of the
+    batch on their own, so a fused labeled + unlabeled forward sees the same batch statistics and
+    running-stat updates as two separate forwards. State dict keys are those of nn.BatchNorm2d.
+    """
+    branches = 1
+
+    def forward(self, x):
+        if self.branches == 1 or not self.training:
+            return super(BranchBatchNorm2d, self).forward(x)
+        return torch.cat([super(BranchBatchNorm2d, self).forward(part) for part in x.chunk(self.branches)], 0)
+
+
+def convert_branch_norm(model):
+    """ Turn the BatchNorm2d layers of `model` into BranchBatchNorm2d in place, :return: the converted layers """
+    norms = []
+    for module in model.modules():
+        if type(module) is nn.BatchNorm2d:
+            module.__class__ = BranchBatchNorm2d
+        if isinstance(module, BranchBatchNorm2d):
+            norms.append(module)
+    return norms
+
+
+def _split(out, n, devices):
+    if isinstance(out, (tuple, list)):
+        parts = [_split(o, n, devices) for o in out]
+        return tuple(p[0] for p in parts), tuple(p[1] for p in parts)
+    if devices == 1:
+        return out[:n], out[n:]
+    pieces = out.chunk(2 * devices)
+    return torch.cat(pieces[0::2], 0), torch.cat(pieces[1::2], 0)
+
+
+def fused_forward(model, labeled, unlabeled, norms=(), devices=1):
+    """
+    model(labeled), model(unlabeled) computed by one forward over the concatenated batch.
+    Tuple outputs (the gradient branch of the *WithGrad models) are split element-wise.
+    :param norms: BranchBatchNorm2d layers of the model, normalized per branch during the forward
+    :param devices: number of DataParallel devices; with norms, every device gets an equal slice of
+        both batches, so the per-branch split also holds on each replica
+    """
+    n = labeled.shape[0]
+    if not norms:
+        return _split(model(torch.cat([labeled, unlabeled], 0)), n, 1)
+    if unlabeled.shape[0] != n or n % devices:
+        # the branches must be equal slices, e.g. not for a short last unlabeled batch
+        return model(labeled), model(unlabeled)
+    if devices == 1:
+        x = torch.cat([labeled, unlabeled], 0)
+    else:
+        x = torch.cat([t for pair in zip(labeled.chunk(devices), unlabeled.chunk(devices)) for t in pair], 0)
+    for norm in norms:
+        norm.branches = 2
+    try:
+        out = model(x)
+    finally:
+        for norm in norms:
+            norm.branches = 1
+    return _split(out, n, devices)
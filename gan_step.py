@@ -0,0 +1,201 @@
+import torch
+
+
+def gradient_penalty(netD, real, fake=None, mode='gp'):
+    """
+    'r1': 0.5 * E||∇D(real)||², pushes D to be flat on the real data
+    'gp': E(||∇D(x̂)|| - 1)² on random interpolates x̂ of real and fake, the WGAN-GP penalty
+    Computed in fp32 with create_graph, so backward reaches the D weights.
+    """
+    real = real.detach().float()
+    if mode == 'r1':
+        x = real.requires_grad_(True)
+    elif mode == 'gp':
+        eps = torch.rand(real.shape[0], 1, 1, 1, device=real.device)
+        x = (eps * real + (1 - eps) * fake.detach().float()).requires_grad_(True)
+    else:
+        raise NotImplementedError('regularization %s not implemented' % mode)
+    pred = netD(x)
+    grad, = torch.autograd.grad(pred.sum(), x, create_graph=True)
+    grad = grad.flatten(1)
+    if mode == 'r1':
+        return 0.5 * grad.pow(2).sum(1).mean()
+    return (grad.norm(2, dim=1) - 1).pow(2).mean()
+
+
+class GANStep():
+    """
+    Discriminator update and adversarial generator loss of one training iteration.
+    The D forward on the fake batch is shared: it gives the generator loss and, through gradients
+    taken w.r.t. the D weights only, the D loss, so D runs once on the fake batch and the
+    requires_grad flags are never toggled. Usage per iteration:
+        loss_G = gan.generator_loss(fake, real)
+        (other_losses + loss_G).backward(inputs=generator_params)
+        optimizer_G.step()
+        gan.step_discriminator()
+    This changes the update order of the previous trainers, which stepped D first: the generator loss now
+    sees the discriminator before this iteration's D update.
+    :param d_every: update D on every d_every-th iteration only
+    :param d_steps: D updates per D iteration, the ones after the first run extra forwards on the same batch
+    :param reg: 'r1', 'gp' or 'none'
+    :param reg_every: lazy regularization, the penalty is added on every reg_every-th D update
+        with its weight multiplied by reg_every
+    :param amp: run the D-only forwards (real batch, extra d_steps) under autocast, with a GradScaler on the D loss.
+        The shared forward on the fake batch stays fp32, its generator loss is backpropagated without a scaler
+    """
+
+    def __init__(self, netD, criterion, optimizer, d_every=1, d_steps=1, reg='none', reg_every=4, reg_weight=10.0,
+                 amp=False):
+        self.netD = netD
+        self.criterion = criterion
+        self.optimizer = optimizer
+        self.d_every = max(1, d_every)
+        self.d_steps = max(1, d_steps)
+        self.reg = reg
+        self.reg_every = max(1, reg_every)
+        self.reg_weight = reg_weight
+        self.amp = amp
+        self.scaler = torch.cuda.amp.GradScaler(enabled=amp and torch.cuda.is_available())
+        self.params = [p for p in netD.parameters() if p.requires_grad]
+        self.iteration = 0
+        self.d_updates = 0
+        self.loss_D = None
+        self.penalty = None
+        self._grads = None
+        self._batch = None
+
+    def _autocast(self, x):
+        return torch.autocast(device_type=x.device.type, enabled=self.amp)
+
+    def _d_loss(self, pred_fake, real, fake):
+        with self._autocast(real):
+            pred_real = self.netD(real)
+        loss = (self.criterion(pred_fake.float(), False) + self.criterion(pred_real.float(), True)) * 0.5
+        self.loss_D = loss.detach()
+        if self.reg != 'none' and self.d_updates % self.reg_every == 0:
+            penalty = gradient_penalty(self.netD, real, fake, self.reg)
+            self.penalty = penalty.detach()
+            loss = loss + self.reg_weight * self.reg_every * penalty
+        self.d_updates += 1
+        return loss
+
+    def generator_loss(self, fake, real):
+        """ :return: adversarial loss of `fake`, the D gradients of this iteration are taken alongside """
+        self.iteration += 1
+        # fp32 even with amp, loss_G reaches the generator through D and is backpropagated unscaled
+        pred_fake = self.netD(fake)
+        loss_G = self.criterion(pred_fake.float(), True)
+        if self.iteration % self.d_every == 0:
+            loss_D = self._d_loss(pred_fake, real, fake)
+            # D weights only, the fake branch of the graph is kept for the generator backward
+            self._grads = torch.autograd.grad(self.scaler.scale(loss_D), self.params, retain_graph=True,
+                                              allow_unused=True)
+            self._batch = (fake.detach(), real.detach())
+        return loss_G
+
+    def step_discriminator(self):
+        """ Apply the D update of this iteration, after the generator backward has used the D weights """
+        if self._grads is None:
+            return
+        for param, grad in zip(self.params, self._grads):
+            param.grad = grad
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self._grads = None
+        fake, real = self._batch
+        self._batch = None
+        for _ in range(self.d_steps - 1):
+            self.optimizer.zero_grad(set_to_none=True)
+            with self._autocast(fake):
+                pred_fake = self.netD(fake)
+            self.scaler.scale(self._d_loss(pred_fake, real, fake)).backward()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+        self.optimizer.zero_grad(set_to_none=True)
+
+    def state_dict(self):
+        return {'iteration': self.iteration, 'd_updates': self.d_updates, 'scaler': self.scaler.state_dict()}
+
+    def load_state_dict(self, state):
+        self.iteration = state['iteration']
+        self.d_updates = state['d_updates']
+        # empty when saved without amp, a resume with --gan_amp starts a fresh scale
+        if state['scaler']:
+            self.scaler.load_state_dict(state['scaler'])
+
+
+if __name__ == '__main__':
+    # step time of the generator + discriminator update, the previous trainer_with_gan loop against GANStep
+    import time
+    import argparse
+    import torch.nn as nn
+    from trainer_with_gan import define_D, GANLoss
+
+    parser = argparse.ArgumentParser(description='GAN step benchmark on random data')
+    parser.add_argument('--batch_size', default=2, type=int)
+    parser.add_argument('--crop_size', default=128, type=int)
+    parser.add_argument('--steps', default=10, type=int)
+    parser.add_argument('--d_every', default=1, type=int)
+    parser.add_argument('--reg', default='gp', type=str)
+    parser.add_argument('--reg_every', default=4, type=int)
+    parser.add_argument('--amp', action='store_true')
+    args = parser.parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+
+    def generator():
+        return nn.Sequential(nn.Conv2d(3, 32, 3, padding=1), nn.ReLU(), nn.Conv2d(32, 32, 3, padding=1), nn.ReLU(),
+                             nn.Conv2d(32, 3, 3, padding=1)).to(device)
+
+    x = torch.rand(args.batch_size, 3, args.crop_size, args.crop_size, device=device)
+    y = torch.rand_like(x)
+    criterion = GANLoss('wgangp').to(device)
+
+    def legacy():
+        netG, netD = generator(), define_D(3, 64, 'basic').to(device)
+        opt_G, opt_D = torch.optim.Adam(netG.parameters()), torch.optim.Adam(netD.parameters())
+
+        def step():
+            fake = netG(x)
+            loss = (fake - y).abs().mean()
+            for p in netD.parameters():
+                p.requires_grad = True
+            opt_D.zero_grad()
+            loss_D = (criterion(netD(fake.detach()), False) + criterion(netD(y), True)) * 0.5
+            loss_D.backward()
+            opt_D.step()
+            for p in netD.parameters():
+                p.requires_grad = False
+            opt_G.zero_grad()
+            (loss + criterion(netD(fake), True)).backward()
+            opt_G.step()
+        return step
+
+    def shared():
+        netG, netD = generator(), define_D(3, 64, 'basic').to(device)
+        opt_G, opt_D = torch.optim.Adam(netG.parameters()), torch.optim.Adam(netD.parameters())
+        gan = GANStep(netD, criterion, opt_D, d_every=args.d_every, reg=args.reg, reg_every=args.reg_every,
+                      amp=args.amp)
+        params = list(netG.parameters())
+
+        def step():
+            fake = netG(x)
+            loss = (fake - y).abs().mean()
+            opt_G.zero_grad()
+            (loss + gan.generator_loss(fake, y)).backward(inputs=params)
+            opt_G.step()
+            gan.step_discriminator()
+        return step
+
+    for name, build in (('legacy (no penalty)', legacy), ('GANStep', shared)):
+        step = build()
+        for _ in range(2):
+            step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        print('%-20s %8.2f ms/step' % (name, (time.perf_counter() - start) * 1000 / args.steps))
@@ -0,0 +1,114 @@
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class GradientMagnitude(torch.autograd.Function):
+    """
+    sqrt(g_v^2 + g_h^2 + eps) keeping only the input and the output for backward,
+    the finite differences are recomputed instead of being stored.
+    """
+
+    @staticmethod
+    def forward(ctx, x, weight, eps):
+        g = F.conv2d(x, weight, padding=1, groups=x.shape[1])
+        out = _magnitude(g, eps)
+        ctx.save_for_backward(x, weight, out)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        x, weight, out = ctx.saved_tensors
+        B, C, H, W = x.shape
+        g = F.conv2d(x, weight, padding=1, groups=C).view(B, C, 2, H, W)
+        grad_g = g * (grad_out / out).unsqueeze(2)
+        grad_x = F.conv_transpose2d(grad_g.view(B, 2 * C, H, W), weight, padding=1, groups=C)
+        return grad_x, None, None
+
+
+def _magnitude(g, eps):
+    B, C2, H, W = g.shape
+    g = g.view(B, C2 // 2, 2, H, W)
+    return torch.sqrt(g.pow(2).sum(2) + eps)
+
+
+class GetGradientNopadding(nn.Module):
+    """
+    Per-channel gradient magnitude with central differences, zero padded.
+    All channels go through one depthwise convolution whose (2c, 1, 3, 3) kernel is cached per
+    channel count / device / dtype.
+    :param memory_efficient: use GradientMagnitude, which does not keep the intermediates alive
+    """
+
+    def __init__(self, memory_efficient=False, eps=1e-6):
+        super(GetGradientNopadding, self).__init__()
+        kernel_v = [[0, -1, 0],
+                    [0, 0, 0],
+                    [0, 1, 0]]
+        kernel_h = [[0, 0, 0],
+                    [-1, 0, 1],
+                    [0, 0, 0]]
+        kernel_h = torch.FloatTensor(kernel_h).unsqueeze(0).unsqueeze(0)
+        kernel_v = torch.FloatTensor(kernel_v).unsqueeze(0).unsqueeze(0)
+        self.weight_h = nn.Parameter(data=kernel_h, requires_grad=False)
+
+        self.weight_v = nn.Parameter(data=kernel_v, requires_grad=False)
+        self.memory_efficient = memory_efficient
+        self.eps = eps
+        self._kernels = {}
+
+    def kernel(self, channels, device, dtype):
+        key = (channels, device, dtype, self.weight_v._version, self.weight_h._version)
+        weight = self._kernels.get(key)
+        if weight is None:
+            weight = torch.cat([self.weight_v, self.weight_h], dim=0).detach()
+            weight = weight.to(device=device, dtype=dtype).repeat(channels, 1, 1, 1)
+            self._kernels = {key: weight}
+        return weight
+
+    def forward(self, inp_feat):
+        weight = self.kernel(inp_feat.shape[1], inp_feat.device, inp_feat.dtype)
+        if self.memory_efficient and inp_feat.requires_grad:
+            return GradientMagnitude.apply(inp_feat, weight, self.eps)
+        g = F.conv2d(inp_feat, weight, padding=1, groups=inp_feat.shape[1])
+        return _magnitude(g, self.eps)
+
+
+def get_gradient_loop(inp_feat, weight_v, weight_h):
+    """ Channel loop of the original GetGradientNopadding, kept as reference """
+    x_list = []
+    for i in range(inp_feat.shape[1]):
+        x_i = inp_feat[:, i]
+        x_i_v = F.conv2d(x_i.unsqueeze(1), weight_v, padding=1)
+        x_i_h = F.conv2d(x_i.unsqueeze(1), weight_h, padding=1)
+        x_i = torch.sqrt(torch.pow(x_i_v, 2) + torch.pow(x_i_h, 2) + 1e-6)
+        x_list.append(x_i)
+    return torch.cat(x_list, dim=1)
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    get_grad = GetGradientNopadding()
+    x = torch.rand(4, 3, 256, 256, requires_grad=True)
+    ref = get_gradient_loop(x, get_grad.weight_v, get_grad.weight_h)
+    for memory_efficient in (False, True):
+        get_grad.memory_efficient = memory_efficient
+        out = get_grad(x)
+        grad, = torch.autograd.grad(out.sum(), x)
+        grad_ref, = torch.autograd.grad(ref.sum(), x, retain_graph=True)
+        print('memory_efficient=%s: max abs err %.1e, grad err %.1e' % (
+            memory_efficient, (out - ref).abs().max().item(), (grad - grad_ref).abs().max().item()))
+    x64 = torch.rand(1, 2, 6, 7, dtype=torch.float64, requires_grad=True)
+    print('gradcheck', torch.autograd.gradcheck(lambda t: GradientMagnitude.apply(
+        t, get_grad.kernel(2, t.device, t.dtype), 1e-6), (x64,)))
+
+    x = torch.rand(4, 64, 256, 256)
+    for name, fn in (('loop', lambda t: get_gradient_loop(t, get_grad.weight_v, get_grad.weight_h)),
+                     ('grouped', get_grad)):
+        with torch.no_grad():
+            fn(x)
+            start = time.perf_counter()
+            for _ in range(5):
+                fn(x)
+        print('%s (4, 64, 256, 256): %.1f ms' % (name, (time.perf_counter() - start) / 5 * 1000))
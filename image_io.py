@@ -0,0 +1,65 @@
+import os
+from PIL import Image
+
+# JPEGs are decoded at the largest libjpeg scale (1/2, 1/4, 1/8) that stays at least DRAFT_MARGIN times
+# the target size, 0 decodes at full resolution
+DRAFT_MARGIN = 2
+
+
+def load_resized(path, size, margin=None):
+    """
+    RGB image at `path` resized to `size` = (w, h) with the antialiasing (Lanczos) filter, as
+    Image.open(path).convert('RGB').resize(size, Image.ANTIALIAS) but without decoding every pixel of a
+    large JPEG: draft() lets libjpeg downscale in the DCT domain to a size of at least
+    margin * size, the antialiased resize does the rest.
+    """
+    margin = DRAFT_MARGIN if margin is None else margin
+    img = Image.open(path)
+    if margin and img.format == 'JPEG':
+        img.draft('RGB', (size[0] * margin, size[1] * margin))
+    # Image.ANTIALIAS is an alias of LANCZOS, removed in Pillow 10
+    return img.convert('RGB').resize(size, Image.LANCZOS)
+
+
+if __name__ == '__main__':
+    # draft decoding against the full decode on a folder of images: difference and time
+    import time
+    import argparse
+    import numpy as np
+
+    parser = argparse.ArgumentParser(description='Validate and time JPEG draft decoding')
+    parser.add_argument('dir', type=str)
+    parser.add_argument('--size', default=280, type=int)
+    parser.add_argument('--margin', default=DRAFT_MARGIN, type=int, help='draft margin to validate, at least 1')
+    parser.add_argument('--limit', default=200, type=int)
+    parser.add_argument('--min_psnr', default=40.0, type=float, help='fail below this PSNR against the full decode')
+    args = parser.parse_args()
+    if args.margin < 1:
+        # margin 0 disables the draft, it would only be compared with itself
+        parser.error('--margin must be at least 1, got %d' % args.margin)
+
+    paths = sorted(os.path.join(root, f) for root, _, files in os.walk(args.dir) for f in files
+                   if f.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp', '.ppm')))[:args.limit]
+    size = (args.size, args.size)
+    margins = {'full': 0, 'draft': args.margin}
+    seconds = {name: 0.0 for name in margins}
+    worst, diffs = float('inf'), []
+    for path in paths:
+        out = {}
+        for name, margin in margins.items():
+            start = time.perf_counter()
+            out[name] = np.asarray(load_resized(path, size, margin), dtype=np.float64)
+            seconds[name] += time.perf_counter() - start
+        diff = out['full'] - out['draft']
+        mse = (diff ** 2).mean()
+        psnr = 10 * np.log10(255 ** 2 / mse) if mse > 0 else float('inf')
+        worst = min(worst, psnr)
+        diffs.append(np.abs(diff).mean())
+        if psnr < args.min_psnr:
+            print('%s: PSNR %.2f dB, max abs diff %d' % (path, psnr, np.abs(diff).max()))
+    if not paths:
+        raise SystemExit('no images in %s' % args.dir)
+    print('%d images, full decode %.1f ms/image, draft x%d %.1f ms/image' % (
+        len(paths), 1000 * seconds['full'] / len(paths), args.margin, 1000 * seconds['draft'] / len(paths)))
+    print('mean abs diff %.3f (0-255), worst PSNR %.2f dB' % (np.mean(diffs), worst))
+    raise SystemExit(0 if worst >= args.min_psnr else 1)
@@ -0,0 +1,203 @@
+import os
+import argparse
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.utils.data as data
+from PIL import Image
+from export_model import load_inference
+from attention import NonLocalSparseAttention, set_rotation_seed
+from model_retinexformer import set_chunk_rows
+
+
+DIHEDRAL = tuple(range(8))
+
+
+def dihedral(x, index):
+    """
+    The 8 transforms of rotate() in dataset_simple / dataset_all on b,c,h,w tensors: (index % 4) * 90
+    degrees counter-clockwise, then a top-bottom flip for index >= 4. This equals rotate() only on square
+    images: PIL's img.rotate(90) keeps the h x w canvas and crops a non-square image, torch.rot90 returns
+    the whole w x h image, which is what the self-ensemble needs to invert every transform exactly.
+    """
+    x = torch.rot90(x, index % 4, dims=(-2, -1))
+    return x.flip(-2) if index >= 4 else x
+
+
+def dihedral_inverse(x, index):
+    if index >= 4:
+        x = x.flip(-2)
+    return torch.rot90(x, -(index % 4), dims=(-2, -1))
+
+
+def _is_oom(error):
+    return 'out of memory' in str(error)
+
+
+class Enhancer():
+    """
+    Inference runner: resizes inputs to a multiple of `multiple` (as test.py does),
+    runs the model and resizes the result back.
+    :param tta: dihedral transforms (indices of rotate(), 0 is the identity) of the self-ensemble, None
+        for a plain forward. All copies go through the model as one batch, 90/270 degree copies of
+        a non-square image as a second one, and the outputs are mapped back and averaged.
+    :param max_batch: images per forward for the ensemble, None for all of them; it is halved on
+        CUDA out-of-memory errors and the working size is kept
+    """
+
+    def __init__(self, model, device='cpu', multiple=16, compile=False, tta=None, max_batch=None):
+        self.device = torch.device(device)
+        self.multiple = multiple
+        self.tta = tuple(tta) if tta else None
+        if self.tta and not set(self.tta) <= set(DIHEDRAL):
+            raise ValueError('tta takes indices of the 8 dihedral transforms, got %s' % (self.tta,))
+        self.max_batch = max_batch
+        self.model = model.to(self.device).eval()
+        # only the enhanced image is kept, so AIMnet can skip its gradient head
+        if hasattr(self.model, 'return_grad'):
+            self.model.return_grad = False
+        if compile:
+            if not hasattr(torch, 'compile'):
+                raise RuntimeError('torch.compile needs torch >= 2.0, found %s' % torch.__version__)
+            # H/W change between images, so ask for a shape-polymorphic graph up front
+            self.model = torch.compile(self.model, dynamic=True)
+
+    @classmethod
+    def from_path(cls, path, model_name=None, torchscript=False, device='cpu', **kwargs):
+        if torchscript:
+            model = torch.jit.load(path, map_location=device)
+        else:
+            model = load_inference(path, model_name=model_name, device=device)
+        return cls(model, device=device, **kwargs)
+
+    def forward(self, x, la=None):
+        out = self.model(x) if la is None else self.model(x, la)
+        # *WithGrad models and AIMnet also return the gradient branch
+        if isinstance(out, (tuple, list)):
+            out = out[0]
+        return out
+
+    def forward_split(self, x, la=None):
+        """ forward() over slices of at most max_batch images """
+        while True:
+            step = self.max_batch or x.shape[0]
+            try:
+                return torch.cat([self.forward(x[i:i + step], None if la is None else la[i:i + step])
+                                  for i in range(0, x.shape[0], step)], 0)
+            except RuntimeError as e:
+                if not _is_oom(e) or step == 1:
+                    raise
+                torch.cuda.empty_cache()
+                self.max_batch = max(1, step // 2)
+
+    def forward_tta(self, x, la=None):
+        """ mean of dihedral_inverse(model(dihedral(x, t)), t) over the transforms t of self.tta """
+        groups = {}
+        for t in self.tta:
+            groups.setdefault(dihedral(x[:1, :1], t).shape, []).append(t)
+        out = 0
+        for transforms in groups.values():
+            batch = torch.cat([dihedral(x, t) for t in transforms], 0)
+            la_batch = None if la is None else torch.cat([dihedral(la, t) for t in transforms], 0)
+            pred = self.forward_split(batch, la_batch).float()
+            for t, part in zip(transforms, pred.chunk(len(transforms))):
+                out = out + dihedral_inverse(part, t)
+        return out / len(self.tta)
+
+    def model_size(self, h, w):
+        """ size an h x w input is resized to before the forward """
+        return int(math.ceil(h / self.multiple)) * self.multiple, int(math.ceil(w / self.multiple)) * self.multiple
+
+    @torch.no_grad()
+    def __call__(self, x, la=None):
+        """
+        :param x: b,3,h,w in [0, 1]
+        :param la: b,3,h,w illumination map for AIMnet, None otherwise
+        :return: b,3,h,w in [0, 1]
+        """
+        x = x.to(self.device)
+        h, w = x.shape[-2:]
+        new_h, new_w = self.model_size(h, w)
+        resized = (new_h, new_w) != (h, w)
+        if resized:
+            x = F.interpolate(x, size=(new_h, new_w), mode='bilinear', align_corners=False)
+        if la is not None:
+            la = F.interpolate(la.to(self.device), size=(new_h, new_w), mode='bilinear', align_corners=False)
+        out = self.forward(x, la) if self.tta is None else self.forward_tta(x, la)
+        if resized:
+            out = F.interpolate(out, size=(h, w), mode='bilinear', align_corners=False)
+        return out.clamp(0, 1)
+
+    @torch.no_grad()
+    def enhance_list(self, images, las=None):
+        """
+        One forward for images of different sizes with the same model_size(). Each one is resized to it
+        and back on its own, exactly as __call__ does, so the outputs match per-image calls.
+        :param images: list of 3,h,w in [0, 1]
+        :param las: list of illumination maps for AIMnet, None otherwise
+        :return: list of 3,h,w in [0, 1]
+        """
+        size = self.model_size(*images[0].shape[-2:])
+
+        def resize(t, size):
+            t = t[None].to(self.device)
+            return t if t.shape[-2:] == size else F.interpolate(t, size=size, mode='bilinear', align_corners=False)
+        x = torch.cat([resize(image, size) for image in images], 0)
+        la = None if las is None else torch.cat([resize(la, size) for la in las], 0)
+        out = self.forward(x, la) if self.tta is None else self.forward_tta(x, la)
+        return [resize(o, tuple(image.shape[-2:]))[0].clamp(0, 1) for o, image in zip(out, images)]
+
+
+def save_image(tensor, path):
+    arr = np.transpose(tensor.float().cpu().numpy(), (1, 2, 0))
+    Image.fromarray((arr * 255).astype(np.uint8)).save(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Enhance a folder of images')
+    parser.add_argument('--weights', required=True, type=str, help='exported .pth, training checkpoint or TorchScript file')
+    parser.add_argument('--model', default=None, type=str, help='model class, needed for training checkpoints')
+    parser.add_argument('--input_dir', default='data/LOLv1/val', type=str, help='folder holding input/ (and LA/)')
+    parser.add_argument('--save_dir', default='result/', type=str)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    parser.add_argument('--la', action='store_true', help='feed the LA illumination map (AIMnet)')
+    parser.add_argument('--torchscript', action='store_true', help='weights is a TorchScript export')
+    parser.add_argument('--compile', action='store_true', help='wrap the model with torch.compile')
+    parser.add_argument('--tta', default=None, type=str,
+                        help="dihedral self-ensemble: 'all' or indices of rotate(), e.g. 0,1,4")
+    parser.add_argument('--max_batch', default=None, type=int, help='images per forward with --tta')
+    parser.add_argument('--rotation_seed', default=None, type=int, help='freeze the LSH rotations of AIMnet')
+    parser.add_argument('--max_buckets', default=None, type=int, help='sparse attention buckets per step')
+    parser.add_argument('--chunk_rows', default=None, type=int, help='run IG_MSA in bands of this many rows')
+
+    args = parser.parse_args()
+    if args.la:
+        from dataset_all import TestData
+    else:
+        from dataset_simple import TestData
+    if not os.path.isdir(args.save_dir):
+        os.makedirs(args.save_dir)
+    tta = None
+    if args.tta is not None:
+        tta = DIHEDRAL if args.tta == 'all' else [int(t) for t in args.tta.split(',')]
+    enhancer = Enhancer.from_path(args.weights, model_name=args.model, torchscript=args.torchscript,
+                                  device=args.device, compile=args.compile, tta=tta, max_batch=args.max_batch)
+    if not args.torchscript:
+        set_rotation_seed(enhancer.model, args.rotation_seed)
+        for module in enhancer.model.modules():
+            if isinstance(module, NonLocalSparseAttention):
+                module.max_buckets = args.max_buckets
+        set_chunk_rows(enhancer.model, args.chunk_rows)
+    dataset = TestData(args.input_dir)
+    loader = data.DataLoader(dataset, batch_size=1)
+    for idx, batch in enumerate(loader):
+        if args.la:
+            x, la = batch
+        else:
+            x, la = batch, None
+        result = enhancer(x, la)
+        name = os.path.basename(dataset.A_paths[idx])
+        save_image(result[0], os.path.join(args.save_dir, name))
+        print('%d %s saved' % (idx, name))
+    print('finished!')
@@ -47,15 +47,16 @@ def image2tensor(path):
     return convert_tensor(img)
 
 
-def ram_generate_embedding_torch(sam_model, image,device):
-
+def ram_generate_embedding_torch(sam_model, image, device, image_size=384):
+    '''
+    :param image_size: side the image is resized to, None feeds it at its own size (a multiple of 4)
+    '''
     #resize_transform = get_resize_transform(image_size=384)
     #image = resize_transform(image)
     #print('image shape = ', image.shape)
-    image_rezied = image.clone()
-    new_height = 384
-    new_width = 384
-    image_rezied = F.interpolate(image_rezied, size=(new_height, new_width), mode='bilinear', align_corners=False)
+    image_rezied = image
+    if image_size is not None:
+        image_rezied = F.interpolate(image_rezied, size=(image_size, image_size), mode='bilinear', align_corners=False)
     #image_rezied = image_rezied.squeeze(0)
     #assert image.shape == (image.shape[0], 3, 384,384), 'input image should be resized to 3*384*384'
 
@@ -86,7 +87,7 @@ def ram_generate_embedding(sam_model, image,device):
 
 
 class RAMContrastLoss(nn.Module):
-    def __init__(self, ablation=False):
+    def __init__(self, ablation=False, image_size=384):
 
         super(RAMContrastLoss, self).__init__()
         """ Initializes a perceptual loss torch.nn.Module
@@ -118,14 +119,17 @@ class RAMContrastLoss(nn.Module):
         
         self.ram.to(device=self.device)
         self.ram.eval()
+        # the embeddings are computed without gradients, so the Swin encoder can keep its bias and masks
+        self.ram.visual_encoder.freeze()
+        self.image_size = image_size
 
         self.ab = ablation
         self.l1 = nn.L1Loss().to(self.device)
 
     def forward(self, anchor, positive, negative):
-        a_vgg, a_logits = ram_generate_embedding_torch(self.ram, anchor, self.device)
-        p_vgg, p_logits= ram_generate_embedding_torch(self.ram, positive, self.device)
-        n_vgg, n_logtis = ram_generate_embedding_torch(self.ram, negative, self.device)
+        a_vgg, a_logits = ram_generate_embedding_torch(self.ram, anchor, self.device, self.image_size)
+        p_vgg, p_logits= ram_generate_embedding_torch(self.ram, positive, self.device, self.image_size)
+        n_vgg, n_logtis = ram_generate_embedding_torch(self.ram, negative, self.device, self.image_size)
 
         loss = 0
 
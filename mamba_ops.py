@@ -0,0 +1,229 @@
+import math
+import time
+import torch
+import torch.nn.functional as F
+
+# CUDA kernel from mamba_ssm when it is installed, the chunked scan below otherwise
+try:
+    from mamba_ssm.ops.selective_scan_interface import selective_scan_fn as selective_scan_cuda
+except ImportError:
+    selective_scan_cuda = None
+
+
+def selective_scan(u, delta, A, B, C, D=None, z=None, delta_bias=None, delta_softplus=False,
+                   return_last_state=False):
+    """ Drop-in for mamba_ssm's selective_scan_fn, used by SS2D.forward_core """
+    if selective_scan_cuda is not None and u.is_cuda:
+        return selective_scan_cuda(u, delta, A, B, C, D, z=z, delta_bias=delta_bias,
+                                   delta_softplus=delta_softplus, return_last_state=return_last_state)
+    return selective_scan_chunked(u, delta, A, B, C, D, z=z, delta_bias=delta_bias,
+                                  delta_softplus=delta_softplus, return_last_state=return_last_state)
+
+
+def selective_scan_chunked(u, delta, A, B, C, D=None, z=None, delta_bias=None, delta_softplus=False,
+                           return_last_state=False, chunk_size=32, max_span=60.):
+    """
+    Vectorized selective scan, x_t = exp(delta_t * A) * x_{t-1} + delta_t * B_t * u_t, y_t = C_t x_t.
+    Inside a chunk the recurrence is solved with cumulative sums, S = cumsum(delta * A) taken from the
+    chunk's first step:
+        x_t = exp(S_t) * x_0' + exp(S_t) * cumsum_s(exp(-S_s) * delta_s * B_s * u_s)
+    exp(-S_s) grows with the decay inside the chunk, so a chunk whose decay exceeds `max_span` is split
+    in halves until it fits. Only one step per chunk stays sequential.
+    u, delta: (b, d, l)   A: (d, n)   B, C: (b, g, n, l) with d % g == 0   D, delta_bias: (d)   z: (b, d, l)
+    """
+    dtype_in = u.dtype
+    u = u.float()
+    delta = delta.float()
+    if delta_bias is not None:
+        delta = delta + delta_bias[..., None].float()
+    if delta_softplus:
+        delta = F.softplus(delta)
+    batch, dim, length = u.shape
+    d_state = A.shape[1]
+    if B.dim() == 3:
+        B = B.unsqueeze(1)
+    if C.dim() == 3:
+        C = C.unsqueeze(1)
+    groups = B.shape[1]
+    dg = dim // groups
+
+    # split channels into (groups, channels per group) so B/C broadcast instead of being repeated
+    u_g = u.view(batch, groups, dg, length, 1)
+    delta_g = delta.view(batch, groups, dg, length, 1)
+    A_g = A.float().view(1, groups, dg, 1, d_state)
+    B_g = B.float().transpose(-1, -2).unsqueeze(2)  # (b, g, 1, l, n)
+    C_g = C.float().transpose(-1, -2)  # (b, g, l, n)
+
+    state = [u.new_zeros(batch, groups, dg, 1, d_state)]
+    ys = []
+
+    def scan(dA, bu, c):
+        # dA, bu: (b, g, dg, T, n), dA <= 0   c: (b, g, T, n)
+        x0 = torch.exp(dA[:, :, :, :1]) * state[0] + bu[:, :, :, :1]
+        if dA.shape[3] == 1:
+            xs = x0
+        else:
+            log_decay = torch.cumsum(dA[:, :, :, 1:], dim=3)
+            if -log_decay[:, :, :, -1].min().item() > max_span:
+                mid = dA.shape[3] // 2
+                scan(dA[:, :, :, :mid], bu[:, :, :, :mid], c[:, :, :mid])
+                scan(dA[:, :, :, mid:], bu[:, :, :, mid:], c[:, :, mid:])
+                return
+            decay = torch.exp(log_decay)
+            xs = decay * (x0 + torch.cumsum(bu[:, :, :, 1:] / decay, dim=3))
+            xs = torch.cat([x0, xs], dim=3)
+        ys.append(torch.einsum('bgdtn,bgtn->bgdt', xs, c))
+        state[0] = xs[:, :, :, -1:]
+
+    for start in range(0, length, chunk_size):
+        end = min(start + chunk_size, length)
+        dt = delta_g[:, :, :, start:end]
+        scan(dt * A_g, dt * u_g[:, :, :, start:end] * B_g[:, :, :, start:end], C_g[:, :, start:end])
+    y = torch.cat(ys, dim=-1).reshape(batch, dim, length)
+
+    out = y if D is None else y + u * D.float()[:, None]
+    if z is not None:
+        out = out * F.silu(z.float())
+    out = out.to(dtype_in)
+    if return_last_state:
+        return out, state[0].reshape(batch, dim, d_state)
+    return out
+
+
+def selective_scan_sequential(u, delta, A, B, C, D=None, z=None, delta_bias=None, delta_softplus=False,
+                              return_last_state=False):
+    """ Step-by-step reference, same math as mamba_ssm's selective_scan_ref for real inputs """
+    dtype_in = u.dtype
+    u = u.float()
+    delta = delta.float()
+    if delta_bias is not None:
+        delta = delta + delta_bias[..., None].float()
+    if delta_softplus:
+        delta = F.softplus(delta)
+    batch, dim, length = u.shape
+    if B.dim() == 3:
+        B = B.unsqueeze(1)
+    if C.dim() == 3:
+        C = C.unsqueeze(1)
+    B = B.float().repeat_interleave(dim // B.shape[1], dim=1)  # (b, d, n, l)
+    C = C.float().repeat_interleave(dim // C.shape[1], dim=1)
+    deltaA = torch.exp(delta[:, :, :, None] * A.float()[None, :, None, :])  # (b, d, l, n)
+    deltaB_u = delta[:, :, :, None] * B.transpose(2, 3) * u[:, :, :, None]
+    x = u.new_zeros(batch, dim, A.shape[1])
+    ys = []
+    for i in range(length):
+        x = deltaA[:, :, i] * x + deltaB_u[:, :, i]
+        ys.append((x * C[:, :, :, i]).sum(-1))
+    y = torch.stack(ys, dim=2)
+    out = y if D is None else y + u * D.float()[:, None]
+    if z is not None:
+        out = out * F.silu(z.float())
+    out = out.to(dtype_in)
+    return (out, x) if return_last_state else out
+
+
+class CrossScan(torch.autograd.Function):
+    """
+    (b, d, h, w) -> (b, 4, d, h * w) in SS2D's four traversal orders: row-major, column-major and both reversed.
+    Written straight into the output, instead of stacking the transposed copy and concatenating the flips.
+    """
+
+    @staticmethod
+    def forward(ctx, x):
+        ctx.shape = x.shape
+        return _scan(x)
+
+    @staticmethod
+    def backward(ctx, ys):
+        B, C, H, W = ctx.shape
+        return _merge(ys, H, W).view(B, C, H, W)
+
+
+class CrossMerge(torch.autograd.Function):
+    """ (b, 4, d, h * w) -> (b, d, h * w), sum of the four directions mapped back to row-major order """
+
+    @staticmethod
+    def forward(ctx, ys, H, W):
+        ctx.shape = (H, W)
+        return _merge(ys, H, W)
+
+    @staticmethod
+    def backward(ctx, y):
+        H, W = ctx.shape
+        B, C, L = y.shape
+        return _scan(y.view(B, C, H, W)), None, None
+
+
+def _scan(x):
+    B, C, H, W = x.shape
+    xs = x.new_empty((B, 4, C, H * W))
+    xs[:, 0] = x.flatten(2, 3)
+    xs[:, 1] = x.transpose(2, 3).flatten(2, 3)
+    xs[:, 2] = xs[:, 0].flip(-1)
+    xs[:, 3] = xs[:, 1].flip(-1)
+    return xs
+
+
+def _merge(ys, H, W):
+    B, K, C, L = ys.shape
+    y = ys[:, 0] + ys[:, 2].flip(-1)
+    y_wh = ys[:, 1] + ys[:, 3].flip(-1)
+    y += y_wh.view(B, C, W, H).transpose(2, 3).reshape(B, C, L)
+    return y
+
+
+def cross_scan(x):
+    return CrossScan.apply(x)
+
+
+def cross_merge(ys, H, W):
+    return CrossMerge.apply(ys, H, W)
+
+
+if __name__ == '__main__':
+    # correctness and speed of the chunked scan against the sequential reference, with SS2D shapes
+    # (b, k * d_inner, h * w) and SS2D's initialization of A and the dt bias
+    torch.manual_seed(0)
+    b, k, d, n = 1, 4, 96, 16
+    for h in (16, 32, 64):
+        l = h * h
+        u = torch.randn(b, k * d, l)
+        delta = torch.randn(b, k * d, l)
+        A = -torch.arange(1, n + 1, dtype=torch.float32).repeat(k * d, 1)
+        Bs = torch.randn(b, k, n, l)
+        Cs = torch.randn(b, k, n, l)
+        Ds = torch.ones(k * d)
+        dt = torch.exp(torch.rand(k * d) * (math.log(0.1) - math.log(0.001)) + math.log(0.001))
+        bias = dt + torch.log(-torch.expm1(-dt))
+        timings = []
+        outs = []
+        for fn in (selective_scan_sequential, selective_scan_chunked):
+            start = time.perf_counter()
+            outs.append(fn(u, delta, A, Bs, Cs, Ds, delta_bias=bias, delta_softplus=True))
+            timings.append(time.perf_counter() - start)
+        err = (outs[0] - outs[1]).abs().max().item()
+        print('%dx%d: max abs err %.2e | sequential %.3fs, chunked %.3fs (%.1fx)' % (
+            h, h, err, timings[0], timings[1], timings[0] / timings[1]))
+
+    # strong decay forces the chunk splitting path
+    u, delta = torch.randn(b, k * d, 1024), 3 * torch.randn(b, k * d, 1024)
+    A = -torch.exp(torch.randn(k * d, n))
+    Bs, Cs = torch.randn(b, k, n, 1024), torch.randn(b, k, n, 1024)
+    ref = selective_scan_sequential(u, delta, A, Bs, Cs, delta_softplus=True)
+    out = selective_scan_chunked(u, delta, A, Bs, Cs, delta_softplus=True)
+    print('strong decay: max abs err %.2e' % (ref - out).abs().max().item())
+
+    # cross scan / merge against the stack + flip + cat construction of SS2D
+    x = torch.randn(2, 8, 5, 7, requires_grad=True)
+    B, C, H, W = x.shape
+    L = H * W
+    x_hwwh = torch.stack([x.view(B, -1, L), torch.transpose(x, dim0=2, dim1=3).contiguous().view(B, -1, L)], dim=1)
+    xs_ref = torch.cat([x_hwwh, torch.flip(x_hwwh, dims=[-1])], dim=1)
+    ys = torch.randn(B, 4, C, L)
+    inv_y = torch.flip(ys[:, 2:4], dims=[-1])
+    y_ref = ys[:, 0] + inv_y[:, 0] + torch.transpose(ys[:, 1].view(B, -1, W, H), 2, 3).reshape(B, -1, L) + \
+        torch.transpose(inv_y[:, 1].view(B, -1, W, H), 2, 3).reshape(B, -1, L)
+    print('cross scan err %.1e, merge err %.1e' % ((cross_scan(x) - xs_ref).abs().max().item(),
+                                                  (cross_merge(ys, H, W) - y_ref).abs().max().item()))
+    print('gradcheck', torch.autograd.gradcheck(cross_scan, (x.double(),)),
+          torch.autograd.gradcheck(lambda t: cross_merge(t, H, W), (ys.double().requires_grad_(),)))
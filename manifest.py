@@ -0,0 +1,154 @@
+import os
+import sys
+import json
+import hashlib
+import warnings
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp')
+MANIFEST_NAME = '.manifest.json'
+VERSION = 1
+# also stat every indexed file on load, catches files replaced in place (the directory mtimes catch
+# added, removed and renamed ones)
+VERIFY = False
+
+
+def _scan(folder):
+    """ :return: (files [[relpath, size, mtime_ns]], dirs {relpath: mtime_ns}) of the images under `folder` """
+    files, dirs = [], {}
+    stack = ['']
+    while stack:
+        rel = stack.pop()
+        path = os.path.join(folder, rel)
+        dirs[rel] = os.stat(path).st_mtime_ns
+        with os.scandir(path) as entries:
+            for entry in entries:
+                name = os.path.join(rel, entry.name) if rel else entry.name
+                if entry.is_dir():
+                    stack.append(name)
+                elif entry.name.lower().endswith(IMG_EXTENSIONS):
+                    stat = entry.stat()
+                    files.append([name, stat.st_size, stat.st_mtime_ns])
+    files.sort()
+    return files, dirs
+
+
+def _is_current(folder, entry, verify):
+    try:
+        if any(os.stat(os.path.join(folder, rel)).st_mtime_ns != mtime for rel, mtime in entry['dirs'].items()):
+            return False
+        if verify:
+            for rel, size, mtime in entry['files']:
+                stat = os.stat(os.path.join(folder, rel))
+                if stat.st_size != size or stat.st_mtime_ns != mtime:
+                    return False
+    except OSError:
+        return False
+    return True
+
+
+def _manifest_paths(root):
+    """ next to the data, or in the user cache when the data is read-only """
+    digest = hashlib.sha1(os.path.abspath(root).encode()).hexdigest()[:16]
+    cache = os.path.join(os.path.expanduser('~'), '.cache', 'semi_lowlight', 'manifests', digest + '.json')
+    return [os.path.join(root, MANIFEST_NAME), cache]
+
+
+def _read(root):
+    for path in _manifest_paths(root):
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if manifest.get('version') == VERSION:
+            return manifest
+    return {'version': VERSION, 'folders': {}}
+
+
+def _write(root, manifest):
+    for path in _manifest_paths(root):
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(manifest, f, separators=(',', ':'))
+            # atomic, concurrent loaders read either the old or the new index
+            os.replace(tmp, path)
+            return path
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    warnings.warn('could not write the manifest of %s, it will be scanned again' % root)
+
+
+def list_folder(root, folder, refresh=False, verify=None):
+    """
+    Image files under root/folder as sorted relative paths, from the manifest of `root` when it is
+    current, otherwise scanned once and stored in it.
+    """
+    verify = VERIFY if verify is None else verify
+    manifest = _read(root)
+    entry = manifest['folders'].get(folder)
+    path = os.path.join(root, folder)
+    if refresh or entry is None or not _is_current(path, entry, verify):
+        assert os.path.isdir(path), '%s is not a valid directory' % path
+        files, dirs = _scan(path)
+        manifest = _read(root)
+        manifest['folders'][folder] = entry = {'files': files, 'dirs': dirs}
+        _write(root, manifest)
+    return [rel for rel, _, _ in entry['files']]
+
+
+def load_pairs(root, folders, strict=True, refresh=False, verify=None):
+    """
+    Full paths of the images of root/<folder> for every folder in `folders`, paired by file stem
+    (relative path without the extension, so input/0001.jpg pairs with GT/0001.png), in the sorted
+    order of the first folder.
+    :param strict: raise ValueError when a stem is missing from a folder, otherwise keep the stems
+        present in all of them and warn
+    :return: list of path lists, one per folder
+    """
+    by_stem = []
+    for folder in folders:
+        stems = {}
+        for rel in list_folder(root, folder, refresh, verify):
+            stem = os.path.splitext(rel)[0]
+            if stem in stems:
+                raise ValueError('%s: %s and %s have the same stem' % (os.path.join(root, folder), stems[stem], rel))
+            stems[stem] = rel
+        by_stem.append(stems)
+    common = set(by_stem[0]).intersection(*by_stem[1:])
+    problems = []
+    for folder, stems in zip(folders, by_stem):
+        extra = sorted(set(stems) - common)
+        if extra:
+            problems.append('%s: %d of %d files without a partner, e.g. %s' % (
+                os.path.join(root, folder), len(extra), len(stems), ', '.join(stems[s] for s in extra[:3])))
+    if problems:
+        message = 'unpaired images in %s\n    %s' % (root, '\n    '.join(problems))
+        if strict:
+            raise ValueError(message)
+        warnings.warn(message)
+    order = sorted(common, key=lambda stem: by_stem[0][stem])
+    return [[os.path.join(root, folder, stems[stem]) for stem in order] for folder, stems in zip(folders, by_stem)]
+
+
+if __name__ == '__main__':
+    # build or refresh the manifest of a split and check the pairing, e.g.
+    #   python manifest.py ./data/labeled input GT
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Scan, pair and index a dataset split')
+    parser.add_argument('root', type=str)
+    parser.add_argument('folders', nargs='+', type=str)
+    parser.add_argument('--refresh', action='store_true', help='scan even if the manifest is current')
+    parser.add_argument('--verify', action='store_true', help='stat every indexed file')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    try:
+        paths = load_pairs(args.root, args.folders, refresh=args.refresh, verify=args.verify)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    print('%d pairs over %s in %.1f ms' % (len(paths[0]), ', '.join(args.folders), (time.perf_counter() - start) * 1000))
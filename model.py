@@ -1,7 +1,8 @@
 # --- Imports --- #
 from utils import *
-from attention import NonLocalSparseAttention
+from attention import NonLocalSparseAttention, set_rotation_seed
 from deform_conv import DCN_layer
+from gradient_ops import GetGradientNopadding
 
 
 class SFT_layer(nn.Module):
@@ -55,35 +56,6 @@ class IGM(nn.Module):
         return out
 
 
-class GetGradientNopadding(nn.Module):
-    def __init__(self):
-        super(GetGradientNopadding, self).__init__()
-        kernel_v = [[0, -1, 0],
-                    [0, 0, 0],
-                    [0, 1, 0]]
-        kernel_h = [[0, 0, 0],
-                    [-1, 0, 1],
-                    [0, 0, 0]]
-        kernel_h = torch.FloatTensor(kernel_h).unsqueeze(0).unsqueeze(0)
-        kernel_v = torch.FloatTensor(kernel_v).unsqueeze(0).unsqueeze(0)
-        self.weight_h = nn.Parameter(data=kernel_h, requires_grad=False)
-
-        self.weight_v = nn.Parameter(data=kernel_v, requires_grad=False)
-
-    def forward(self, inp_feat):
-        x_list = []
-        for i in range(inp_feat.shape[1]):
-            x_i = inp_feat[:, i]
-            x_i_v = F.conv2d(x_i.unsqueeze(1), self.weight_v, padding=1)
-            x_i_h = F.conv2d(x_i.unsqueeze(1), self.weight_h, padding=1)
-            x_i = torch.sqrt(torch.pow(x_i_v, 2) + torch.pow(x_i_h, 2) + 1e-6)
-            x_list.append(x_i)
-
-        res = torch.cat(x_list, dim=1)
-
-        return res
-
-
 class Down(nn.Module):
     def __init__(self, in_channels, chan_factor, bias=False):
         super(Down, self).__init__()
@@ -304,12 +276,16 @@ class AIMnet(nn.Module):
         self.b_concat_2 = nn.Conv2d(2 * n_feat, n_feat, kernel_size=3, padding=1, bias=bias)
         self.b_block_2 = RCB(2 * n_feat, self.act, bias=bias)
         self.b_fea_conv = nn.Conv2d(n_feat, n_feat, kernel_size=3, padding=1, bias=bias)
+        self.return_grad = True
 
-    def forward(self, x, la):
-        x_top = x.clone()
-        x_top_la = self.conv_in(la)
+    def forward(self, x, la, return_grad=None):
+        """
+        :param return_grad: also return the gradient branch output, defaults to self.return_grad.
+            False skips the grad_out head and returns the enhanced image alone
+        """
         x_grad = self.get_gradient(x)
-        x_top = self.conv_in(x_top)
+        # la, x and its gradient map share conv_in, so they go through it as one batch
+        x_top_la, x_top, x_b_fea = self.conv_in(torch.cat([la, x, x_grad], dim=0)).chunk(3, dim=0)
         x_mid = self.down2(x_top)
         x_bot = self.down4(x_top)
 
@@ -330,7 +306,6 @@ class AIMnet(nn.Module):
         mid_out = self.conv_mid(x_top2)
         mid_out = mid_out + x_top
 
-        x_b_fea = self.conv_in(x_grad)
         x_cat_1 = torch.cat([x_b_fea, x_top1], dim=1)
 
         x_cat_1 = self.b_block_1(x_cat_1)
@@ -342,17 +317,24 @@ class AIMnet(nn.Module):
         x_cat_2 = self.b_concat_2(x_cat_2)
 
         grad_out = x_cat_2 + x_b_fea
-        res_grad = self.grad_out(grad_out)
         out = self.aff_final(mid_out, grad_out)
         result = self.conv_out(out)
+        if not (self.return_grad if return_grad is None else return_grad):
+            return result
 
+        res_grad = self.grad_out(grad_out)
         return result, res_grad
 
 
 if __name__ == "__main__":
-    model = AIMnet()
+    model = AIMnet().eval()
+    # fixed LSH rotations so the two calls below are comparable
+    set_rotation_seed(model, 0)
     x = torch.ones([1, 3, 256, 256])
     x1 = torch.ones([1, 3, 256, 256])
-    y = model(x, x1)
+    with torch.no_grad():
+        y = model(x, x1)
+        y_only = model(x, x1, return_grad=False)
     print(y[0].shape, y[1].shape)
+    print('without grad head, max abs diff %.1e' % (y_only - y[0]).abs().max().item())
     print('model params: %d' % count_parameters(model))  
@@ -2,38 +2,6 @@
 from utils import *
 
 
-class GetGradientNopadding(nn.Module):
-    def __init__(self):
-        super(GetGradientNopadding, self).__init__()
-        kernel_v = [[0, -1, 0],
-                    [0, 0, 0],
-                    [0, 1, 0]]
-        kernel_h = [[0, 0, 0],
-                    [-1, 0, 1],
-                    [0, 0, 0]]
-        kernel_h = torch.FloatTensor(kernel_h).unsqueeze(0).unsqueeze(0)
-        kernel_v = torch.FloatTensor(kernel_v).unsqueeze(0).unsqueeze(0)
-        self.weight_h = nn.Parameter(data=kernel_h, requires_grad=False)
-
-        self.weight_v = nn.Parameter(data=kernel_v, requires_grad=False)
-
-    def forward(self, inp_feat):
-        x_list = []
-        for i in range(inp_feat.shape[1]):
-            x_i = inp_feat[:, i]
-            x_i_v = F.conv2d(x_i.unsqueeze(1), self.weight_v, padding=1)
-            x_i_h = F.conv2d(x_i.unsqueeze(1), self.weight_h, padding=1)
-            x_i = torch.sqrt(torch.pow(x_i_v, 2) + torch.pow(x_i_h, 2) + 1e-6)
-            x_list.append(x_i)
-
-        res = torch.cat(x_list, dim=1)
-
-        return res
-
-
-
-
-
 """
 
 if __name__ == "__main__":
@@ -54,6 +22,8 @@ import math
 import warnings
 from torch.nn.init import _calculate_fan_in_and_fan_out
 from pdb import set_trace as stx
+from gradient_ops import GetGradientNopadding
+from model_retinexformer import ig_msa_chunked
 # import cv2
 #import os
 #os.environ['CUDA_VISIBLE_DEVICES'] = '2'
@@ -192,6 +162,8 @@ class IG_MSA(nn.Module):
             nn.Conv2d(dim, dim, 3, 1, 1, bias=False, groups=dim),
         )
         self.dim = dim
+        # rows per band of ig_msa_chunked, None attends over the whole frame at once
+        self.chunk_rows = None
 
     def forward(self, x_in, illu_fea_trans):
         """
@@ -200,6 +172,8 @@ class IG_MSA(nn.Module):
         return out: [b,h,w,c]
         """
         b, h, w, c = x_in.shape
+        if self.chunk_rows and h > self.chunk_rows:
+            return ig_msa_chunked(self, x_in, illu_fea_trans, self.chunk_rows)
         x = x_in.reshape(b, h * w, c)
         q_inp = self.to_q(x)
         k_inp = self.to_k(x)
@@ -2,14 +2,15 @@
 import math
 import torch
 import torch.nn as nn
-import torch.utils.checkpoint as checkpoint
+from activation_checkpoint import checkpoint_forward
 import torch.nn.functional as F
 from functools import partial
 from typing import Optional, Callable
 #from basicsr.utils.registry import ARCH_REGISTRY
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
-from mamba_ssm.ops.selective_scan_interface import selective_scan_fn, selective_scan_ref
+from mamba_ops import selective_scan, cross_scan, cross_merge
 from einops import rearrange, repeat
+from gradient_ops import GetGradientNopadding
 
 
 
@@ -264,7 +265,7 @@ class SS2D(nn.Module):
         self.A_logs = self.A_log_init(self.d_state, self.d_inner, copies=4, merge=True)  # (K=4, D, N)
         self.Ds = self.D_init(self.d_inner, copies=4, merge=True)  # (K=4, D, N)
 
-        self.selective_scan = selective_scan_fn
+        self.selective_scan = selective_scan
 
         self.out_norm = nn.LayerNorm(self.d_inner)
         self.out_proj = nn.Linear(self.d_inner, self.d_model, bias=bias, **factory_kwargs)
@@ -331,8 +332,7 @@ class SS2D(nn.Module):
         B, C, H, W = x.shape
         L = H * W
         K = 4
-        x_hwwh = torch.stack([x.view(B, -1, L), torch.transpose(x, dim0=2, dim1=3).contiguous().view(B, -1, L)], dim=1).view(B, 2, -1, L)
-        xs = torch.cat([x_hwwh, torch.flip(x_hwwh, dims=[-1])], dim=1) # (1, 4, 192, 3136)
+        xs = cross_scan(x) # (b, k, d, l)
 
         x_dbl = torch.einsum("b k d l, k c d -> b k c l", xs.view(B, K, -1, L), self.x_proj_weight)
         dts, Bs, Cs = torch.split(x_dbl, [self.dt_rank, self.d_state, self.d_state], dim=2)
@@ -353,11 +353,7 @@ class SS2D(nn.Module):
         ).view(B, K, -1, L)
         assert out_y.dtype == torch.float
 
-        inv_y = torch.flip(out_y[:, 2:4], dims=[-1]).view(B, 2, -1, L)
-        wh_y = torch.transpose(out_y[:, 1].view(B, -1, W, H), dim0=2, dim1=3).contiguous().view(B, -1, L)
-        invwh_y = torch.transpose(inv_y[:, 1].view(B, -1, W, H), dim0=2, dim1=3).contiguous().view(B, -1, L)
-
-        return out_y[:, 0], inv_y[:, 0], wh_y, invwh_y
+        return cross_merge(out_y, H, W)
 
     def forward(self, x: torch.Tensor, **kwargs):
         B, H, W, C = x.shape
@@ -367,9 +363,8 @@ class SS2D(nn.Module):
 
         x = x.permute(0, 3, 1, 2).contiguous()
         x = self.act(self.conv2d(x))
-        y1, y2, y3, y4 = self.forward_core(x)
-        assert y1.dtype == torch.float32
-        y = y1 + y2 + y3 + y4
+        y = self.forward_core(x)
+        assert y.dtype == torch.float32
         y = torch.transpose(y, dim0=1, dim1=2).contiguous().view(B, H, W, -1)
         y = self.out_norm(y)
         y = y * F.silu(z)
@@ -464,10 +459,7 @@ class BasicLayer(nn.Module):
 
     def forward(self, x, x_size):
         for blk in self.blocks:
-            if self.use_checkpoint:
-                x = checkpoint.checkpoint(blk, x)
-            else:
-                x = blk(x, x_size)
+            x = checkpoint_forward(self, blk, x, x_size)
         if self.downsample is not None:
             x = self.downsample(x)
         return x
@@ -483,33 +475,6 @@ class BasicLayer(nn.Module):
             flops += self.downsample.flops()
         return flops
 
-class GetGradientNopadding(nn.Module):
-    def __init__(self):
-        super(GetGradientNopadding, self).__init__()
-        kernel_v = [[0, -1, 0],
-                    [0, 0, 0],
-                    [0, 1, 0]]
-        kernel_h = [[0, 0, 0],
-                    [-1, 0, 1],
-                    [0, 0, 0]]
-        kernel_h = torch.FloatTensor(kernel_h).unsqueeze(0).unsqueeze(0)
-        kernel_v = torch.FloatTensor(kernel_v).unsqueeze(0).unsqueeze(0)
-        self.weight_h = nn.Parameter(data=kernel_h, requires_grad=False)
-
-        self.weight_v = nn.Parameter(data=kernel_v, requires_grad=False)
-
-    def forward(self, inp_feat):
-        x_list = []
-        for i in range(inp_feat.shape[1]):
-            x_i = inp_feat[:, i]
-            x_i_v = F.conv2d(x_i.unsqueeze(1), self.weight_v, padding=1)
-            x_i_h = F.conv2d(x_i.unsqueeze(1), self.weight_h, padding=1)
-            x_i = torch.sqrt(torch.pow(x_i_v, 2) + torch.pow(x_i_h, 2) + 1e-6)
-            x_list.append(x_i)
-
-        res = torch.cat(x_list, dim=1)
-
-        return res
     
 class Illumination_Estimator(nn.Module):
     def __init__(
@@ -784,6 +749,8 @@ class ResidualGroup(nn.Module):
 
         self.dim = dim
         self.input_resolution = input_resolution # [64, 64]
+        # the whole group, see activation_checkpoint.py; use_checkpoint of the constructor goes to the blocks
+        self.use_checkpoint = False
 
         self.residual_group = BasicLayer(
             dim=dim,
@@ -814,6 +781,9 @@ class ResidualGroup(nn.Module):
             img_size=img_size, patch_size=patch_size, in_chans=0, embed_dim=dim, norm_layer=None)
 
     def forward(self, x, x_size):
+        return checkpoint_forward(self, self._forward, x, x_size)
+
+    def _forward(self, x, x_size):
         return self.patch_embed(self.conv(self.patch_unembed(self.residual_group(x, x_size), x_size))) + x
 
     def flops(self):
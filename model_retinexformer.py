@@ -2,38 +2,6 @@
 from utils import *
 
 
-class GetGradientNopadding(nn.Module):
-    def __init__(self):
-        super(GetGradientNopadding, self).__init__()
-        kernel_v = [[0, -1, 0],
-                    [0, 0, 0],
-                    [0, 1, 0]]
-        kernel_h = [[0, 0, 0],
-                    [-1, 0, 1],
-                    [0, 0, 0]]
-        kernel_h = torch.FloatTensor(kernel_h).unsqueeze(0).unsqueeze(0)
-        kernel_v = torch.FloatTensor(kernel_v).unsqueeze(0).unsqueeze(0)
-        self.weight_h = nn.Parameter(data=kernel_h, requires_grad=False)
-
-        self.weight_v = nn.Parameter(data=kernel_v, requires_grad=False)
-
-    def forward(self, inp_feat):
-        x_list = []
-        for i in range(inp_feat.shape[1]):
-            x_i = inp_feat[:, i]
-            x_i_v = F.conv2d(x_i.unsqueeze(1), self.weight_v, padding=1)
-            x_i_h = F.conv2d(x_i.unsqueeze(1), self.weight_h, padding=1)
-            x_i = torch.sqrt(torch.pow(x_i_v, 2) + torch.pow(x_i_h, 2) + 1e-6)
-            x_list.append(x_i)
-
-        res = torch.cat(x_list, dim=1)
-
-        return res
-
-
-
-
-
 """
 
 if __name__ == "__main__":
@@ -49,11 +17,12 @@ if __name__ == "__main__":
 import torch.nn as nn
 import torch
 import torch.nn.functional as F
-from einops import rearrange
 import math
 import warnings
 from torch.nn.init import _calculate_fan_in_and_fan_out
 from pdb import set_trace as stx
+from gradient_ops import GetGradientNopadding
+from activation_checkpoint import checkpoint_forward
 # import cv2
 #import os
 #os.environ['CUDA_VISIBLE_DEVICES'] = '2'
@@ -192,6 +161,8 @@ class IG_MSA(nn.Module):
             nn.Conv2d(dim, dim, 3, 1, 1, bias=False, groups=dim),
         )
         self.dim = dim
+        # rows per band of ig_msa_chunked, None attends over the whole frame at once
+        self.chunk_rows = None
 
     def forward(self, x_in, illu_fea_trans):
         """
@@ -200,12 +171,15 @@ class IG_MSA(nn.Module):
         return out: [b,h,w,c]
         """
         b, h, w, c = x_in.shape
+        if self.chunk_rows and h > self.chunk_rows:
+            return ig_msa_chunked(self, x_in, illu_fea_trans, self.chunk_rows)
         x = x_in.reshape(b, h * w, c)
         q_inp = self.to_q(x)
         k_inp = self.to_k(x)
         v_inp = self.to_v(x)
         illu_attn = illu_fea_trans # illu_fea: b,c,h,w -> b,h,w,c
-        q, k, v, illu_attn = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h=self.num_heads),
+        # 'b n (h d) -> b h n d' with plain reshapes so traced/ONNX graphs keep h, w dynamic
+        q, k, v, illu_attn = map(lambda t: t.reshape(b, h * w, self.num_heads, -1).transpose(1, 2),
                                  (q_inp, k_inp, v_inp, illu_attn.flatten(1, 2)))
         v = v * illu_attn
         # q: b,heads,hw,c
@@ -228,6 +202,55 @@ class IG_MSA(nn.Module):
         return out
 
 
+def ig_msa_chunked(msa, x_in, illu_fea_trans, chunk_rows):
+    """
+    IG_MSA.forward over bands of chunk_rows rows, so no (b, heads, hw, d) tensor is built.
+    q and k are normalized over hw, so K^T Q and the squared norms are summed band by band and
+    divided once at the end. The d x d attention is then applied band by band, together with the
+    projection and the positional convs (a 2 row halo covers the two 3x3 convs).
+    x_in, illu_fea_trans: [b,h,w,c]
+    return out: [b,h,w,c]
+    """
+    b, h, w, c = x_in.shape
+    heads, d = msa.num_heads, msa.dim_head
+    kq = x_in.new_zeros(b, heads, d, d)
+    k_sq = x_in.new_zeros(b, heads, d, 1)
+    q_sq = x_in.new_zeros(b, heads, 1, d)
+    for r0 in range(0, h, chunk_rows):
+        x = x_in[:, r0:r0 + chunk_rows].reshape(b, -1, c)
+        n = x.shape[1]
+        q = msa.to_q(x).reshape(b, n, heads, d).permute(0, 2, 3, 1)  # b,heads,d,n
+        k = msa.to_k(x).reshape(b, n, heads, d).permute(0, 2, 3, 1)
+        kq = kq + k @ q.transpose(-2, -1)
+        k_sq = k_sq + k.pow(2).sum(-1, keepdim=True)
+        q_sq = q_sq + q.pow(2).sum(-1).unsqueeze(-2)
+    # same eps as F.normalize
+    attn = kq / (k_sq.sqrt().clamp_min(1e-12) * q_sq.sqrt().clamp_min(1e-12))
+    attn = (attn * msa.rescale).softmax(dim=-1)
+
+    out = x_in.new_empty(b, h, w, c)
+    for r0 in range(0, h, chunk_rows):
+        r1 = min(r0 + chunk_rows, h)
+        lo, hi = max(r0 - 2, 0), min(r1 + 2, h)
+        v_inp = msa.to_v(x_in[:, lo:hi].reshape(b, -1, c)).reshape(b, hi - lo, w, c)
+        n = (r1 - r0) * w
+        v = v_inp[:, r0 - lo:r1 - lo].reshape(b, n, heads, d) * illu_fea_trans[:, r0:r1].reshape(b, n, heads, d)
+        x = attn @ v.permute(0, 2, 3, 1)  # b,heads,d,n
+        x = x.permute(0, 3, 1, 2).reshape(b, n, heads * d)
+        out_c = msa.proj(x).view(b, r1 - r0, w, c)
+        out_p = msa.pos_emb(v_inp.permute(0, 3, 1, 2))[:, :, r0 - lo:r1 - lo].permute(0, 2, 3, 1)
+        out[:, r0:r1] = out_c + out_p
+    return out
+
+
+def set_chunk_rows(model, chunk_rows):
+    """ Run every IG_MSA in model band by band (None restores the full-frame attention) """
+    for module in model.modules():
+        if hasattr(module, 'chunk_rows') and hasattr(module, 'rescale'):
+            module.chunk_rows = chunk_rows
+    return model
+
+
 class FeedForward(nn.Module):
     def __init__(self, dim, mult=4):
         super().__init__()
@@ -258,6 +281,8 @@ class IGAB(nn.Module):
             num_blocks=2,
     ):
         super().__init__()
+        # recompute the blocks in backward instead of storing their activations, see activation_checkpoint.py
+        self.use_checkpoint = False
         self.blocks = nn.ModuleList([])
         for _ in range(num_blocks):
             self.blocks.append(nn.ModuleList([
@@ -271,6 +296,9 @@ class IGAB(nn.Module):
         illu_fea: [b,c,h,w]
         return out: [b,c,h,w]
         """
+        return checkpoint_forward(self, self._forward, x, illu_fea)
+
+    def _forward(self, x, illu_fea):
         x = x.permute(0, 2, 3, 1)
         for (attn, ff) in self.blocks:
             x = attn(x, illu_fea_trans=illu_fea.permute(0, 2, 3, 1)) + x
@@ -436,6 +464,19 @@ class RetinexFormerWithGrad(nn.Module):
         return out, res_grad
     
 if __name__ == '__main__':
+    # banded IG_MSA against the full-frame one, outputs and gradients
+    torch.manual_seed(0)
+    model = RetinexFormer().eval()
+    inputs = torch.rand(1, 3, 96, 80, requires_grad=True)
+    ref = model(inputs)
+    grad_ref, = torch.autograd.grad(ref.sum(), inputs)
+    set_chunk_rows(model, 7)
+    out = model(inputs)
+    grad, = torch.autograd.grad(out.sum(), inputs)
+    print('chunked IG_MSA: max abs err %.1e, grad err %.1e' % ((out - ref).abs().max().item(),
+                                                                (grad - grad_ref).abs().max().item()))
+    set_chunk_rows(model, None)
+
     from fvcore.nn import FlopCountAnalysis
     
     device = torch.device('cuda:2' if torch.cuda.is_available() else 'cpu')
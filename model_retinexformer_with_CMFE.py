@@ -1,5 +1,7 @@
 # --- Imports --- #
 from utils import *
+from gradient_ops import GetGradientNopadding
+from model_retinexformer import ig_msa_chunked
 
 class GFM(nn.Module):
     def __init__(self, in_channels, feature_num=2, bias=True, padding_mode='reflect', **kwargs) -> None:
@@ -118,38 +120,6 @@ class MSFN(nn.Module):
         return x.permute(0, 2, 3, 1)
     
 
-class GetGradientNopadding(nn.Module):
-    def __init__(self):
-        super(GetGradientNopadding, self).__init__()
-        kernel_v = [[0, -1, 0],
-                    [0, 0, 0],
-                    [0, 1, 0]]
-        kernel_h = [[0, 0, 0],
-                    [-1, 0, 1],
-                    [0, 0, 0]]
-        kernel_h = torch.FloatTensor(kernel_h).unsqueeze(0).unsqueeze(0)
-        kernel_v = torch.FloatTensor(kernel_v).unsqueeze(0).unsqueeze(0)
-        self.weight_h = nn.Parameter(data=kernel_h, requires_grad=False)
-
-        self.weight_v = nn.Parameter(data=kernel_v, requires_grad=False)
-
-    def forward(self, inp_feat):
-        x_list = []
-        for i in range(inp_feat.shape[1]):
-            x_i = inp_feat[:, i]
-            x_i_v = F.conv2d(x_i.unsqueeze(1), self.weight_v, padding=1)
-            x_i_h = F.conv2d(x_i.unsqueeze(1), self.weight_h, padding=1)
-            x_i = torch.sqrt(torch.pow(x_i_v, 2) + torch.pow(x_i_h, 2) + 1e-6)
-            x_list.append(x_i)
-
-        res = torch.cat(x_list, dim=1)
-
-        return res
-
-
-
-
-
 """
 
 if __name__ == "__main__":
@@ -308,6 +278,8 @@ class IG_MSA(nn.Module):
             nn.Conv2d(dim, dim, 3, 1, 1, bias=False, groups=dim),
         )
         self.dim = dim
+        # rows per band of ig_msa_chunked, None attends over the whole frame at once
+        self.chunk_rows = None
 
     def forward(self, x_in, illu_fea_trans):
         """
@@ -316,6 +288,8 @@ class IG_MSA(nn.Module):
         return out: [b,h,w,c]
         """
         b, h, w, c = x_in.shape
+        if self.chunk_rows and h > self.chunk_rows:
+            return ig_msa_chunked(self, x_in, illu_fea_trans, self.chunk_rows)
         x = x_in.reshape(b, h * w, c)
         q_inp = self.to_q(x)
         k_inp = self.to_k(x)
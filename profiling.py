@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import resource
+import contextlib
+import torch
+
+MEMORY_KEYS = ('cpu_rss_mb', 'cpu_maxrss_mb', 'cuda_peak_mb', 'cuda_reserved_mb')
+
+
+def _cpu_memory():
+    """ {'cpu_rss_mb': current RSS} on Linux, elsewhere {'cpu_maxrss_mb': high-water mark of the process} """
+    try:
+        with open('/proc/self/statm') as f:
+            return {'cpu_rss_mb': int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20}
+    except (OSError, ValueError, IndexError):
+        return {'cpu_maxrss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+class Profiler():
+    """
+    Per-iteration instrumentation for the trainers:
+        with profiler.timer('teacher'):
+            ...
+        profiler.step()     # once per iteration
+    Timers synchronize the device on entry and exit so they measure the GPU work of the block, and
+    show up as ranges in the torch.profiler trace. step() records the timings and the memory
+    high-water marks of the iteration. A disabled profiler costs one attribute lookup per timer.
+    :param trace_dir: run torch.profiler over `schedule` = (wait, warmup, active) steps and write a
+        TensorBoard trace there
+    :param json_path: JSON lines file, dump_json() appends the steps and the summary of each epoch
+    """
+
+    def __init__(self, enabled=False, sync=True, trace_dir=None, schedule=(5, 2, 5), json_path=None):
+        self.enabled = enabled
+        self.sync = sync and torch.cuda.is_available()
+        self.json_path = json_path
+        self.current = {}
+        # steps since the last dump_json(), earlier ones are only on disk
+        self.steps = []
+        self.step_count = 0
+        self.torch_profiler = None
+        if enabled and trace_dir is not None:
+            wait, warmup, active = schedule
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+                record_shapes=True, profile_memory=True)
+            self.torch_profiler.start()
+
+    def timer(self, name):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._timer(name)
+
+    @contextlib.contextmanager
+    def _timer(self, name):
+        with torch.profiler.record_function(name):
+            if self.sync:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                if self.sync:
+                    torch.cuda.synchronize()
+                self.current[name] = self.current.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+    def step(self):
+        """ Close the current iteration """
+        if not self.enabled:
+            return
+        record = {'step': self.step_count, 'ms': self.current}
+        record.update(_cpu_memory())
+        if torch.cuda.is_available():
+            record['cuda_peak_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+            record['cuda_reserved_mb'] = torch.cuda.max_memory_reserved() / 2 ** 20
+            torch.cuda.reset_peak_memory_stats()
+        self.steps.append(record)
+        self.step_count += 1
+        self.current = {}
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+
+    def summary(self, steps=None):
+        """ Mean ms per timer and max memory over `steps` (the steps since the last dump_json() by default) """
+        steps = self.steps if steps is None else steps
+        if not steps:
+            return {}
+        names = sorted({name for record in steps for name in record['ms']})
+        summary = {'steps': len(steps),
+                   'ms': {name: sum(r['ms'].get(name, 0.0) for r in steps) / len(steps) for name in names}}
+        for key in MEMORY_KEYS:
+            if key in steps[0]:
+                summary[key] = max(record[key] for record in steps)
+        return summary
+
+    def write(self, writer, global_step):
+        """ Summary of the steps since the last dump_json() to the SummaryWriter, e.g. once per epoch """
+        if not self.enabled:
+            return
+        summary = self.summary()
+        for name, ms in summary.get('ms', {}).items():
+            writer.add_scalar('time/%s_ms' % name, ms, global_step=global_step)
+        for key in MEMORY_KEYS:
+            if key in summary:
+                writer.add_scalar('memory/%s' % key, summary[key], global_step=global_step)
+
+    def dump_json(self, epoch=None, path=None):
+        """
+        Append one line {'epoch', 'summary', 'steps'} with the steps since the last call and drop
+        them from memory. Without a path the steps are kept, for summary() over a whole run.
+        """
+        path = path or self.json_path
+        if not self.enabled or path is None or not self.steps:
+            return
+        with open(path, 'a') as f:
+            f.write(json.dumps({'epoch': epoch, 'summary': self.summary(), 'steps': self.steps}) + '\n')
+        self.steps = []
+
+    def close(self):
+        if self.torch_profiler is not None:
+            self.torch_profiler.stop()
+            self.torch_profiler = None
+        self.dump_json()
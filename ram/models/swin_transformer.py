@@ -10,6 +10,7 @@ from scipy import interpolate
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.utils.checkpoint as checkpoint
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 
@@ -65,6 +66,36 @@ def window_reverse(windows, window_size, H, W):
     return x
 
 
+def compute_mask(H, W, window_size, shift_size, device=None):
+    """
+    Args:
+        H, W (int): Size of the (padded) feature map, multiples of window_size
+        window_size (int): Window size
+        shift_size (int): Shift size for SW-MSA
+
+    Returns:
+        attn_mask: (0/-100) mask of shape (num_windows, window_size*window_size, window_size*window_size)
+    """
+    img_mask = torch.zeros((1, H, W, 1), device=device)  # 1 H W 1
+    h_slices = (slice(0, -window_size),
+                slice(-window_size, -shift_size),
+                slice(-shift_size, None))
+    w_slices = (slice(0, -window_size),
+                slice(-window_size, -shift_size),
+                slice(-shift_size, None))
+    cnt = 0
+    for h in h_slices:
+        for w in w_slices:
+            img_mask[:, h, w, :] = cnt
+            cnt += 1
+
+    mask_windows = window_partition(img_mask, window_size)  # nW, window_size, window_size, 1
+    mask_windows = mask_windows.view(-1, window_size * window_size)
+    attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
+    attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+    return attn_mask
+
+
 class WindowAttention(nn.Module):
     r""" Window based multi-head self attention (W-MSA) module with relative position bias.
     It supports both of shifted and non-shifted window.
@@ -113,6 +144,38 @@ class WindowAttention(nn.Module):
         trunc_normal_(self.relative_position_bias_table, std=.02)
         self.softmax = nn.Softmax(dim=-1)
 
+        # fused attention kernel when torch has one (>= 2.0)
+        self.use_sdpa = hasattr(F, 'scaled_dot_product_attention')
+        # frozen: the bias (and bias + mask) tensors are built once and reused, see SwinTransformer.freeze
+        self.frozen = False
+        self.bias_cache = {}
+
+    def attention_bias(self, mask=None):
+        """
+        Relative position bias plus the shift mask.
+
+        Returns:
+            bias: (1, nH, Wh*Ww, Wh*Ww) without mask, (num_windows, nH, Wh*Ww, Wh*Ww) with mask
+        """
+        table = self.relative_position_bias_table
+        key = None
+        if self.frozen:
+            key = (table.device, table.dtype, table._version,
+                   None if mask is None else (mask.data_ptr(), tuple(mask.shape)))
+            if key in self.bias_cache:
+                return self.bias_cache[key]
+        relative_position_bias = table[self.relative_position_index.view(-1)].view(
+            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
+        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+        bias = relative_position_bias.unsqueeze(0)
+        if mask is not None:
+            bias = bias + mask.unsqueeze(1).to(bias.dtype)
+        if key is not None:
+            if len(self.bias_cache) >= 8:
+                self.bias_cache.clear()
+            self.bias_cache[key] = bias
+        return bias
+
     def forward(self, x, mask=None):
         """
         Args:
@@ -123,25 +186,29 @@ class WindowAttention(nn.Module):
         qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
-        q = q * self.scale
-        attn = (q @ k.transpose(-2, -1))
-
-        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-        attn = attn + relative_position_bias.unsqueeze(0)
-
-        if mask is not None:
-            nW = mask.shape[0]
-            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
-            attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
+        bias = self.attention_bias(mask)
+        nW = bias.shape[0]
+
+        if self.use_sdpa:
+            head_dim = C // self.num_heads
+            if self.scale != head_dim ** -0.5:
+                # the kernel scales by head_dim ** -0.5
+                q = q * (self.scale * head_dim ** 0.5)
+            if nW > 1:
+                # windows of one image share the mask: B, nW, nH, N, d against nW, nH, N, N
+                shape = (B_ // nW, nW, self.num_heads, N, head_dim)
+                q, k, v = q.reshape(shape), k.reshape(shape), v.reshape(shape)
+            x = F.scaled_dot_product_attention(q, k, v, attn_mask=bias.to(q.dtype),
+                                               dropout_p=self.attn_drop.p if self.training else 0.)
+            x = x.reshape(B_, self.num_heads, N, head_dim).transpose(1, 2).reshape(B_, N, C)
         else:
+            q = q * self.scale
+            attn = (q @ k.transpose(-2, -1))
+            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + bias.unsqueeze(0)
+            attn = attn.view(-1, self.num_heads, N, N)
             attn = self.softmax(attn)
-
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B_, N, C)
+            attn = self.attn_drop(attn)
+            x = (attn @ v).transpose(1, 2).reshape(B_, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -211,27 +278,13 @@ class SwinTransformerBlock(nn.Module):
         if self.shift_size > 0:
             # calculate attention mask for SW-MSA
             H, W = self.input_resolution
-            img_mask = torch.zeros((1, H, W, 1))  # 1 H W 1
-            h_slices = (slice(0, -self.window_size),
-                        slice(-self.window_size, -self.shift_size),
-                        slice(-self.shift_size, None))
-            w_slices = (slice(0, -self.window_size),
-                        slice(-self.window_size, -self.shift_size),
-                        slice(-self.shift_size, None))
-            cnt = 0
-            for h in h_slices:
-                for w in w_slices:
-                    img_mask[:, h, w, :] = cnt
-                    cnt += 1
-
-            mask_windows = window_partition(img_mask, self.window_size)  # nW, window_size, window_size, 1
-            mask_windows = mask_windows.view(-1, self.window_size * self.window_size)
-            attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-            attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+            attn_mask = compute_mask(H, W, self.window_size, self.shift_size)
         else:
             attn_mask = None
 
         self.register_buffer("attn_mask", attn_mask)
+        # masks of the other (padded) resolutions, keyed by (H, W, device)
+        self.mask_cache = {}
 
         ## condition from LR
         self.condition_attention = nn.Sequential(
@@ -244,8 +297,18 @@ class SwinTransformerBlock(nn.Module):
         zero_module(self.condition_attention)
         zero_module(self.condition_ffn)
 
-    def forward(self, x, condition=None):
-        H, W = self.input_resolution
+    def get_mask(self, H, W, device):
+        if self.shift_size == 0:
+            return None
+        if (H, W) == tuple(self.input_resolution):
+            return self.attn_mask
+        key = (H, W, device)
+        if key not in self.mask_cache:
+            self.mask_cache[key] = compute_mask(H, W, self.window_size, self.shift_size, device=device)
+        return self.mask_cache[key]
+
+    def forward(self, x, condition=None, hw=None):
+        H, W = hw or self.input_resolution
         B, L, C = x.shape
         assert L == H * W, "input feature has wrong size"
 
@@ -262,7 +325,12 @@ class SwinTransformerBlock(nn.Module):
             x = x*condition_attn_multiplication + condition_attn_multiplication
             x = x.permute(0, 2, 3, 1)
 
-
+        # pad the feature map to multiples of the window size
+        pad_b = (self.window_size - H % self.window_size) % self.window_size
+        pad_r = (self.window_size - W % self.window_size) % self.window_size
+        if pad_b or pad_r:
+            x = F.pad(x, (0, 0, 0, pad_r, 0, pad_b))
+        Hp, Wp = H + pad_b, W + pad_r
 
         # cyclic shift
         if self.shift_size > 0:
@@ -275,17 +343,19 @@ class SwinTransformerBlock(nn.Module):
         x_windows = x_windows.view(-1, self.window_size * self.window_size, C)  # nW*B, window_size*window_size, C
 
         # W-MSA/SW-MSA
-        attn_windows = self.attn(x_windows, mask=self.attn_mask)  # nW*B, window_size*window_size, C
+        attn_windows = self.attn(x_windows, mask=self.get_mask(Hp, Wp, x.device))  # nW*B, window_size*window_size, C
 
         # merge windows
         attn_windows = attn_windows.view(-1, self.window_size, self.window_size, C)
-        shifted_x = window_reverse(attn_windows, self.window_size, H, W)  # B H' W' C
+        shifted_x = window_reverse(attn_windows, self.window_size, Hp, Wp)  # B H' W' C
 
         # reverse cyclic shift
         if self.shift_size > 0:
             x = torch.roll(shifted_x, shifts=(self.shift_size, self.shift_size), dims=(1, 2))
         else:
             x = shifted_x
+        if pad_b or pad_r:
+            x = x[:, :H, :W, :].contiguous()
         x = x.view(B, H * W, C)
 
         # FFN
@@ -344,16 +414,17 @@ class PatchMerging(nn.Module):
         self.reduction = nn.Linear(4 * dim, 2 * dim, bias=False)
         self.norm = norm_layer(4 * dim)
 
-    def forward(self, x):
+    def forward(self, x, hw=None):
         """
         x: B, H*W, C
         """
-        H, W = self.input_resolution
+        H, W = hw or self.input_resolution
         B, L, C = x.shape
         assert L == H * W, "input feature has wrong size"
-        assert H % 2 == 0 and W % 2 == 0, f"x size ({H}*{W}) are not even."
 
         x = x.view(B, H, W, C)
+        if H % 2 or W % 2:
+            x = F.pad(x, (0, 0, 0, W % 2, 0, H % 2))
 
         x0 = x[:, 0::2, 0::2, :]  # B H/2 W/2 C
         x1 = x[:, 1::2, 0::2, :]  # B H/2 W/2 C
@@ -425,14 +496,14 @@ class BasicLayer(nn.Module):
         else:
             self.downsample = None
 
-    def forward(self, x, condition=None):
+    def forward(self, x, condition=None, hw=None):
         for blk in self.blocks:
             if self.use_checkpoint:
-                x = checkpoint.checkpoint(blk, x)
+                x = checkpoint.checkpoint(blk, x, condition, hw)
             else:
-                x = blk(x, condition=condition)
+                x = blk(x, condition=condition, hw=hw)
         if self.downsample is not None:
-            x = self.downsample(x)
+            x = self.downsample(x, hw)
         return x
 
     def extra_repr(self) -> str:
@@ -479,9 +550,8 @@ class PatchEmbed(nn.Module):
 
     def forward(self, x):
         B, C, H, W = x.shape
-        # FIXME look at relaxing size constraints
-        assert H == self.img_size[0] and W == self.img_size[1], \
-            f"Input image size ({H}*{W}) doesn't match model ({self.img_size[0]}*{self.img_size[1]})."
+        assert H % self.patch_size[0] == 0 and W % self.patch_size[1] == 0, \
+            f"Input image size ({H}*{W}) is not a multiple of the patch size {self.patch_size}."
         x = self.proj(x).flatten(2).transpose(1, 2)  # B Ph*Pw C
         if self.norm is not None:
             x = self.norm(x)
@@ -596,14 +666,33 @@ class SwinTransformer(nn.Module):
     def no_weight_decay_keywords(self):
         return {'relative_position_bias_table'}
 
+    def freeze(self, frozen=True):
+        """
+        Inference-only mode for a fixed feature extractor (RAMContrastLoss): eval mode, no parameter
+        gradients, and the relative position bias and shift masks are built once per resolution.
+        """
+        for param in self.parameters():
+            param.requires_grad = not frozen
+        if frozen:
+            self.eval()
+        for module in self.modules():
+            if isinstance(module, WindowAttention):
+                module.frozen = frozen
+                module.bias_cache = {}
+        return self
+
     def forward(self, x, idx_to_group_img=None, image_atts=None, condition=None, **kwargs):
+        # any multiple of the patch size, the stages pad to the window size, so inputs need not be img_size
+        hw = (x.shape[2] // self.patch_embed.patch_size[0], x.shape[3] // self.patch_embed.patch_size[1])
         x = self.patch_embed(x)
         if self.ape:
             x = x + self.absolute_pos_embed
         x = self.pos_drop(x)
 
         for layer in self.layers:
-            x = layer(x, condition=condition)
+            x = layer(x, condition=condition, hw=hw)
+            if layer.downsample is not None:
+                hw = ((hw[0] + 1) // 2, (hw[1] + 1) // 2)
 
         x = self.norm(x)  # B L C
 
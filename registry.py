@@ -0,0 +1,88 @@
+import os
+import json
+import importlib
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# Every entry is 'module:attribute'. The module is imported only when the entry is built, so a run
+# pays for the Mamba / SAM / RAM stacks only when its config selects them.
+
+# model class -> module that defines it
+MODEL_MODULES = {
+    'AIMnet': 'model',
+    'RetinexFormer': 'model_retinexformer',
+    'RetinexFormerWithGrad': 'model_retinexformer',
+    'lowlightnet3': 'model_mnnet',
+    'CMTNet': 'model_CMTNet',
+    'CMTNetWithGrad': 'model_CMTNet',
+    'DCENet': 'model_DCENet',
+    'RetinexMamba': 'model_retinexmamba',
+    'MambaLowlight': 'model_mamba_lowlight',
+    'EnlightenMamba': 'model_enlightenmamba',
+    'MambaIR': 'model_mambair',
+}
+
+REGISTRY = {
+    'model': {name: '%s:%s' % (module, name) for name, module in MODEL_MODULES.items()},
+    'trainer': {
+        'Trainer': 'trainer:Trainer',
+        'TrainerWithGrad': 'trainer_with_grad:TrainerWithGrad',
+        'TrainerWithGradTV': 'trainer_with_grad_tvloss:TrainerWithGrad',
+        'TrainerWithGradRAMPerceptual': 'trainer_with_grad_ramperceputal:TrainerWithGrad',
+        'TrainerWithGradSAMPerceptual': 'trainer_with_grad_samperceputal:TrainerWithGrad',
+        'TrainerWithGradQAlignBank': 'trainer_with_grad_with_qalignbank:TrainerWithGrad',
+        'TrainerWithGan': 'trainer_with_gan:Trainer',
+        'TrainerWithGanAndGrad': 'trainer_with_gan_and_grad:Trainer',
+    },
+    # dataset_simple reads input/GT pairs, dataset_all also the LA maps (AIMnet)
+    'dataset': {
+        'simple': 'dataset_simple',
+        'all': 'dataset_all',
+    },
+    'loss': {
+        'contrast': 'loss.contrast:ContrastLoss',
+        'sam_contrast': 'loss.sam_contrast:SAMContrastLoss',
+        'ram_contrast': 'loss.ram_contrast:RAMContrastLoss',
+    },
+}
+
+
+def resolve(kind, name):
+    """ Import and return the object registered as `name` under `kind` """
+    if name not in REGISTRY[kind]:
+        raise KeyError('unknown %s %r, choose from %s' % (kind, name, ', '.join(sorted(REGISTRY[kind]))))
+    module, _, attr = REGISTRY[kind][name].partition(':')
+    module = importlib.import_module(module)
+    return getattr(module, attr) if attr else module
+
+
+def build(kind, name, *args, **kwargs):
+    return resolve(kind, name)(*args, **kwargs)
+
+
+def load_config(path):
+    """ Flat dict of train.py arguments from a .json or .yaml/.yml file """
+    with open(path) as f:
+        if os.path.splitext(path)[1] in ('.yaml', '.yml'):
+            if yaml is None:
+                raise ImportError('PyYAML is needed to read %s, or use a .json config' % path)
+            return yaml.safe_load(f) or {}
+        return json.load(f)
+
+
+class LazyMetric():
+    """ pyiqa metric that is imported and created on its first call, on the GPU like the trainers expect """
+
+    def __init__(self, name, **kwargs):
+        self.name = name
+        self.kwargs = kwargs
+        self.metric = None
+
+    def __call__(self, *args, **kwargs):
+        if self.metric is None:
+            import pyiqa
+            self.metric = pyiqa.create_metric(self.name, **self.kwargs).cuda()
+        return self.metric(*args, **kwargs)
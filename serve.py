@@ -0,0 +1,370 @@
+import io
+import os
+import json
+import time
+import queue
+import base64
+import socket
+import argparse
+import threading
+import email.policy
+from email.parser import BytesParser
+from collections import deque
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import torch
+from PIL import Image
+from inference import Enhancer
+
+
+def decode_image(data):
+    """ encoded image bytes -> 3,h,w float tensor in [0, 1] """
+    arr = np.asarray(Image.open(io.BytesIO(data)).convert('RGB'), dtype=np.float32) / 255
+    return torch.from_numpy(arr).permute(2, 0, 1)
+
+
+def _decode_pair(image, la):
+    """ encoded image and optional LA map -> tensors, ValueError if either is not a readable image """
+    try:
+        image = decode_image(image)
+        la = decode_image(la) if la is not None else None
+    except Exception as e:
+        raise ValueError('cannot decode the image: %s' % e)
+    if la is not None and la.shape != image.shape:
+        raise ValueError('la is %dx%d, the image %dx%d' % (la.shape[1], la.shape[2], image.shape[1], image.shape[2]))
+    return image, la
+
+
+def encode_png(tensor):
+    arr = (tensor.clamp(0, 1).permute(1, 2, 0).numpy() * 255).round().astype(np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(arr).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+class Metrics():
+    """ Request, batch and latency counters of the engine, thread-safe """
+
+    def __init__(self, window=60.0):
+        self.window = window
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.images = 0
+        self.model_pixels = 0
+        self.pixels = 0
+        self.latencies = deque(maxlen=2000)
+        self.recent = deque()
+
+    def batch(self, n, pixels, model_pixels):
+        with self.lock:
+            self.batches += 1
+            self.images += n
+            self.pixels += pixels
+            self.model_pixels += model_pixels
+
+    def done(self, latency, error=False):
+        now = time.time()
+        with self.lock:
+            self.requests += 1
+            self.errors += error
+            self.latencies.append(latency)
+            self.recent.append(now)
+            while self.recent and self.recent[0] < now - self.window:
+                self.recent.popleft()
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+            uptime = time.time() - self.start
+            return {'uptime_s': uptime, 'requests': self.requests, 'errors': self.errors, 'batches': self.batches,
+                    'mean_batch': self.images / self.batches if self.batches else 0.0,
+                    'resize_overhead': self.model_pixels / self.pixels - 1 if self.pixels else 0.0,
+                    'images_per_s': len(self.recent) / min(self.window, max(uptime, 1e-6)),
+                    'latency_ms': {'p50': float(np.percentile(latencies, 50)),
+                                   'p95': float(np.percentile(latencies, 95)),
+                                   'max': float(latencies.max())}}
+
+
+class _Request():
+    def __init__(self, image, la, key):
+        self.image = image
+        self.la = la
+        self.key = key
+        self.future = Future()
+        self.time = time.perf_counter()
+
+
+class BatchingEngine():
+    """
+    Runs an Enhancer on batches coalesced from concurrent submit() calls. The first request of a
+    batch waits at most `max_latency` seconds for others; requests are grouped by the size the
+    Enhancer resizes them to (Enhancer.model_size), so images of similar size share a forward and
+    every result equals a single-image Enhancer call. No padding: the attention of RetinexFormer
+    is global, padded borders would change the output.
+    """
+
+    def __init__(self, enhancer, max_batch=8, max_latency=0.01):
+        self.enhancer = enhancer
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.metrics = Metrics()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, name='batching-engine', daemon=True)
+        self.thread.start()
+
+    def _key(self, image, la):
+        return self.enhancer.model_size(*image.shape[-2:]) + (la is not None,)
+
+    def submit(self, image, la=None):
+        """ :param image: 3,h,w in [0, 1] :return: Future of the 3,h,w enhanced image on the CPU """
+        request = _Request(image, la, self._key(image, la))
+        self.queue.put(request)
+        return request.future
+
+    def __call__(self, image, la=None):
+        return self.submit(image, la).result()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _collect(self, first):
+        pending = [first]
+        deadline = first.time + self.max_latency
+        while len(pending) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                self.queue.put(None)
+                break
+            pending.append(request)
+        return pending
+
+    def _loop(self):
+        while True:
+            first = self.queue.get()
+            if first is None:
+                return
+            groups = {}
+            for request in self._collect(first):
+                groups.setdefault(request.key, []).append(request)
+            for (h, w, _), requests in groups.items():
+                self._run(requests, h, w)
+
+    def _run(self, requests, h, w):
+        try:
+            las = [r.la for r in requests] if requests[0].la is not None else None
+            out = self.enhancer.enhance_list([r.image for r in requests], las)
+        except Exception as e:
+            for r in requests:
+                r.future.set_exception(e)
+                self.metrics.done(time.perf_counter() - r.time, error=True)
+            return
+        self.metrics.batch(len(requests), sum(r.image.shape[-2] * r.image.shape[-1] for r in requests),
+                           len(requests) * h * w)
+        for r, o in zip(requests, out):
+            r.future.set_result(o.cpu())
+            self.metrics.done(time.perf_counter() - r.time)
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    GET  /health          {"status": "ok", ...}
+    GET  /metrics         Metrics.summary()
+    POST /enhance         encoded image in, PNG out; multipart/form-data with 'image' and 'la' parts for AIMnet
+    POST /enhance_stream  json lines {"id", "image": base64[, "la": base64]} in, the results streamed back as
+                          json lines {"id", "image": base64 PNG} (or {"id", "error"}) in completion order
+    """
+    protocol_version = 'HTTP/1.1'
+    engine = None
+    info = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, code, body, content_type='application/json'):
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_GET(self):
+        if self.path == '/health':
+            alive = self.engine.thread.is_alive()
+            self._send(200 if alive else 503, dict(self.info, status='ok' if alive else 'down',
+                                                   queue=self.engine.queue.qsize()))
+        elif self.path == '/metrics':
+            self._send(200, self.engine.metrics.summary())
+        else:
+            self._send(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        if self.path == '/enhance':
+            try:
+                image, la = self._enhance_body()
+            except ValueError as e:
+                return self._send(400, {'error': str(e)})
+            try:
+                self._send(200, encode_png(self.engine(image, la)), 'image/png')
+            except Exception as e:
+                self._send(500, {'error': str(e)})
+        elif self.path == '/enhance_stream':
+            try:
+                items = self._stream_body()
+            except ValueError as e:
+                return self._send(400, {'error': str(e)})
+            self._stream(items)
+        else:
+            self._send(404, {'error': 'unknown path %s' % self.path})
+
+    def _enhance_body(self):
+        """ the raw image, or multipart/form-data with an 'image' and an optional 'la' part """
+        body = self._body()
+        content_type = self.headers.get('Content-Type', '')
+        if not content_type.startswith('multipart/form-data'):
+            return _decode_pair(body, None)
+        message = BytesParser(policy=email.policy.HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        parts = {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+                 for part in message.iter_parts()} if message.is_multipart() else {}
+        if 'image' not in parts:
+            raise ValueError("multipart body without an 'image' part")
+        return _decode_pair(parts['image'], parts.get('la'))
+
+    def _stream_body(self):
+        """ all json lines decoded up front, so a bad line fails the request before anything runs """
+        items = []
+        for number, line in enumerate(self._body().splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                image, la = _decode_pair(base64.b64decode(item['image']),
+                                         base64.b64decode(item['la']) if item.get('la') else None)
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError('line %d: %s: %s' % (number, type(e).__name__, e))
+            items.append((item.get('id'), image, la))
+        return items
+
+    def _stream(self, items):
+        results = queue.Queue()
+        for id, image, la in items:
+            self.engine.submit(image, la).add_done_callback(lambda f, id=id: results.put((id, f)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for _ in range(len(items)):
+            id, future = results.get()
+            try:
+                result = {'id': id, 'image': base64.b64encode(encode_png(future.result())).decode()}
+            except Exception as e:
+                result = {'id': id, 'error': str(e)}
+            line = (json.dumps(result) + '\n').encode()
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        self.socket.bind(self.server_address)
+        self.server_name, self.server_port = 'localhost', 0
+
+    def get_request(self):
+        request, _ = self.socket.accept()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('unix', 0)
+
+
+def create_server(engine, host='127.0.0.1', port=8080, socket_path=None, info=None):
+    """ HTTP server on host:port, or on the Unix socket `socket_path`; serve_forever() it """
+    handler = type('BoundHandler', (Handler,), {'engine': engine, 'info': dict(info or {})})
+    if socket_path is not None:
+        return UnixHTTPServer(socket_path, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def _selftest(engine, socket_path, requests=16):
+    """ concurrent requests of mixed sizes through the client stub, checked against one forward per image """
+    from concurrent.futures import ThreadPoolExecutor
+    from enhance_client import EnhanceClient
+
+    client = EnhanceClient(socket_path=socket_path)
+    print('health', client.health())
+    sizes = [(96, 128), (100, 120), (128, 128), (64, 80)]
+    images = [torch.rand(3, *sizes[i % len(sizes)]) for i in range(requests)]
+    encoded = [encode_png(img) for img in images]
+    with ThreadPoolExecutor(8) as pool:
+        outputs = list(pool.map(client.enhance, encoded))
+    worst = 0.0
+    for img, data in zip(images, outputs):
+        # the same quantized input through the enhancer alone, as test.py / inference.py run it;
+        # batched convolutions may differ in the last float bits, which rounds away in the PNG
+        x = decode_image(encode_png(img))
+        ref = decode_image(encode_png(engine.enhancer(x[None])[0].cpu()))
+        worst = max(worst, (decode_image(data) - ref).abs().max().item())
+    print('%d concurrent requests, max difference to single-image inference %.4f' % (requests, worst))
+    streamed = list(client.enhance_stream(encoded[:4]))
+    print('streamed ids', [r['id'] for r in streamed])
+    print('metrics', json.dumps(client.metrics()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local enhancement server with dynamic batching')
+    parser.add_argument('--weights', default=None, type=str, help='exported .pth or training checkpoint, '
+                                                                  'random weights when omitted (testing)')
+    parser.add_argument('--model', default='RetinexFormer', type=str, help='model class')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8080, type=int)
+    parser.add_argument('--socket', default=None, type=str, help='serve on this Unix socket instead of TCP')
+    parser.add_argument('--max_batch', default=8, type=int)
+    parser.add_argument('--max_latency_ms', default=10.0, type=float, help='wait of the first request of a batch')
+    parser.add_argument('--selftest', action='store_true', help='serve on a temporary socket and run the client stub')
+    args = parser.parse_args()
+
+    if args.weights is None:
+        from registry import build
+        enhancer = Enhancer(build('model', args.model), device=args.device)
+    else:
+        enhancer = Enhancer.from_path(args.weights, model_name=args.model, device=args.device)
+    engine = BatchingEngine(enhancer, args.max_batch, args.max_latency_ms / 1000)
+    if args.selftest:
+        args.socket = '/tmp/enhance_selftest_%d.sock' % os.getpid()
+    server = create_server(engine, args.host, args.port, args.socket,
+                           info={'model': args.model, 'weights': args.weights, 'device': args.device})
+    if args.selftest:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            _selftest(engine, args.socket)
+        finally:
+            server.shutdown()
+            engine.close()
+            os.remove(args.socket)
+    else:
+        print('serving %s on %s' % (args.model, args.socket or '%s:%d' % (args.host, args.port)))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            engine.close()
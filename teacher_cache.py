@@ -0,0 +1,94 @@
+import numpy as np
+import torch
+import torch.utils.data as data
+
+
+class IndexedDataset(data.Dataset):
+    """ Appends the sample index to every item of `dataset`, the key of the TeacherCache """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getattr__(self, name):
+        # A_paths, fineSize, ... of the wrapped dataset
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __getitem__(self, index):
+        return tuple(self.dataset[index]) + (index,)
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class TeacherCache():
+    """
+    Teacher predictions of the unlabeled samples, stored per sample index in a memory-mapped fp16 file.
+    The weak view of an unlabeled sample is only resized, so between refreshes the teacher output
+    changes only as much as the EMA weights do. An entry is recomputed when it is older than
+    `refresh_every` steps or when the teacher drifted more than `max_drift` since it was written;
+    otherwise the stored prediction is served and the teacher forward is skipped.
+    Drift is the summed relative L2 size of the EMA updates, an upper bound of ||θ_now - θ_then|| / ||θ||.
+    :param path: file of the store, allocated on the first batch as (num_samples, C, H, W) fp16
+    """
+
+    def __init__(self, path, num_samples, refresh_every=100, max_drift=0.01):
+        self.path = path
+        self.num_samples = num_samples
+        self.refresh_every = refresh_every
+        self.max_drift = max_drift
+        self.store = None
+        self.written = np.full(num_samples, -1, dtype=np.int64)
+        self.drift_at = np.zeros(num_samples, dtype=np.float64)
+        self.drift = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    @torch.no_grad()
+    def add_drift(self, teacher_params, student_params, alpha):
+        """ Account for the EMA update teacher = alpha * teacher + (1 - alpha) * student, call it before the update """
+        teacher_params = list(teacher_params)
+        diff = torch.stack([(p.data - t.data).float().norm() for t, p in zip(teacher_params, student_params)]).norm()
+        norm = torch.stack([t.data.float().norm() for t in teacher_params]).norm()
+        self.drift += (1 - alpha) * (diff / norm.clamp_min(1e-12)).item()
+
+    def predict(self, ids, images, teacher, step):
+        """
+        :param ids: sample indices of the batch (IndexedDataset)
+        :param images: b,c,h,w weak views on the training device
+        :param teacher: callable running the teacher on a batch, e.g. Trainer.predict_with_out_grad
+        :param step: current iteration, the age of the entries is counted in it
+        """
+        if ids is None:
+            raise ValueError('the teacher cache needs the sample index, wrap the unlabeled dataset in IndexedDataset')
+        ids = torch.as_tensor(ids).cpu().numpy()
+        if self.store is None:
+            self.store = np.lib.format.open_memmap(self.path, mode='w+', dtype=np.float16,
+                                                   shape=(self.num_samples,) + tuple(images.shape[1:]))
+        written = self.written[ids]
+        stale = (written < 0) | (step - written >= self.refresh_every) | \
+                (self.drift - self.drift_at[ids] > self.max_drift)
+        out = torch.empty_like(images)
+        if stale.any():
+            idx = np.nonzero(stale)[0]
+            rows = torch.as_tensor(idx, device=images.device)
+            fresh = teacher(images[rows])
+            out[rows] = fresh.to(out.dtype)
+            self.store[ids[idx]] = fresh.half().cpu().numpy()
+            self.written[ids[idx]] = step
+            self.drift_at[ids[idx]] = self.drift
+        if not stale.all():
+            hit = np.nonzero(~stale)[0]
+            cached = torch.from_numpy(self.store[ids[hit]])
+            out[torch.as_tensor(hit, device=images.device)] = cached.to(images.device).to(out.dtype)
+        self.hits += int((~stale).sum())
+        self.misses += int(stale.sum())
+        return out
+
+    def hit_rate(self, reset=True):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        if reset:
+            self.hits = self.misses = 0
+        return rate
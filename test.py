@@ -1,36 +1,28 @@
 import os
 import torch
-import torch.nn as nn
 from torch.autograd import Variable
 import torch.utils.data as data
 import numpy as np
 from PIL import Image
-from adamp import AdamP
 # my import
-from model import AIMnet
 from dataset_simple import TestData
-from model_retinexformer import RetinexFormer
+from export_model import load_inference
 #os.environ["CUDA_VISIBLE_DEVICES"] = "0,1"
 
 bz = 1
 #model_root = 'pretrained/model.pth'
-model_root = 'model/lol_ckpt_begin_0404/model_e200.pth'
+# exported by export_model.py, e.g.
+# python export_model.py --checkpoint model/lol_ckpt_begin_0404/model_e200.pth --model RetinexFormer --out model/lol_ckpt_begin_0404/inference.pth
+model_root = 'model/lol_ckpt_begin_0404/inference.pth'
 input_root = 'data/LOLv1/val'
 save_path = 'result/lol_ckpt_begin_0404/'
 if not os.path.isdir(save_path):
     os.makedirs(save_path)
-checkpoint = torch.load(model_root)
 Mydata_ = TestData(input_root)
 data_load = data.DataLoader(Mydata_, batch_size=bz)
 
-#model = AIMnet().cuda()
-model = RetinexFormer().cuda()
-model = nn.DataParallel(model, device_ids=[0, 1])
-optimizer = AdamP(model.parameters(), lr=2e-4, betas=(0.9, 0.999), weight_decay=1e-4)
-model.load_state_dict(checkpoint['state_dict'])
-optimizer.load_state_dict(checkpoint['optimizer_dict'])
-epoch = checkpoint['epoch']
-model.eval()
+# the architecture comes from the artifact, a training checkpoint would also need model_name
+model = load_inference(model_root, device='cuda')
 print('START!')
 if 1:
     print('Load model successfully!')
@@ -1,29 +1,46 @@
 import os
+import json
 import argparse
 from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 # my import
-#from dataset_all import TrainLabeled, TrainUnlabeled, ValLabeled
-from dataset_simple import TrainLabeled, TrainUnlabeled, ValLabeled, TrainUnlabeledOrignAug
-
-from model import AIMnet
 from utils import *
-from trainer import Trainer
-from trainer_with_grad import TrainerWithGrad
-from model_retinexformer import RetinexFormerWithGrad
-from model_mnnet import lowlightnet3
+from registry import REGISTRY, resolve, build, load_config
+from teacher_cache import IndexedDataset
+from adaptive_sampler import AdaptiveSampler
+from activation_checkpoint import set_activation_checkpointing
+import image_io
+import manifest
+
+# flags that only some trainers implement -> trainer class attribute that marks the support
+TRAINER_FEATURES = {
+    'teacher_cache_every': 'supports_teacher_cache',
+    'adaptive_min_rate': 'supports_adaptive_sampler',
+    'save_iter_period': 'supports_checkpoint_manager',
+    'keep_last': 'supports_checkpoint_manager',
+}
+
 
 def main(gpu, args):
     args.local_rank = gpu
     # random seed
     setup_seed(2022)
-    # load data
+    image_io.DRAFT_MARGIN = args.jpeg_draft_margin
+    manifest.VERIFY = args.verify_manifest
+    # load data, model and trainer are imported from the registry on demand
+    dataset = resolve('dataset', args.dataset)
     train_folder = args.data_dir
-    paired_dataset = TrainLabeled(dataroot=train_folder, phase='labeled', finesize=args.crop_size)
-    unpaired_dataset = TrainUnlabeledOrignAug(dataroot=train_folder, phase='unlabeled', finesize=args.crop_size)
-    val_dataset = ValLabeled(dataroot=train_folder, phase='val', finesize=args.crop_size)
+    paired_dataset = dataset.TrainLabeled(dataroot=train_folder, phase='labeled', finesize=args.crop_size)
+    unpaired_dataset = getattr(dataset, args.unlabeled_dataset)(dataroot=train_folder, phase='unlabeled',
+                                                                finesize=args.crop_size)
+    if args.teacher_cache_every or args.adaptive_min_rate:
+        unpaired_dataset = IndexedDataset(unpaired_dataset)
+    val_dataset = dataset.ValLabeled(dataroot=train_folder, phase='val', finesize=args.crop_size)
     paired_sampler = None
     unpaired_sampler = None
+    if args.adaptive_min_rate:
+        unpaired_sampler = AdaptiveSampler(len(unpaired_dataset), min_rate=args.adaptive_min_rate,
+                                           patience=args.adaptive_patience)
     val_sampler = None
     paired_loader = DataLoader(paired_dataset, batch_size=args.train_batchsize, sampler=paired_sampler)
     unpaired_loader = DataLoader(unpaired_dataset, batch_size=args.train_batchsize, sampler=unpaired_sampler)
@@ -31,18 +48,19 @@ def main(gpu, args):
     print('there are total %s batches for train' % (len(paired_loader)))
     print('there are total %s batches for val' % (len(val_loader)))
     # create model
-    #net = AIMnet()
-    #ema_net = AIMnet()
-    
-    net = lowlightnet3()
-    ema_net = lowlightnet3()
+    net = build('model', args.model, **args.model_args)
+    ema_net = build('model', args.model, **args.model_args)
     ema_net = create_emamodel(ema_net)
     print('student model params: %d' % count_parameters(net))
+    if args.activation_checkpoint:
+        # student only, the EMA teacher runs under no_grad and keeps no activations anyway
+        stages = set_activation_checkpointing(net, args.activation_checkpoint)
+        print('activation checkpointing: %s' % ', '.join(stages))
     # tensorboard
     writer = SummaryWriter(log_dir=args.log_dir)
-    trainer = TrainerWithGrad(model=net, tmodel=ema_net, args=args, supervised_loader=paired_loader,
-                      unsupervised_loader=unpaired_loader,
-                      val_loader=val_loader, iter_per_epoch=len(unpaired_loader), writer=writer)
+    trainer = build('trainer', args.trainer, model=net, tmodel=ema_net, args=args, supervised_loader=paired_loader,
+                    unsupervised_loader=unpaired_loader,
+                    val_loader=val_loader, iter_per_epoch=len(unpaired_loader), writer=writer)
 
     trainer.train()
     writer.close()
@@ -50,6 +68,14 @@ def main(gpu, args):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Training')
+    parser.add_argument('--config', default=None, type=str, help='.json/.yaml file of argument defaults, see configs/')
+    parser.add_argument('--model', default='lowlightnet3', type=str, choices=sorted(REGISTRY['model']))
+    parser.add_argument('--model_args', default={}, type=json.loads, help='model constructor kwargs as json')
+    parser.add_argument('--trainer', default='TrainerWithGrad', type=str, choices=sorted(REGISTRY['trainer']))
+    parser.add_argument('--dataset', default='simple', type=str, choices=sorted(REGISTRY['dataset']))
+    parser.add_argument('--unlabeled_dataset', default='TrainUnlabeledOrignAug', type=str,
+                        help='unlabeled dataset class of the dataset module')
+    parser.add_argument('--contrast_loss', default='ram_contrast', type=str, choices=sorted(REGISTRY['loss']))
     parser.add_argument('-g', '--gpus', default=2, type=int, metavar='N')
     parser.add_argument('--num_epochs', default=200, type=int)
     parser.add_argument('--train_batchsize', default=8, type=int, help='train batchsize')
@@ -63,8 +89,50 @@ if __name__ == '__main__':
     parser.add_argument('--save_path', default='./model/ckpt_begin_0510_on_Visdrone/', type=str)
     parser.add_argument('--log_dir', default='./model/log', type=str)
     parser.add_argument('--start_epoch', default=1, type=int)
+    parser.add_argument('--save_iter_period', default=0, type=int, help='mid-epoch checkpoint every N iterations, 0 disables')
+    parser.add_argument('--keep_last', default=None, type=int, help='number of epoch checkpoints to keep')
+    parser.add_argument('--fused_forward', action='store_true', help='one student forward over labeled + unlabeled batches')
+    parser.add_argument('--teacher_cache_every', default=0, type=int,
+                        help='reuse teacher predictions of unlabeled samples for up to N steps, 0 disables')
+    parser.add_argument('--teacher_cache_drift', default=0.01, type=float,
+                        help='also refresh a cached prediction once the EMA teacher drifted this much (relative L2)')
+    parser.add_argument('--gan_d_every', default=1, type=int,
+                        help='GAN trainers: update D every N iterations. D is now stepped after the generator '
+                             'backward, not before it as in the previous trainers')
+    parser.add_argument('--gan_d_steps', default=1, type=int, help='GAN trainers: D updates per D iteration')
+    parser.add_argument('--gan_reg', default='none', type=str, choices=['r1', 'gp', 'none'],
+                        help='D regularization, off by default')
+    parser.add_argument('--gan_reg_every', default=4, type=int, help='lazy regularization interval in D updates')
+    parser.add_argument('--gan_reg_weight', default=10.0, type=float)
+    parser.add_argument('--gan_amp', action='store_true', help='run the D-only forwards in mixed precision, the one giving the generator loss stays fp32')
+    parser.add_argument('--jpeg_draft_margin', default=image_io.DRAFT_MARGIN, type=int,
+                        help='decode JPEGs at >= this multiple of the load size before resizing, 0 for full decode')
+    parser.add_argument('--adaptive_min_rate', default=0.0, type=float,
+                        help='with TrainUnlabeledWithBank: revisit rate of unlabeled samples whose bank candidate '
+                             'settled, 0 visits every sample every epoch, see adaptive_sampler.py')
+    parser.add_argument('--adaptive_patience', default=3, type=int,
+                        help='visits without a bank replacement before a sample can settle')
+    parser.add_argument('--verify_manifest', action='store_true',
+                        help='stat every indexed image instead of the folders only, see manifest.py')
+    parser.add_argument('--activation_checkpoint', default=None, type=str,
+                        help="recompute these stages in backward: 'all', class names (IGAB, VSSLayer, ResidualGroup) "
+                             "or module names, see activation_checkpoint.py")
+    parser.add_argument('--profile', action='store_true', help='per-iteration timers and memory, see profiling.py')
+    parser.add_argument('--profile_trace', default=None, type=str, help='also write a torch.profiler trace to this dir')
 
+    # the config replaces the defaults, arguments given on the command line still win
+    config_path = parser.parse_known_args()[0].config
+    if config_path is not None:
+        config = load_config(config_path)
+        unknown = set(config) - {action.dest for action in parser._actions}
+        if unknown:
+            parser.error('unknown keys in %s: %s' % (config_path, ', '.join(sorted(unknown))))
+        parser.set_defaults(**config)
     args = parser.parse_args()
+    trainer_class = resolve('trainer', args.trainer)
+    for flag, feature in TRAINER_FEATURES.items():
+        if getattr(args, flag) and not getattr(trainer_class, feature, False):
+            parser.error('--%s is not supported by the %s trainer' % (flag, args.trainer))
     if not os.path.isdir(args.save_path):
         os.makedirs(args.save_path)
     main(-1, args)
@@ -1,28 +1,37 @@
+import os
 import torch
 import numpy as np
 from tqdm import tqdm
 import torch.nn as nn
-from itertools import cycle
 import torchvision
 import torch.distributed as dist
 from torch.optim import lr_scheduler
 import PIL.Image as Image
 from utils import *
+from data_stream import InfiniteLoader, iter_from
 from torch.autograd import Variable
 from adamp import AdamP
 from torchvision.models import vgg16
 from loss.losses import *
-from model import GetGradientNopadding
-from loss.contrast import ContrastLoss
-from loss.sam_contrast import SAMContrastLoss
-from loss.ram_contrast import RAMContrastLoss
-import pyiqa
+from registry import build, LazyMetric
+from profiling import Profiler
+from fused_forward import fused_forward, convert_branch_norm
+from teacher_cache import TeacherCache, IndexedDataset
+from adaptive_sampler import AdaptiveSampler
+from checkpoint import CheckpointManager, load_checkpoint, trainer_state, restore_trainer, set_rng_state
 
 
 class Trainer:
+    # optional features train.py may enable for this trainer, see train.TRAINER_FEATURES
+    supports_teacher_cache = True
+    supports_adaptive_sampler = True
+    supports_checkpoint_manager = True
+
     def __init__(self, model, tmodel, args, supervised_loader, unsupervised_loader, val_loader, iter_per_epoch, writer):
 
         self.supervised_loader = supervised_loader
+        # endless, reshuffled and re-augmented labeled batches, see data_stream.py
+        self.supervised_stream = InfiniteLoader(supervised_loader)
         self.unsupervised_loader = unsupervised_loader
         self.val_loader = val_loader
         self.args = args
@@ -34,32 +43,57 @@ class Trainer:
         self.start_epoch = args.start_epoch
         self.epochs = args.num_epochs
         self.save_period = 20
-        self.loss_unsup = nn.L1Loss()
-        self.loss_str = MyLoss().cuda()
-        self.loss_grad = nn.L1Loss().cuda()
-        #self.loss_cr = ContrastLoss().cuda()
-        #self.loss_cr = SAMContrastLoss().cuda()
-        self.loss_cr = RAMContrastLoss().cuda()
+        self.save_iter_period = getattr(args, 'save_iter_period', 0)
+        self.ckpt = CheckpointManager(args.save_path, keep_last=getattr(args, 'keep_last', None),
+                                      async_save=getattr(args, 'async_save', True))
+        self.start_iter = 0
+        self.resume_rng = None
+        self.best_psnr = 0.0
+        # unlabeled samples whose bank candidate stopped improving are visited less, see adaptive_sampler.py
+        sampler = getattr(unsupervised_loader, 'sampler', None)
+        self.unlabeled_sampler = sampler if isinstance(sampler, AdaptiveSampler) else None
+        # teacher predictions of the unlabeled samples reused for up to teacher_cache_every steps
+        self.teacher_cache = None
+        if getattr(args, 'teacher_cache_every', 0):
+            self.teacher_cache = TeacherCache(os.path.join(args.save_path, 'teacher_cache.npy'),
+                                              len(unsupervised_loader.dataset), args.teacher_cache_every,
+                                              getattr(args, 'teacher_cache_drift', 0.01))
+        self.profiler = Profiler(enabled=getattr(args, 'profile', False),
+                                 trace_dir=getattr(args, 'profile_trace', None),
+                                 json_path=os.path.join(args.save_path, 'profile.jsonl'))
         self.consistency = 0.2
         self.consistency_rampup = 100.0
-        self.iqa_metric = pyiqa.create_metric('musiq', as_loss=True).cuda()
-        vgg_model = vgg16(pretrained=True).features[:16]
-        vgg_model = vgg_model.cuda()
-        self.loss_per = PerpetualLoss(vgg_model).cuda()
+        # pyiqa is imported on the first get_reliable call
+        self.iqa_metric = LazyMetric('musiq', as_loss=True)
         self.curiter = 0
-        self.model.cuda()
-        self.tmodel.cuda()
         self.device, available_gpus = self._get_available_devices(self.args.gpus)
+        self.build_losses()
+        self.model.to(self.device)
+        self.tmodel.to(self.device)
+        # one student forward over the labeled + unlabeled batch, BatchNorm layers keep per-branch statistics
+        self.fused_forward = getattr(args, 'fused_forward', False)
+        self.branch_norms = convert_branch_norm(self.model) if self.fused_forward else []
         self.model = torch.nn.DataParallel(self.model, device_ids=available_gpus)
         # set optimizer and learning rate
         self.optimizer_s = AdamP(self.model.parameters(), lr=2e-4, betas=(0.9, 0.999), weight_decay=1e-4)
         # self.lr_scheduler_s = lr_scheduler.StepLR(self.optimizer_s, step_size=100, gamma=0.1)
         self.lr_scheduler_s = lr_scheduler.MultiStepLR(self.optimizer_s, milestones=[100, 150], gamma=0.1)
 
+    def build_losses(self):
+        self.loss_unsup = nn.L1Loss()
+        self.loss_str = MyLoss().to(self.device)
+        self.loss_grad = nn.L1Loss().to(self.device)
+        # 'contrast' (VGG), 'sam_contrast' or 'ram_contrast', see registry.REGISTRY['loss']
+        self.loss_cr = build('loss', getattr(self.args, 'contrast_loss', 'ram_contrast')).to(self.device)
+        vgg_model = vgg16(pretrained=True).features[:16]
+        self.loss_per = PerpetualLoss(vgg_model).to(self.device)
+
     @torch.no_grad()
     def update_teachers(self, teacher, itera, keep_rate=0.996):
         # exponential moving average(EMA)
         alpha = min(1 - 1 / (itera + 1), keep_rate)
+        if self.teacher_cache is not None:
+            self.teacher_cache.add_drift(teacher.parameters(), self.model.parameters(), alpha)
         for ema_param, param in zip(teacher.parameters(), self.model.parameters()):
             ema_param.data = (alpha * ema_param.data) + (1 - alpha) * param.data
 
@@ -73,49 +107,58 @@ class Trainer:
         for p in self.tmodel.parameters():
             p.requires_grad = False
 
-    def get_reliable(self, teacher_predict, student_predict, positive_list, p_name):
+    def get_reliable(self, teacher_predict, student_predict, positive_list, p_name, ids=None):
         N = teacher_predict.shape[0]
         score_t_list = []
         score_s_list = []
         score_r_list = []
 
-        for idx in range(0, N):
-            score_t = self.iqa_metric(teacher_predict[idx]).detach().cpu()
-            score_t_list.append(score_t)
-            score_s = self.iqa_metric(student_predict[idx]).detach().cpu()
-            score_s_list.append(score_s)
-            score_r = self.iqa_metric(positive_list[idx]).detach().cpu()
-            score_r_list.append(score_r) 
+        with self.profiler.timer('reliable'):
+            for idx in range(0, N):
+                score_t = self.iqa_metric(teacher_predict[idx]).detach().cpu()
+                score_t_list.append(score_t)
+                score_s = self.iqa_metric(student_predict[idx]).detach().cpu()
+                score_s_list.append(score_s)
+                score_r = self.iqa_metric(positive_list[idx]).detach().cpu()
+                score_r_list.append(score_r)
 
         score_t = np.array(score_t_list)
         score_s = np.array(score_s_list)
         score_r = np.array(score_r_list)
 
         positive_sample = positive_list.clone()
+        replaced = np.zeros(N, dtype=bool)
         for idx in range(0, N):
             if score_t[idx] > score_s[idx]:
                 if score_t[idx] > score_r[idx]:
                     positive_sample[idx] = teacher_predict[idx]
+                    replaced[idx] = True
                     # update the reliable bank
                     temp_c = np.transpose(teacher_predict[idx].detach().cpu().numpy(), (1, 2, 0))
                     temp_c = np.clip(temp_c, 0, 1)
                     arr_c = (temp_c*255).astype(np.uint8)
                     arr_c = Image.fromarray(arr_c)
                     arr_c.save('%s' % p_name[idx])
+        if self.unlabeled_sampler is not None and ids is not None:
+            self.unlabeled_sampler.update(ids, score_t, score_s, score_r, replaced)
         del N, score_r, score_s, score_t, teacher_predict, student_predict, positive_list
         return positive_sample
 
     def train(self):
         self.freeze_teachers_parameters()
-        if self.start_epoch == 1:
+        if self.start_epoch == 1 and self.args.resume != 'True':
             initialize_weights(self.model)
         else:
-            checkpoint = torch.load(self.args.resume_path)
-            self.model.load_state_dict(checkpoint['state_dict'])
+            checkpoint = load_checkpoint(self.args.resume_path)
+            restore_trainer(self, checkpoint)
+            if self.start_iter == 0 and self.resume_rng is not None:
+                set_rng_state(self.resume_rng)
+                self.resume_rng = None
+            del checkpoint
         for epoch in range(self.start_epoch, self.epochs + 1):
             loss_ave, psnr_train = self._train_epoch(epoch)
             loss_val = loss_ave.item() / self.args.crop_size * self.args.train_batchsize
-            train_psnr = sum(psnr_train) / len(psnr_train)
+            train_psnr = sum(psnr_train) / len(psnr_train) if psnr_train else 0.0
             psnr_val = self._valid_epoch(max(0, epoch))
             val_psnr = sum(psnr_val) / len(psnr_val)
 
@@ -126,14 +169,16 @@ class Trainer:
             #    self.writer.add_histogram(f"{name}", param, 0)
 
             # Save checkpoint
-            if epoch % self.save_period == 0 and self.args.local_rank <= 0:
-                state = {'arch': type(self.model).__name__,
-                         'epoch': epoch,
-                         'state_dict': self.model.state_dict(),
-                         'optimizer_dict': self.optimizer_s.state_dict()}
-                ckpt_name = str(self.args.save_path) + 'model_e{}.pth'.format(str(epoch))
-                print("Saving a checkpoint: {} ...".format(str(ckpt_name)))
-                torch.save(state, ckpt_name)
+            if self.args.local_rank <= 0:
+                if val_psnr > self.best_psnr:
+                    self.best_psnr = val_psnr
+                    self.ckpt.save(trainer_state(self, epoch), 'model_best', epoch, metric=val_psnr)
+                if epoch % self.save_period == 0:
+                    ckpt_name = 'model_e{}'.format(str(epoch))
+                    print("Saving a checkpoint: {} ...".format(str(self.args.save_path) + ckpt_name))
+                    self.ckpt.save(trainer_state(self, epoch), ckpt_name, epoch, metric=val_psnr, rotate=True)
+        self.ckpt.wait()
+        self.profiler.close()
 
     def _train_epoch(self, epoch):
         sup_loss = AverageMeter()
@@ -142,52 +187,99 @@ class Trainer:
         psnr_train = []
         self.model.train()
         self.freeze_teachers_parameters()
-        train_loader = iter(zip(cycle(self.supervised_loader), self.unsupervised_loader))
-        tbar = range(len(self.unsupervised_loader))
+        if self.unlabeled_sampler is not None:
+            self.unlabeled_sampler.set_epoch(epoch)
+        indexed = isinstance(self.unsupervised_loader.dataset, IndexedDataset)
+        # mid-epoch resume: the labeled stream comes back at its saved position, the unlabeled one
+        # starts after the consumed batches, then continue from the saved rng
+        unsupervised = iter_from(self.unsupervised_loader, self.start_iter)
+        train_loader = zip(self.supervised_stream, unsupervised)
+        if self.resume_rng is not None:
+            set_rng_state(self.resume_rng)
+            self.resume_rng = None
+        tbar = range(self.start_iter, len(self.unsupervised_loader))
+        self.start_iter = 0
         tbar = tqdm(tbar, ncols=130, leave=True)
+        total_loss = torch.zeros(1)
         for i in tbar:
-            (img_data, label), (unpaired_data_w, unpaired_data_s) = next(train_loader)
-            img_data = Variable(img_data).cuda(non_blocking=True)
-            label = Variable(label).cuda(non_blocking=True)
-            unpaired_data_s = Variable(unpaired_data_s).cuda(non_blocking=True)
-            unpaired_data_w = Variable(unpaired_data_w).cuda(non_blocking=True)
+            with self.profiler.timer('data'):
+                (img_data, label), unpaired = next(train_loader)
+                # IndexedDataset (teacher cache, adaptive sampler) appends the sample index,
+                # TrainUnlabeledWithBank adds the bank candidate and its path
+                unpaired_data_w, unpaired_data_s = unpaired[0], unpaired[1]
+                unpaired_ids = unpaired[-1] if indexed else None
+                bank = unpaired[2:4] if len(unpaired) - indexed >= 4 else None
+                img_data = Variable(img_data).to(self.device, non_blocking=True)
+                label = Variable(label).to(self.device, non_blocking=True)
+                unpaired_data_s = Variable(unpaired_data_s).to(self.device, non_blocking=True)
+                unpaired_data_w = Variable(unpaired_data_w).to(self.device, non_blocking=True)
             # teacher output
-            predict_target_u = self.predict_with_out_grad(unpaired_data_w)
+            with self.profiler.timer('teacher'):
+                if self.teacher_cache is None:
+                    predict_target_u = self.predict_with_out_grad(unpaired_data_w)
+                else:
+                    predict_target_u = self.teacher_cache.predict(unpaired_ids, unpaired_data_w,
+                                                                  self.predict_with_out_grad, self.curiter)
             origin_predict = predict_target_u.detach().clone()
             # student output
-            outputs_l = self.model(img_data)
-            outputs_ul= self.model(unpaired_data_s)
-            structure_loss = self.loss_str(outputs_l, label)
-            perpetual_loss = self.loss_per(outputs_l, label)
-            #get_grad = GetGradientNopadding().cuda()
-            #gradient_loss = self.loss_grad(get_grad(outputs_l), get_grad(label)) + self.loss_grad(outputs_g, get_grad(label))
-            loss_sup = structure_loss + 0.3 * perpetual_loss #+ 0.1 * gradient_loss
+            with self.profiler.timer('student'):
+                if self.fused_forward:
+                    outputs_l, outputs_ul = fused_forward(
+                        self.model, img_data, unpaired_data_s, self.branch_norms, max(1, len(self.model.device_ids)))
+                else:
+                    outputs_l = self.model(img_data)
+                    outputs_ul= self.model(unpaired_data_s)
+            with self.profiler.timer('sup_loss'):
+                structure_loss = self.loss_str(outputs_l, label)
+                perpetual_loss = self.loss_per(outputs_l, label)
+                #get_grad = GetGradientNopadding().cuda()
+                #gradient_loss = self.loss_grad(get_grad(outputs_l), get_grad(label)) + self.loss_grad(outputs_g, get_grad(label))
+                loss_sup = structure_loss + 0.3 * perpetual_loss #+ 0.1 * gradient_loss
             sup_loss.update(loss_sup.mean().item())
 
             p_sample = predict_target_u
-            loss_unsu = self.loss_unsup(outputs_ul, p_sample) + self.loss_cr(outputs_ul, p_sample, unpaired_data_s)
+            if bank is not None:
+                # the teacher output replaces the candidate where MUSIQ prefers it over student and candidate
+                p_sample = self.get_reliable(predict_target_u, outputs_ul, bank[0].to(self.device, non_blocking=True),
+                                             bank[1], unpaired_ids)
+            with self.profiler.timer('contrast'):
+                loss_cr = self.loss_cr(outputs_ul, p_sample, unpaired_data_s)
+            loss_unsu = self.loss_unsup(outputs_ul, p_sample) + loss_cr
             unsup_loss.update(loss_unsu.mean().item())
             consistency_weight = self.get_current_consistency_weight(epoch)
             total_loss = consistency_weight * loss_unsu + loss_sup
             total_loss = total_loss.mean()
             psnr_train.extend(to_psnr(outputs_l, label))
             self.optimizer_s.zero_grad()
-            total_loss.backward()
-            self.optimizer_s.step()
+            with self.profiler.timer('backward'):
+                total_loss.backward()
+            with self.profiler.timer('optimizer'):
+                self.optimizer_s.step()
 
             tbar.set_description('Train-Student Epoch {} | Ls {:.4f} Lu {:.4f}|'
                                  .format(epoch, sup_loss.avg, unsup_loss.avg))
 
             del img_data, label, unpaired_data_w, unpaired_data_s,
-            with torch.no_grad():
+            with torch.no_grad(), self.profiler.timer('ema'):
                 self.update_teachers(teacher=self.tmodel, itera=self.curiter)
                 self.curiter = self.curiter + 1
+            self.profiler.step()
+
+            if self.save_iter_period and (i + 1) % self.save_iter_period == 0 and self.args.local_rank <= 0:
+                self.ckpt.save(trainer_state(self, epoch, i + 1), 'model_last', epoch, iteration=i + 1)
 
         loss_total_ave = loss_total_ave + total_loss
 
         self.writer.add_scalar('Train_loss', total_loss, global_step=epoch)
         self.writer.add_scalar('sup_loss', sup_loss.avg, global_step=epoch)
         self.writer.add_scalar('unsup_loss', unsup_loss.avg, global_step=epoch)
+        if self.teacher_cache is not None:
+            self.writer.add_scalar('teacher_cache_hit_rate', self.teacher_cache.hit_rate(), global_step=epoch)
+        if self.unlabeled_sampler is not None:
+            for name, value in self.unlabeled_sampler.stats().items():
+                self.writer.add_scalar('unlabeled_' + name, value, global_step=epoch)
+        self.profiler.write(self.writer, epoch)
+        self.profiler.dump_json(epoch)
         self.lr_scheduler_s.step(epoch=epoch - 1)
         return loss_total_ave, psnr_train
 
@@ -201,8 +293,8 @@ class Trainer:
         tbar = tqdm(self.val_loader, ncols=130)
         with torch.no_grad():
             for i, (val_data, val_label) in enumerate(tbar):
-                val_data = Variable(val_data).cuda()
-                val_label = Variable(val_label).cuda()
+                val_data = Variable(val_data).to(self.device)
+                val_label = Variable(val_label).to(self.device)
                 # forward
                 val_output = self.model(val_data)
                 temp_psnr, temp_ssim, N = compute_psnr_ssim(val_output, val_label)
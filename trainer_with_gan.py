@@ -2,21 +2,18 @@ import torch
 import numpy as np
 from tqdm import tqdm
 import torch.nn as nn
-from itertools import cycle
 import torchvision
 import torch.distributed as dist
 from torch.optim import lr_scheduler
 import PIL.Image as Image
 from utils import *
+from data_stream import InfiniteLoader
 from torch.autograd import Variable
 from adamp import AdamP
 from torchvision.models import vgg16
 from loss.losses import *
-from model import GetGradientNopadding
-from loss.contrast import ContrastLoss
-from loss.sam_contrast import SAMContrastLoss
-from loss.ram_contrast import RAMContrastLoss
-import pyiqa
+from registry import build, LazyMetric
+from gan_step import GANStep
 import functools
 from torch.nn import init
 
@@ -282,6 +279,8 @@ class Trainer:
     def __init__(self, model, tmodel, args, supervised_loader, unsupervised_loader, val_loader, iter_per_epoch, writer):
 
         self.supervised_loader = supervised_loader
+        # endless, reshuffled and re-augmented labeled batches, see data_stream.py
+        self.supervised_stream = InfiniteLoader(supervised_loader)
         self.unsupervised_loader = unsupervised_loader
         self.val_loader = val_loader
         self.args = args
@@ -296,12 +295,12 @@ class Trainer:
         self.loss_unsup = nn.L1Loss()
         self.loss_str = MyLoss().cuda()
         self.loss_grad = nn.L1Loss().cuda()
-        #self.loss_cr = ContrastLoss().cuda()
-        #self.loss_cr = SAMContrastLoss().cuda()
-        self.loss_cr = RAMContrastLoss().cuda()
+        # 'contrast' (VGG), 'sam_contrast' or 'ram_contrast', see registry.REGISTRY['loss']
+        self.loss_cr = build('loss', getattr(args, 'contrast_loss', 'ram_contrast')).cuda()
         self.consistency = 0.2
         self.consistency_rampup = 100.0
-        self.iqa_metric = pyiqa.create_metric('musiq', as_loss=True).cuda()
+        # pyiqa is imported on the first get_reliable call
+        self.iqa_metric = LazyMetric('musiq', as_loss=True)
         vgg_model = vgg16(pretrained=True).features[:16]
         vgg_model = vgg_model.cuda()
         self.loss_per = PerpetualLoss(vgg_model).cuda()
@@ -319,6 +318,11 @@ class Trainer:
         self.netD = define_D(input_nc=3, ndf=64, netD='basic').cuda()
         self.criterionGAN = GANLoss('wgangp').cuda()
         self.optimizer_D = torch.optim.Adam(self.netD.parameters(), lr=2e-4, betas=(0.9, 0.999))
+        # D update ratio, lazy R1/GP and mixed precision of D, see gan_step.py
+        self.gan = GANStep(self.netD, self.criterionGAN, self.optimizer_D,
+                           d_every=getattr(args, 'gan_d_every', 1), d_steps=getattr(args, 'gan_d_steps', 1),
+                           reg=getattr(args, 'gan_reg', 'none'), reg_every=getattr(args, 'gan_reg_every', 4),
+                           reg_weight=getattr(args, 'gan_reg_weight', 10.0), amp=getattr(args, 'gan_amp', False))
 
     @torch.no_grad()
     def update_teachers(self, teacher, itera, keep_rate=0.996):
@@ -376,6 +380,11 @@ class Trainer:
         else:
             checkpoint = torch.load(self.args.resume_path)
             self.model.load_state_dict(checkpoint['state_dict'])
+            # checkpoints written before the discriminator was saved restart it from scratch
+            if 'netD' in checkpoint:
+                self.netD.load_state_dict(checkpoint['netD'])
+                self.optimizer_D.load_state_dict(checkpoint['optimizer_D'])
+                self.gan.load_state_dict(checkpoint['gan'])
         for epoch in range(self.start_epoch, self.epochs + 1):
             loss_ave, psnr_train = self._train_epoch(epoch)
             loss_val = loss_ave.item() / self.args.crop_size * self.args.train_batchsize
@@ -394,24 +403,14 @@ class Trainer:
                 state = {'arch': type(self.model).__name__,
                          'epoch': epoch,
                          'state_dict': self.model.state_dict(),
-                         'optimizer_dict': self.optimizer_s.state_dict()}
+                         'optimizer_dict': self.optimizer_s.state_dict(),
+                         'netD': self.netD.state_dict(),
+                         'optimizer_D': self.optimizer_D.state_dict(),
+                         'gan': self.gan.state_dict()}
                 ckpt_name = str(self.args.save_path) + 'model_e{}.pth'.format(str(epoch))
                 print("Saving a checkpoint: {} ...".format(str(ckpt_name)))
                 torch.save(state, ckpt_name)
 
-    def set_requires_grad(self, nets, requires_grad=False):
-        """Set requies_grad=Fasle for all the networks to avoid unnecessary computations
-        Parameters:
-            nets (network list)   -- a list of networks
-            requires_grad (bool)  -- whether the networks require gradients or not
-        """
-        if not isinstance(nets, list):
-            nets = [nets]
-        for net in nets:
-            if net is not None:
-                for param in net.parameters():
-                    param.requires_grad = requires_grad
-
     def _train_epoch(self, epoch):
         sup_loss = AverageMeter()
         unsup_loss = AverageMeter()
@@ -419,7 +418,7 @@ class Trainer:
         psnr_train = []
         self.model.train()
         self.freeze_teachers_parameters()
-        train_loader = iter(zip(cycle(self.supervised_loader), self.unsupervised_loader))
+        train_loader = iter(zip(self.supervised_stream, self.unsupervised_loader))
         tbar = range(len(self.unsupervised_loader))
         tbar = tqdm(tbar, ncols=130, leave=True)
         for i in tbar:
@@ -449,30 +448,13 @@ class Trainer:
             total_loss = total_loss.mean()
             psnr_train.extend(to_psnr(outputs_l, label))
             
-            #update D
-            self.set_requires_grad(self.netD, True)  # enable backprop for D
-            self.optimizer_D.zero_grad()     # set D's gradients to zero
-            #backward_D
-            #fake
-            pred_fake = self.netD(outputs_l.detach()) #discriminator给到
-            loss_D_fake = self.criterionGAN(pred_fake, False)
-
-            #real
-            pred_real = self.netD(label) #discriminator给到
-            loss_D_real = self.criterionGAN(pred_real, True)
-            loss_D = (loss_D_fake + loss_D_real) * 0.5
-            loss_D.backward()
-            self.optimizer_D.step()          # update D's weights
-
-            #update G
-            self.set_requires_grad(self.netD, False)  #冻结distriminator
+            # one D forward on outputs_l gives the G loss and the D gradients, D is stepped after the G backward
+            loss_G_GAN = self.gan.generator_loss(outputs_l, label)
             self.optimizer_s.zero_grad()
-            #backward_G
-            pred_fake = self.netD(outputs_l) #discriminator给到
-            loss_G_GAN = self.criterionGAN(pred_fake, True)
             total_loss = total_loss + loss_G_GAN
-            total_loss.backward()
+            total_loss.backward(inputs=list(self.model.parameters()))
             self.optimizer_s.step()
+            self.gan.step_discriminator()
 
             tbar.set_description('Train-Student Epoch {} | Ls {:.4f} Lu {:.4f}|'
                                  .format(epoch, sup_loss.avg, unsup_loss.avg))
@@ -487,6 +469,10 @@ class Trainer:
         self.writer.add_scalar('Train_loss', total_loss, global_step=epoch)
         self.writer.add_scalar('sup_loss', sup_loss.avg, global_step=epoch)
         self.writer.add_scalar('unsup_loss', unsup_loss.avg, global_step=epoch)
+        if self.gan.loss_D is not None:
+            self.writer.add_scalar('D_loss', self.gan.loss_D, global_step=epoch)
+        if self.gan.penalty is not None:
+            self.writer.add_scalar('D_penalty', self.gan.penalty, global_step=epoch)
         self.lr_scheduler_s.step(epoch=epoch - 1)
         return loss_total_ave, psnr_train
 
@@ -2,28 +2,27 @@ import torch
 import numpy as np
 from tqdm import tqdm
 import torch.nn as nn
-from itertools import cycle
 import torchvision
 import torch.distributed as dist
 from torch.optim import lr_scheduler
 import PIL.Image as Image
 from utils import *
+from data_stream import InfiniteLoader
 from torch.autograd import Variable
 from adamp import AdamP
 from torchvision.models import vgg16
 from loss.losses import *
-from model import GetGradientNopadding
-from loss.contrast import ContrastLoss
-from loss.sam_contrast import SAMContrastLoss
-from loss.ram_contrast import RAMContrastLoss
+from registry import build, LazyMetric
+from gradient_ops import GetGradientNopadding
 from loss.sam_perceptural import SAMPerpetualLoss
-import pyiqa
 
 
 class TrainerWithGrad:
     def __init__(self, model, tmodel, args, supervised_loader, unsupervised_loader, val_loader, iter_per_epoch, writer):
 
         self.supervised_loader = supervised_loader
+        # endless, reshuffled and re-augmented labeled batches, see data_stream.py
+        self.supervised_stream = InfiniteLoader(supervised_loader)
         self.unsupervised_loader = unsupervised_loader
         self.val_loader = val_loader
         self.args = args
@@ -38,12 +37,13 @@ class TrainerWithGrad:
         self.loss_unsup = nn.L1Loss()
         self.loss_str = MyLoss().cuda()
         self.loss_grad = nn.L1Loss().cuda()
-        #self.loss_cr = ContrastLoss().cuda()
-        #self.loss_cr = SAMContrastLoss().cuda()
-        self.loss_cr = RAMContrastLoss().cuda()
+        self.get_grad = GetGradientNopadding(memory_efficient=True).cuda()
+        # 'contrast' (VGG), 'sam_contrast' or 'ram_contrast', see registry.REGISTRY['loss']
+        self.loss_cr = build('loss', getattr(args, 'contrast_loss', 'ram_contrast')).cuda()
         self.consistency = 0.1
         self.consistency_rampup = 100.0
-        self.iqa_metric = pyiqa.create_metric('musiq', as_loss=True).cuda()
+        # pyiqa is imported on the first get_reliable call
+        self.iqa_metric = LazyMetric('musiq', as_loss=True)
         vgg_model = vgg16(pretrained=True).features[:16]
         vgg_model = vgg_model.cuda()
         self.loss_per = SAMPerpetualLoss().cuda()
@@ -143,7 +143,7 @@ class TrainerWithGrad:
         psnr_train = []
         self.model.train()
         self.freeze_teachers_parameters()
-        train_loader = iter(zip(cycle(self.supervised_loader), self.unsupervised_loader))
+        train_loader = iter(zip(self.supervised_stream, self.unsupervised_loader))
         tbar = range(len(self.unsupervised_loader))
         tbar = tqdm(tbar, ncols=130, leave=True)
         for i in tbar:
@@ -160,8 +160,8 @@ class TrainerWithGrad:
             outputs_ul, _ = self.model(unpaired_data_s)
             structure_loss = self.loss_str(outputs_l, label)
             perpetual_loss = self.loss_per(outputs_l, label)
-            get_grad = GetGradientNopadding().cuda()
-            gradient_loss = self.loss_grad(get_grad(outputs_l), get_grad(label)) + self.loss_grad(outputs_g, get_grad(label))
+            label_grad = self.get_grad(label)
+            gradient_loss = self.loss_grad(self.get_grad(outputs_l), label_grad) + self.loss_grad(outputs_g, label_grad)
             loss_sup = structure_loss + 0.3 * perpetual_loss + 0.1 * gradient_loss
             sup_loss.update(loss_sup.mean().item())
 